@@ -0,0 +1,109 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thomas Quintana <quintana.thomas@gmail.com>
+
+'''
+Measures the number of events per second that can be routed by the
+dispatch rule index compared to the linear scan it replaced as the number
+of tenant rules grows. Half of the events match the last tenant rule and
+the other half match no rule at all.
+
+Usage: python -m benchmarks.dispatch_rules [events]
+'''
+from lib.esl import Event
+from lib.server import DispatchRules
+
+import re, sys, time
+
+def generate_rules(tenants):
+  rules = [{
+    'header_name': 'Event-Name',
+    'header_value': 'HEARTBEAT',
+    'target': 'switchlets.heartbeat.example.Monitor'
+  }]
+  for tenant in range(tenants):
+    rules.append({
+      'header_name': 'variable_tenant_id',
+      'header_value': 'tenant-%i' % tenant,
+      'target': 'switchlets.tenants.Tenant%i' % tenant
+    })
+  rules.append({
+    'header_name': 'FreeSWITCH-Hostname',
+    'header_pattern': '^gateway-[0-9]+$',
+    'target': 'switchlets.gateways.Gateway'
+  })
+  return rules
+
+def generate_events(events, tenants):
+  matched = Event({
+    'Event-Name': 'CHANNEL_CREATE',
+    'FreeSWITCH-Hostname': 'freeswitch.local',
+    'variable_tenant_id': 'tenant-%i' % (tenants - 1)
+  })
+  unmatched = Event({
+    'Event-Name': 'CHANNEL_ANSWER',
+    'FreeSWITCH-Hostname': 'freeswitch.local',
+    'variable_tenant_id': 'unknown'
+  })
+  return [matched, unmatched] * (events / 2)
+
+def linear_scan(rules):
+  '''
+  The linear scan that DispatchRules replaced. It is kept here as a
+  reference point for the benchmark.
+  '''
+  def get_target(message):
+    for rule in rules:
+      target = rule.get('target')
+      name = rule.get('header_name')
+      header = message.get_header(name)
+      if not header:
+        continue
+      value = rule.get('header_value')
+      if value and header == value:
+        return target
+      pattern = rule.get('header_pattern')
+      if pattern:
+        match = re.search(pattern, header)
+        if match:
+          return target
+  return get_target
+
+def report(name, tenants, get_target, events):
+  count, elapsed = run(get_target, events)
+  print '%-8s %6i rules %8i events %8.3fs %10.0f events/sec' % (name,
+    tenants + 2, count, elapsed, count / elapsed)
+
+def run(get_target, events):
+  start = time.time()
+  for event in events:
+    get_target(event)
+  return len(events), time.time() - start
+
+def main():
+  events = 100000
+  if len(sys.argv) > 1:
+    events = int(sys.argv[1])
+  for tenants in [2, 20, 200]:
+    rules = generate_rules(tenants)
+    stream = generate_events(events, tenants)
+    report('linear', tenants, linear_scan(rules), stream)
+    report('indexed', tenants, DispatchRules(rules).get_target, stream)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,235 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thomas Quintana <quintana.thomas@gmail.com>
+
+'''
+Measures the number of events per second the event socket parser can
+process compared to the StringIO based parser it replaced, and how the
+plain, json and xml event formats compare for the same event mix. Like
+the dispatcher, every event has a handful of its headers read.
+
+Usage: python -m benchmarks.esl_parser [events] [chunk size]
+'''
+from lib.esl import Event, EventSocketParser, json_loads, parse_headers
+from os import SEEK_END
+from xml.sax.saxutils import escape
+
+# Import the proper StringIO implementation.
+try:
+  from cStringIO import StringIO
+except:
+  from StringIO import StringIO
+
+import json, sys, time, urllib
+
+CHANNEL_EVENT = ''.join([
+  'Event-Name: CHANNEL_CREATE\n',
+  'Core-UUID: 2a1f7f4e-5a2b-11e4-b3a8-0800272a5ae6\n',
+  'FreeSWITCH-Hostname: freeswitch.local\n',
+  'Event-Date-Local: 2014-10-22%2015%3A03%3A21\n',
+  'Channel-State: CS_INIT\n',
+  'Channel-Call-UUID: 5f6b2c9e-5a2b-11e4-b3b9-0800272a5ae6\n',
+  'Unique-ID: 5f6b2c9e-5a2b-11e4-b3b9-0800272a5ae6\n',
+  'Call-Direction: inbound\n',
+  'Caller-Direction: inbound\n',
+  'Caller-Caller-ID-Number: 1000\n',
+  'Caller-Destination-Number: 5551234\n',
+  'Caller-Network-Addr: 192.168.1.10\n'
+] + ['variable_sip_h_X-Header-%i: value%%20%i\n' % (i, i) for i in range(60)] + ['\n'])
+
+BACKGROUND_JOB_EVENT = ''.join([
+  'Event-Name: BACKGROUND_JOB\n',
+  'Core-UUID: 2a1f7f4e-5a2b-11e4-b3a8-0800272a5ae6\n',
+  'Job-UUID: 7f4db78a-17d7-11dd-b7a0-db4edd065621\n',
+  'Job-Command: uuid_answer\n',
+  'Job-Command-Arg: 5f6b2c9e-5a2b-11e4-b3b9-0800272a5ae6\n',
+  'Content-Length: 4\n\n',
+  '+OK\n'
+])
+
+# The headers the dispatcher and a typical switchlet read from an event.
+HEADERS_READ = ['Content-Type', 'Job-UUID', 'Event-Name', 'Channel-Call-UUID']
+
+class StringIOEventSocketParser(object):
+  '''
+  The StringIO based parser that EventSocketParser replaced. It is kept
+  here as a reference point for the benchmark.
+  '''
+  def __init__(self):
+    self.__buffer__ = StringIO()
+
+  def feed(self, data):
+    self.__buffer__.seek(0, SEEK_END)
+    self.__buffer__.write(data)
+
+  def next_event(self):
+    buffer_contents = self.__buffer__.getvalue()
+    if len(buffer_contents) == 0 or buffer_contents.find('\n\n') == -1:
+      return None
+    self.__buffer__.seek(0)
+    body = None
+    headers = self.__parse_headers__()
+    length = headers.get('Content-Length')
+    if length:
+      length = int(length)
+      del headers['Content-Length']
+      offset = self.__buffer__.tell()
+      self.__buffer__.seek(0, SEEK_END)
+      end = self.__buffer__.tell()
+      if length <= end - offset:
+        self.__buffer__.seek(offset)
+        if headers.get('Content-Type') == 'text/event-plain':
+          headers.update(self.__parse_headers__())
+          length = headers.get('Content-Length')
+          if length:
+            del headers['Content-Length']
+            body = self.__buffer__.read(int(length))
+        else:
+          body = self.__buffer__.read(length)
+      else:
+        return None
+    offset = self.__buffer__.tell()
+    self.__buffer__.seek(0, SEEK_END)
+    remaining = self.__buffer__.tell() - offset
+    if remaining == 0:
+      self.__buffer__.seek(0)
+      self.__buffer__.truncate(0)
+    else:
+      self.__buffer__.seek(offset)
+      data = self.__buffer__.read(remaining)
+      self.__buffer__.seek(0)
+      self.__buffer__.write(data)
+      self.__buffer__.truncate(remaining)
+    return Event(headers, body)
+
+  def __parse_headers__(self):
+    headers = dict()
+    while True:
+      line = self.__parse_line__()
+      if line == '':
+        break
+      tokens = line.split(':', 1)
+      value = tokens[1].strip()
+      if value:
+        value = urllib.unquote(value)
+      headers.update({tokens[0].strip(): value})
+    return headers
+
+  def __parse_line__(self, stride = 64):
+    line = list()
+    while True:
+      chunk = self.__buffer__.read(stride)
+      end = chunk.find('\n')
+      if end == -1:
+        line.append(chunk)
+      else:
+        line.append(chunk[:end])
+        offset = self.__buffer__.tell()
+        self.__buffer__.seek(offset - len(chunk[end + 1:]))
+        break
+      if len(chunk) < stride:
+        break
+    return ''.join(line)
+
+def decode_event(event):
+  separator = event.find('\n\n')
+  headers = parse_headers(event[:separator])
+  body = None
+  length = headers.pop('Content-Length', None)
+  if length:
+    body = event[separator + 2:separator + 2 + int(length)]
+  return headers, body
+
+def json_event(event):
+  headers, body = decode_event(event)
+  if body:
+    headers.update({'Content-Length': str(len(body)), '_body': body})
+  return json.dumps(headers)
+
+def xml_event(event):
+  headers, body = decode_event(event)
+  lines = ['<event>\n  <headers>\n']
+  for name, value in headers.items():
+    lines.append('    <%s>%s</%s>\n' % (name, escape(value), name))
+  lines.append('  </headers>\n')
+  if body:
+    lines.append('  <Content-Length>%i</Content-Length>\n' % len(body))
+    lines.append('  <body>%s</body>\n' % escape(body))
+  lines.append('</event>')
+  return ''.join(lines)
+
+FORMATS = {
+  'plain': lambda event: event,
+  'json': json_event,
+  'xml': xml_event
+}
+
+def generate_stream(events, format = 'plain'):
+  encode = FORMATS.get(format)
+  messages = list()
+  for event in [BACKGROUND_JOB_EVENT, CHANNEL_EVENT]:
+    event = encode(event)
+    messages.append('Content-Length: %i\nContent-Type: text/event-%s\n\n%s' %
+      (len(event), format, event))
+  stream = list()
+  for index in range(events):
+    if index % 4 == 0:
+      stream.append(messages[0])
+    else:
+      stream.append(messages[1])
+  return ''.join(stream)
+
+def report(name, parser, stream, chunk_size):
+  count, elapsed = run(parser, stream, chunk_size)
+  print '%-10s %8i events %10i bytes %8.3fs %10.0f events/sec' % (name,
+    count, len(stream), elapsed, count / elapsed)
+
+def run(parser, stream, chunk_size):
+  count = 0
+  start = time.time()
+  for offset in xrange(0, len(stream), chunk_size):
+    parser.feed(stream[offset:offset + chunk_size])
+    while True:
+      event = parser.next_event()
+      if not event:
+        break
+      for name in HEADERS_READ:
+        event.get_header(name)
+      count += 1
+  return count, time.time() - start
+
+def main():
+  events = 20000
+  chunk_size = 4096
+  if len(sys.argv) > 1:
+    events = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    chunk_size = int(sys.argv[2])
+  print 'Parsing %i events in %i byte chunks using the %s JSON decoder.' % \
+    (events, chunk_size, json_loads.__module__)
+  stream = generate_stream(events)
+  for name, parser in [('StringIO', StringIOEventSocketParser()),
+                       ('bytearray', EventSocketParser()),
+                       ('lazy', EventSocketParser(lazy_headers = True))]:
+    report(name, parser, stream, chunk_size)
+  for format in ['json', 'xml']:
+    report(format, EventSocketParser(), generate_stream(events, format),
+      chunk_size)
+
+if __name__ == '__main__':
+  main()
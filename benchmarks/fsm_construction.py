@@ -0,0 +1,107 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thomas Quintana <quintana.thomas@gmail.com>
+
+'''
+Measures the number of finite state machines with the transitions and
+actions of the IncomingCallHandler that can be created per second when
+the transition lookup table is cached by the class compared to when it is
+created for every instance.
+
+Usage: python -m benchmarks.fsm_construction [machines]
+'''
+from lib.fsm import Action, FiniteStateMachine
+
+import sys, time
+
+class CallHandler(FiniteStateMachine):
+  initial_state = 'not ready'
+
+  transitions = [
+    ('not ready', 'waiting for incoming call'),
+    ('waiting for incoming call', 'call started. fetching app'),
+    ('call started. fetching app', 'failed query. stopping call'),
+    ('call started. fetching app', 'fetching execution logic'),
+    ('fetching execution logic', 'failed query. stopping call'),
+    ('fetching execution logic', 'got logic. answering call'),
+    ('got logic. answering call', 'executing call logic'),
+    ('failed query. stopping call', 'terminate call'),
+    ('executing call logic', 'terminate call'),
+    ('terminate call', 'call terminated'),
+    ('call terminated', 'waiting for incoming call'),
+  ]
+
+  def __init__(self, *args, **kwargs):
+    super(CallHandler, self).__init__(*args, **kwargs)
+    self.__call_context__ = {}
+
+  @Action(state = 'call started. fetching app')
+  def fetch_app(self, message):
+    pass
+
+  @Action(state = 'fetching execution logic')
+  def find_call_execution_logic(self, message):
+    pass
+
+  @Action(state = 'got logic. answering call')
+  def call_answer(self, message):
+    pass
+
+  @Action(state = 'executing call logic')
+  def call_execution(self, message):
+    pass
+
+  @Action(state = 'failed query. stopping call')
+  def call_rejection(self, message):
+    pass
+
+  @Action(state = 'terminate call')
+  def clean_up_call(self, message):
+    pass
+
+  @Action(state = 'call terminated')
+  def end_call(self, message):
+    pass
+
+class UncachedCallHandler(CallHandler):
+  '''
+  Creates the transition lookup table for every instance like the finite
+  state machine did before the table was cached. It is kept here as a
+  reference point for the benchmark.
+  '''
+  @classmethod
+  def __get_lookup_table__(cls):
+    return cls.__create_lookup_table__()
+
+def report(name, klass, machines):
+  start = time.time()
+  for counter in xrange(machines):
+    klass()
+  elapsed = time.time() - start
+  print '%-8s %8i machines %8.3fs %10.0f machines/sec %8.2fus/machine' % (
+    name, machines, elapsed, machines / elapsed, elapsed * 1000000 / machines)
+
+def main():
+  machines = 100000
+  if len(sys.argv) > 1:
+    machines = int(sys.argv[1])
+  report('uncached', UncachedCallHandler, machines)
+  report('cached', CallHandler, machines)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,112 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thomas Quintana <quintana.thomas@gmail.com>
+
+'''
+Measures the number of transitions per second taken by a finite state
+machine compared to a compiled finite state machine for the transition
+the dispatcher takes for every event and for the states a call goes
+through, with transition tracing turned off and on.
+
+Usage: python -m benchmarks.fsm_transitions [transitions]
+'''
+from lib.fsm import Action, CompiledFiniteStateMachine, FiniteStateMachine, \
+  Guard, TransitionHistogram, set_transition_sink
+
+import sys, time
+
+class Dispatcher(FiniteStateMachine):
+  initial_state = 'not ready'
+
+  transitions = [
+    ('not ready', 'authenticating'),
+    ('authenticating', 'failed authentication'),
+    ('authenticating', 'initializing'),
+    ('initializing', 'failed initialization'),
+    ('initializing', 'dispatching'),
+    ('dispatching', 'dispatching'),
+    ('dispatching', 'done')
+  ]
+
+  @Action(state = 'dispatching')
+  def dispatch(self, message):
+    pass
+
+class CompiledDispatcher(Dispatcher, CompiledFiniteStateMachine):
+  pass
+
+class CallHandler(FiniteStateMachine):
+  initial_state = 'waiting for incoming call'
+
+  transitions = [
+    ('waiting for incoming call', 'call started. fetching app'),
+    ('call started. fetching app', 'fetching execution logic'),
+    ('fetching execution logic', 'got logic. answering call'),
+    ('got logic. answering call', 'executing call logic'),
+    ('executing call logic', 'terminate call'),
+    ('terminate call', 'call terminated'),
+    ('call terminated', 'waiting for incoming call')
+  ]
+
+  @Guard(state = 'executing call logic')
+  def answered(self):
+    return True
+
+  @Action(state = 'call started. fetching app')
+  def fetch_app(self, message):
+    pass
+
+  @Action(state = 'got logic. answering call')
+  def call_answer(self, message):
+    pass
+
+  @Action(state = 'terminate call', on_enter = False, on_exit = True)
+  def clean_up_call(self, message):
+    pass
+
+class CompiledCallHandler(CallHandler, CompiledFiniteStateMachine):
+  pass
+
+def report(name, machine, states, transitions):
+  start = time.time()
+  for counter in xrange(transitions / len(states)):
+    for state in states:
+      machine.transition(to = state)
+  elapsed = time.time() - start
+  print '%-29s %8i transitions %8.3fs %10.0f transitions/sec' % (name,
+    transitions, elapsed, transitions / elapsed)
+
+def main():
+  transitions = 700000
+  if len(sys.argv) > 1:
+    transitions = int(sys.argv[1])
+  for klass in [Dispatcher, CompiledDispatcher]:
+    machine = klass()
+    for state in ['authenticating', 'initializing', 'dispatching']:
+      machine.transition(to = state)
+    report(klass.__name__, machine, ['dispatching'], transitions)
+  for klass in [CallHandler, CompiledCallHandler]:
+    states = [end for begin, end in klass.transitions]
+    report(klass.__name__, klass(), states, transitions)
+  set_transition_sink(TransitionHistogram())
+  for klass in [CallHandler, CompiledCallHandler]:
+    states = [end for begin, end in klass.transitions]
+    report('%s (traced)' % klass.__name__, klass(), states, transitions)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thomas Quintana <quintana.thomas@gmail.com>
+
+'''
+Measures how long the TimerService takes to expire timers that all fall
+into the same tick, for one-shot and recurring timers spread over a few
+observers and over one observer per timer.
+
+Usage: python -m benchmarks.timer_expiry [timers]
+'''
+from lib.services import ReceiveTimeoutCommand, ScheduleTimersCommand, \
+  TimerService
+from Queue import Queue
+
+import sys, time
+
+class Observer(object):
+  '''
+  Stands in for a pykka ActorRef whose tell puts the message in the actor's
+  inbox.
+  '''
+  def __init__(self, urn):
+    self.actor_urn = urn
+    self.actor_inbox = Queue()
+
+  def is_alive(self):
+    return True
+
+  def tell(self, message):
+    self.actor_inbox.put(message)
+
+def report(name, timers, observers, recurring):
+  service = TimerService(clock = 'thread')
+  actors = [Observer('urn:%i' % index) for index in xrange(observers)]
+  commands = [ReceiveTimeoutCommand(actors[index % observers], 100,
+    recurring = recurring) for index in xrange(timers)]
+  service.on_receive({'content': ScheduleTimersCommand(commands)})
+  start = time.time()
+  service.__tick__()
+  elapsed = time.time() - start
+  messages = sum([actor.actor_inbox.qsize() for actor in actors])
+  print '%-21s %7i timers %7i observers %7i messages %8.3fs' % (name,
+    timers, observers, messages, elapsed)
+
+def main():
+  timers = 100000
+  if len(sys.argv) > 1:
+    timers = int(sys.argv[1])
+  for recurring in [False, True]:
+    name = 'recurring' if recurring else 'one-shot'
+    for observers in [100, timers]:
+      report(name, timers, observers, recurring)
+
+if __name__ == '__main__':
+  main()
@@ -29,6 +29,8 @@ dispatch_rules = [
     'header_name': 'Event-Name',
     'header_value': 'CHANNEL_CREATE',
     'persistent': False,
+    # The number of handlers started ahead of time and reused across calls.
+    'pool_size': 32,
     'target': 'switchlets.call_handlers.IncomingCallHandler'
   }
   #,{
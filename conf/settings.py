@@ -30,13 +30,111 @@ logging_level = DEBUG
 logging_format = '%(asctime)s %(levelname)s - %(name)s - %(message)s'
 logging_filename = None # '/usr/lib/freepy/log/freepy.log'
 
-# The Event Socket configuration used to connect to FreeSWITCH.
-freeswitch_host = {
+# The Event Socket configuration used to connect to FreeSWITCH. Every
+# FreeSWITCH node in the list gets its own dispatcher.
+freeswitch_hosts = [
+  {
     'name':     'FreeSwITCH Test VM',
     'address':  '127.0.0.1',
     'port':      8021,
     'password': 'ClueCon'
-}
+  }
+]
+
+# When set freepy also accepts the connections FreeSWITCH makes when the
+# socket application is used in outbound mode, e.g.
+#   <action application="socket" data="127.0.0.1:8084 async full"/>
+# Every call that connects is handled by a new instance of the target
+# switchlet which receives the CHANNEL_DATA event for the call first.
+outbound_socket = None
+#outbound_socket = {
+#  'address': '0.0.0.0',
+#  'port':     8084,
+#  'target':  'switchlets.call_handlers.IncomingCallHandler'
+#}
+
+# The number of event socket connections opened to FreeSWITCH. When more
+# than one connection is used calls are spread across the connections by
+# their UUID. The possible values are 1 through 16.
+event_socket_connections = 1
+
+# The number of dispatcher threads used for every event socket connection.
+# Events are spread across the threads by their call or job UUID so the
+# events for a call are always handled in order by the same thread. The
+# possible values are 1 through 16.
+dispatcher_shards = 1
+
+# The number of worker processes used for every FreeSWITCH node. When set,
+# the freepy process owns the event socket connections and spreads the calls
+# across the worker processes by their UUID while the switchlets run in the
+# workers. Worker processes can not be combined with several event socket
+# connections or the outbound socket. Every worker process runs
+# dispatcher_shards dispatcher threads. Set to 0 to run everything in a single
+# process. At most 16 worker processes can be used.
+worker_processes = 0
+
+# The directory where freepy creates a private directory, only accessible by
+# the user running freepy, for the UNIX sockets used between the freepy
+# process and its worker processes. Set to None to use the system's temporary
+# directory.
+worker_socket_directory = None
+
+# The format used by FreeSWITCH to deliver events. The possible values are:
+#   plain
+#   json
+#   xml
+event_socket_format = 'plain'
+
+# When True the headers of plain events are only decoded when they are
+# requested by the dispatcher or a switchlet instead of when the event
+# is parsed.
+event_socket_lazy_headers = True
+
+# When True all the events received from FreeSWITCH in one read are
+# delivered to the dispatcher as a single message.
+event_socket_batch_events = True
+
+# When True FreeSWITCH is asked to filter out the events that do not match
+# a dispatch rule or a watch registered by a switchlet.
+event_socket_filters = True
+
+# The number of seconds the dispatcher waits for the reply to a command and
+# keeps a job observer that was not unregistered before forgetting them.
+dispatcher_transaction_ttl = 60
+dispatcher_observer_ttl = 3600
+
+# When True, the sender of an expired command and the observer of an expired
+# job receive a JobTimeoutEvent.
+dispatcher_expiry_notifications = True
+
+# The dispatcher mailbox watermarks. When the number of messages waiting
+# for a dispatcher reaches the high watermark freepy stops reading from
+# FreeSWITCH until the mailbox drains back to the low watermark. Set the
+# high watermark to None to read without limits.
+dispatcher_mailbox_high_watermark = 10000
+dispatcher_mailbox_low_watermark = 1000
+
+# The actor runtime used by the dispatchers and switchlets. The possible
+# values are:
+#   threading - Every actor runs in its own thread.
+#   gevent    - Every actor runs in a greenlet. Requires gevent.
+#   eventlet  - Every actor runs in a green thread. Requires eventlet.
+# The green runtimes need kilobytes per actor instead of a thread stack
+# and patch the standard library when freepy starts.
+actor_runtime = 'threading'
+
+# When True every transition taken by the dispatchers and switchlets is
+# counted and the time spent in every state is kept in a histogram.
+fsm_tracing = False
+
+# The largest pool of pre-started switchlets a dispatch rule may ask for
+# with its pool_size.
+switchlet_pool_maximum = 1000
+
+# The clock that drives the timer service. 'reactor' ticks from a
+# LoopingCall inside the twisted reactor and 'thread' ticks from a
+# dedicated thread.
+timer_clock = 'reactor'
 
 # A list of services to register with the dispatcher.
 dispatcher_services = [
@@ -44,6 +142,7 @@ dispatcher_services = [
     'name': 'Timer Service',                # The service name.
     'events': [                             # A list of events to forward to the service.
       'ReceiveTimeoutCommand',
+      'ScheduleTimersCommand',
       'StopTimeoutCommand'
     ],
     'target': 'lib.services.TimerService'  # The path to the service.
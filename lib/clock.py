@@ -0,0 +1,62 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thomas Quintana <quintana.thomas@gmail.com>
+
+'''
+A monotonic clock for measuring elapsed time that is not affected when the
+system clock is changed.
+'''
+import ctypes, sys, time
+
+# The clock id of CLOCK_MONOTONIC differs between platforms.
+if sys.platform == 'darwin':
+  CLOCK_MONOTONIC = 6
+else:
+  CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+  _fields_ = [
+    ('tv_sec', ctypes.c_long),
+    ('tv_nsec', ctypes.c_long)
+  ]
+
+def __load_clock_gettime__():
+  for name in [None, 'librt.so.1', 'libc.dylib']:
+    try:
+      return ctypes.CDLL(name).clock_gettime
+    except (AttributeError, OSError):
+      pass
+
+__clock_gettime__ = __load_clock_gettime__()
+
+def monotonic():
+  '''
+  Returns: The number of seconds elapsed since an arbitrary point in time.
+  '''
+  now = timespec()
+  if __clock_gettime__(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+    raise OSError('The monotonic clock is not available.')
+  return now.tv_sec + now.tv_nsec / 1000000000.0
+
+# Platforms without a working clock_gettime fall back to the system clock.
+try:
+  if not __clock_gettime__:
+    raise OSError('clock_gettime is not available.')
+  monotonic()
+except OSError:
+  monotonic = time.time
@@ -17,7 +17,29 @@
 #
 # Thomas Quintana <quintana.thomas@gmail.com>
 
-from pykka import ThreadingActor
+from conf.settings import actor_runtime
+
+def get_actor_class(runtime):
+  '''
+  Returns: The pykka actor class for an actor runtime.
+
+  Arguments: runtime - The name of the runtime as in conf.settings.actor_runtime.
+  '''
+  if runtime == 'threading':
+    from pykka import ThreadingActor
+    return ThreadingActor
+  elif runtime == 'gevent':
+    from pykka.gevent import GeventActor
+    return GeventActor
+  elif runtime == 'eventlet':
+    from pykka.eventlet import EventletActor
+    return EventletActor
+  else:
+    raise ValueError('The actor runtime %s is invalid. Possible values are '
+      'threading, gevent or eventlet.' % runtime)
+
+# The actor class extended by dispatchers and switchlets.
+RuntimeActor = get_actor_class(actor_runtime)
 
 class InitializeSwitchletEvent(object):
   def __init__(self, dispatcher):
@@ -26,9 +48,16 @@ class InitializeSwitchletEvent(object):
   def get_dispatcher(self):
     return self.__dispatcher__
 
+class ResetSwitchletEvent(object):
+  '''
+  Sent to a pooled switchlet when it is handed back to its pool so it can
+  forget the call it was handling before it is reused.
+  '''
+  pass
+
 class UninitializeSwitchletEvent(object):
   pass
 
-class Switchlet(ThreadingActor):
+class Switchlet(RuntimeActor):
   def __init__(self, *args, **kwargs):
     super(Switchlet, self).__init__(*args, **kwargs)
\ No newline at end of file
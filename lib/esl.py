@@ -16,28 +16,121 @@
 # under the License.
 #
 # Thomas Quintana <quintana.thomas@gmail.com>
-from os import SEEK_END
-from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+from threading import Lock
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, ReconnectingClientFactory, \
+  ServerFactory
 
-# Import the proper StringIO implementation.
+# Import the fastest available JSON decoder.
 try:
-  from cStringIO import StringIO
-except:
-  from StringIO import StringIO
+  from ujson import loads as json_loads
+except ImportError:
+  try:
+    from simplejson import loads as json_loads
+  except ImportError:
+    from json import loads as json_loads
+
+# Import the proper ElementTree implementation.
+try:
+  from xml.etree.cElementTree import fromstring as xml_loads
+except ImportError:
+  from xml.etree.ElementTree import fromstring as xml_loads
 
 import logging
 import urllib
 
+# The content types used by the event socket to deliver events.
+EVENT_CONTENT_TYPES = frozenset([
+  'text/event-json',
+  'text/event-plain',
+  'text/event-xml'
+])
+
 class IEventSocketClientObserver(object):
   def on_event(self, event):
     pass
 
+  def on_events(self, events):
+    for event in events:
+      self.on_event(event)
+
   def on_start(self, client):
     pass
 
   def on_stop(self):
     pass
 
+def decode_header_value(value):
+  '''
+  Returns: A header value stripped of whitespace and url decoded.
+  '''
+  value = value.strip()
+  if '%' in value:
+    value = urllib.unquote(value)
+  return value
+
+def find_header(block, name):
+  '''
+  Finds a header inside a raw block of headers without parsing the rest of
+  the block. When a header is repeated the last value wins just like it does
+  for parse_headers.
+
+  Arguments: block - The raw header block.
+             name  - The name of the header.
+
+  Returns: The decoded header value or None if the header is not present.
+  '''
+  key = name + ':'
+  start = block.rfind('\n' + key)
+  if start == -1:
+    if not block.startswith(key):
+      return None
+    start = len(key)
+  else:
+    start = start + 1 + len(key)
+  end = block.find('\n', start)
+  if end == -1:
+    end = len(block)
+  return decode_header_value(block[start:end])
+
+def parse_headers(block):
+  '''
+  Parses a raw block of headers into a dictionary.
+
+  Arguments: block - The raw header block.
+  '''
+  headers = dict()
+  for line in block.split('\n'):
+    tokens = line.split(':', 1)
+    if len(tokens) < 2:
+      continue
+    headers[tokens[0].strip()] = decode_header_value(tokens[1])
+  return headers
+
+def encode_event(event):
+  '''
+  Encodes an event as a text/event-plain message which EventSocketParser
+  decodes back into an event with the same headers and body. The original
+  Content-Type of the event is kept in the encoded headers.
+
+  Arguments: event - The event to encode.
+  '''
+  lines = list()
+  for name, value in event.get_headers().iteritems():
+    if isinstance(value, unicode):
+      value = value.encode('utf-8')
+    lines.append('%s: %s\n' % (name, urllib.quote(str(value))))
+  body = event.get_body()
+  if body:
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    lines.append('Content-Length: %i\n\n%s' % (len(body), body))
+  else:
+    lines.append('\n')
+  block = ''.join(lines)
+  return 'Content-Length: %i\nContent-Type: text/event-plain\n\n%s' % \
+    (len(block), block)
+
 class Event(object):
   def __init__(self, headers, body = None):
     self.__headers__ = headers
@@ -52,11 +145,207 @@ class Event(object):
   def get_headers(self):
     return self.__headers__
 
+class LazyEvent(Event):
+  '''
+  An event that keeps the raw header block of a plain event and only decodes
+  a header the first time it is requested. The complete dictionary of headers
+  is only built when get_headers() is called.
+
+  Arguments: headers - The already decoded envelope headers.
+             block   - The raw header block of the event.
+             body    - The event body.
+  '''
+  def __init__(self, headers, block, body = None):
+    super(LazyEvent, self).__init__(headers, body)
+    self.__block__ = block
+    self.__decoded__ = dict()
+
+  def get_header(self, name):
+    if self.__block__ is None:
+      return self.__headers__.get(name)
+    if name in self.__decoded__:
+      return self.__decoded__[name]
+    value = None
+    # The Content-Length of the event body is not exposed as a header.
+    if not name == 'Content-Length':
+      value = find_header(self.__block__, name)
+    if value is None:
+      value = self.__headers__.get(name)
+    self.__decoded__[name] = value
+    return value
+
+  def get_headers(self):
+    if self.__block__ is not None:
+      self.__headers__.update(parse_headers(self.__block__))
+      self.__headers__.pop('Content-Length', None)
+      self.__block__ = None
+      self.__decoded__ = None
+    return self.__headers__
+
+class EventSocketParser(object):
+  '''
+  Parses the event socket wire protocol out of a growable bytearray. Incoming
+  data is appended to the buffer and a read cursor is advanced past every
+  complete message so the buffer is only compacted once the consumed prefix
+  grows past a threshold.
+
+  Arguments: threshold    - The number of consumed bytes that triggers compaction.
+             lazy_headers - If True plain events are returned as LazyEvents.
+  '''
+  COMPACTION_THRESHOLD = 65536
+
+  def __init__(self, threshold = COMPACTION_THRESHOLD, lazy_headers = False):
+    self.__buffer__ = bytearray()
+    self.__offset__ = 0
+    self.__threshold__ = threshold
+    self.__lazy_headers__ = lazy_headers
+    # Headers for a message whose body has not been fully received yet.
+    self.__pending__ = None
+
+  def __compact__(self):
+    '''
+    Reclaims the consumed prefix of the buffer.
+    '''
+    offset = self.__offset__
+    if offset == len(self.__buffer__):
+      del self.__buffer__[:]
+      self.__offset__ = 0
+    elif offset >= self.__threshold__:
+      del self.__buffer__[:offset]
+      self.__offset__ = 0
+
+  def __parse_event__(self, headers, start, end):
+    '''
+    Parses the body of a message located between start and end.
+
+    Arguments: headers - The message headers.
+               start   - The offset where the body begins.
+               end     - The offset where the body ends.
+    '''
+    buffer = self.__buffer__
+    content_type = headers.get('Content-Type')
+    if content_type == 'text/event-plain':
+      # Plain events carry their own headers and an optional body.
+      separator = buffer.find('\n\n', start, end)
+      if separator == -1:
+        separator = end
+      block = str(buffer[start:separator])
+      body = None
+      if self.__lazy_headers__:
+        length = find_header(block, 'Content-Length')
+      else:
+        headers.update(parse_headers(block))
+        length = headers.pop('Content-Length', None)
+      if length:
+        offset = separator + 2
+        body = str(buffer[offset:offset + int(length)])
+      if self.__lazy_headers__:
+        return LazyEvent(headers, block, body)
+      return Event(headers, body)
+    elif content_type == 'text/event-json':
+      return self.__parse_json_event__(headers, str(buffer[start:end]))
+    elif content_type == 'text/event-xml':
+      return self.__parse_xml_event__(headers, str(buffer[start:end]))
+    else:
+      return Event(headers, str(buffer[start:end]))
+
+  def __parse_json_event__(self, headers, data):
+    '''
+    Parses an event delivered using the json format.
+
+    Arguments: headers - The message headers.
+               data    - The JSON encoded event.
+    '''
+    headers.update(json_loads(data))
+    headers.pop('Content-Length', None)
+    body = headers.pop('_body', None)
+    return Event(headers, body)
+
+  def __parse_xml_event__(self, headers, data):
+    '''
+    Parses an event delivered using the xml format.
+
+    Arguments: headers - The message headers.
+               data    - The XML encoded event.
+    '''
+    root = xml_loads(data)
+    elements = root.find('headers')
+    if elements is not None:
+      for header in elements:
+        headers[header.tag] = header.text or ''
+    headers.pop('Content-Length', None)
+    body = root.find('body')
+    if body is not None:
+      body = body.text
+    return Event(headers, body)
+
+  def close(self):
+    '''
+    Releases the buffer and any partially received message.
+    '''
+    del self.__buffer__[:]
+    self.__offset__ = 0
+    self.__pending__ = None
+
+  def feed(self, data):
+    '''
+    Appends data received from the event socket to the buffer.
+
+    Arguments: data - The data to append.
+    '''
+    self.__buffer__.extend(data)
+
+  def next_event(self):
+    '''
+    Returns: The next complete event in the buffer or None if more data
+             is required.
+    '''
+    buffer = self.__buffer__
+    if self.__pending__:
+      headers, start, length = self.__pending__
+    else:
+      separator = buffer.find('\n\n', self.__offset__)
+      if separator == -1:
+        return None
+      headers = parse_headers(str(buffer[self.__offset__:separator]))
+      start = separator + 2
+      length = headers.pop('Content-Length', None)
+      if length:
+        length = int(length)
+    if length:
+      end = start + length
+      # Make sure we have enough data to process the body.
+      if end > len(buffer):
+        self.__pending__ = (headers, start, length)
+        return None
+      self.__pending__ = None
+      event = self.__parse_event__(headers, start, end)
+      start = end
+    else:
+      event = Event(headers)
+    self.__offset__ = start
+    self.__compact__()
+    return event
+
 class EventSocketClient(Protocol):
-  def __init__(self, observer):
+  def __init__(self, observer, lazy_headers = False, batch_events = False):
     self.__logger__ = logging.getLogger('freepy.lib.esl.eventsocketclient')
-    # Data buffer.
-    self.__buffer__ = None
+    # Event parser.
+    self.__parser__ = None
+    self.__lazy_headers__ = lazy_headers
+    # When True all the events parsed from one chunk of data are
+    # delivered to the observer at once.
+    self.__batch_events__ = batch_events
+    # Commands waiting to be written by the reactor thread. Every command
+    # sent during one reactor iteration is written at once.
+    self.__send_lock__ = Lock()
+    self.__send_queue__ = list()
+    self.__flush_pending__ = False
+    # Counters for the writes made by the client.
+    self.__bytes_sent__ = 0
+    self.__commands_sent__ = 0
+    self.__flushes__ = 0
+    self.__largest_flush__ = 0
     # Client state.
     self.__host__ = None
     self.__peer__ = None
@@ -67,102 +356,42 @@ class EventSocketClient(Protocol):
       raise TypeError('The observer must extend the \
       IEventSocketClientObserver interface.')
 
-  def __parse__(self):
-    # Make sure we have enough data to process the event.
-    buffer_contents = self.__buffer__.getvalue()
-    if len(buffer_contents) == 0 or not buffer_contents.find('\n\n'):
-      return None
-    else:
-      # Parse the event for processing.
-      self.__buffer__.seek(0)
-      body = None
-      headers = self.__parse_headers__()
-      length = headers.get('Content-Length')
-      if length:
-        length = int(length)
-        # Remove the Content-Length header.
-        del headers['Content-Length']
-        # Make sure we have enough data to process the body.
-        offset = self.__buffer__.tell()
-        self.__buffer__.seek(0, SEEK_END)
-        end = self.__buffer__.tell()
-        remaining = end - offset
-        # Handle the event body.
-        if length <= remaining:
-          self.__buffer__.seek(offset)
-          type = headers.get('Content-Type')
-          if type and type == 'text/event-plain':
-            headers.update(self.__parse_headers__())
-            length = headers.get('Content-Length')
-            if length:
-              length = int(length)
-              del headers['Content-Length']
-              body = self.__buffer__.read(length)
-          else:
-            body = self.__buffer__.read(length)
-        else:
-          return None
-      # Reclaim resources.
-      offset = self.__buffer__.tell()
-      self.__buffer__.seek(0, SEEK_END)
-      end = self.__buffer__.tell()
-      remaining = end - offset
-      if remaining == 0:
-        self.__buffer__.seek(0)
-        self.__buffer__.truncate(0)
-      else:
-        self.__buffer__.seek(offset)
-        data = self.__buffer__.read(remaining)
-        self.__buffer__.seek(0)
-        self.__buffer__.write(data)
-        self.__buffer__.truncate(remaining)
-      return Event(headers, body)
+  def __flush__(self):
+    '''
+    Writes every queued command to the transport. Must be called from
+    the reactor thread.
+    '''
+    with self.__send_lock__:
+      queue = self.__send_queue__
+      self.__send_queue__ = list()
+      self.__flush_pending__ = False
+    if not queue or not self.__peer__:
+      return
+    self.transport.writeSequence(queue)
+    self.__flushes__ += 1
+    self.__commands_sent__ += len(queue)
+    self.__bytes_sent__ += sum([len(command) for command in queue])
+    if len(queue) > self.__largest_flush__:
+      self.__largest_flush__ = len(queue)
 
-  def __parse_headers__(self):
-    headers = dict()
-    while True:
-      line = self.__parse_line__()
-      if line == '':
-        break
-      else:
-        tokens = line.split(':', 1)
-        name = tokens[0].strip()
-        value = tokens[1].strip()
-        if value and not len(value) == 0:
-          value = urllib.unquote(value)
-        headers.update({name: value})
-    return headers
-
-  def __parse_line__(self, stride = 64):
-    line = list()
-    while True:
-      chunk = self.__buffer__.read(stride)
-      end = chunk.find('\n')
-      if end == -1:
-        line.append(chunk)
-      else:
-        line.append(chunk[:end])
-        offset = self.__buffer__.tell()
-        left_over = len(chunk[end + 1:])
-        self.__buffer__.seek(offset - left_over)
-        break
-      if len(chunk) < stride:
-        break
-    return ''.join(line)
-
-  def connectionLost(self, reason):
+  def __on_connection_lost__(self, reason):
     self.__logger__.critical('A connection to the FreeSWITCH instance located @ %s:%i \
     has been lost due to the following reason.\n%s', self.__peer__.host, 
     self.__peer__.port, reason)
+
+  def connectionLost(self, reason):
+    self.__on_connection_lost__(reason)
     self.__observer__.on_stop()
-    if self.__buffer__:
-      self.__buffer__.close()
-    self.__buffer__ = None
+    if self.__parser__:
+      self.__parser__.close()
+    self.__parser__ = None
+    with self.__send_lock__:
+      self.__send_queue__ = list()
     self.__host__ = None
     self.__peer__ = None
 
   def connectionMade(self):
-    self.__buffer__ = StringIO()
+    self.__parser__ = EventSocketParser(lazy_headers = self.__lazy_headers__)
     self.__host__ = self.transport.getHost()
     self.__peer__ = self.transport.getPeer()
     self.__observer__.on_start(self)
@@ -171,29 +400,110 @@ class EventSocketClient(Protocol):
     if self.__logger__.isEnabledFor(logging.DEBUG):
       self.__logger__.debug('The following message was received from %s:%i.\n%s',
         self.__peer__.host, self.__peer__.port, data)
-    self.__buffer__.write(data)
-    while True:
-      event = self.__parse__()
-      if event:
-        self.__observer__.on_event(event)
-      else:
-        break
+    self.__parser__.feed(data)
+    if self.__batch_events__:
+      events = list()
+      while True:
+        event = self.__parser__.next_event()
+        if event:
+          events.append(event)
+        else:
+          break
+      if events:
+        self.__observer__.on_events(events)
+    else:
+      while True:
+        event = self.__parser__.next_event()
+        if event:
+          self.__observer__.on_event(event)
+        else:
+          break
+
+  def get_bytes_sent(self):
+    return self.__bytes_sent__
+
+  def get_commands_sent(self):
+    return self.__commands_sent__
+
+  def get_flushes(self):
+    return self.__flushes__
+
+  def get_largest_flush(self):
+    return self.__largest_flush__
+
+  def pause(self):
+    '''
+    Stops reading from FreeSWITCH. Must be called from the reactor thread.
+    '''
+    self.transport.pauseProducing()
+
+  def resume(self):
+    '''
+    Resumes reading from FreeSWITCH. Must be called from the reactor thread.
+    '''
+    self.transport.resumeProducing()
 
   def send(self, command):
+    '''
+    Queues a command to be written by the reactor thread. It is safe to call
+    this method from any thread.
+
+    Arguments: command - The command to send.
+    '''
     serialized_command = str(command)
     if self.__logger__.isEnabledFor(logging.DEBUG):
       self.__logger__.debug('The following message will be sent to %s:%i.\n%s',
         self.__peer__.host, self.__peer__.port, serialized_command)
-    self.transport.write(serialized_command)
+    with self.__send_lock__:
+      self.__send_queue__.append(serialized_command)
+      if self.__flush_pending__:
+        return
+      self.__flush_pending__ = True
+    reactor.callFromThread(self.__flush__)
 
 class EventSocketClientFactory(ReconnectingClientFactory):
-  def __init__(self, observer):
+  def __init__(self, observer, lazy_headers = False, batch_events = False):
     self.__logger__ = logging.getLogger('freepy.lib.esl.eventsocketclientfactory')
     self.__observer__ = observer
+    self.__lazy_headers__ = lazy_headers
+    self.__batch_events__ = batch_events
 
   def buildProtocol(self, addr):
     if self.__logger__.isEnabledFor(logging.INFO):
       self.__logger__.info('Connected to the FreeSWITCH instance located @ %s:%i.',
         addr.host, addr.port)
     self.resetDelay()
-    return EventSocketClient(self.__observer__)
+    return EventSocketClient(self.__observer__,
+      lazy_headers = self.__lazy_headers__,
+      batch_events = self.__batch_events__)
+
+class OutboundEventSocket(EventSocketClient):
+  '''
+  An event socket connection opened by FreeSWITCH for a single call when
+  the socket application is used in outbound mode.
+  '''
+  def __on_connection_lost__(self, reason):
+    if self.__logger__.isEnabledFor(logging.DEBUG):
+      self.__logger__.debug('The outbound connection from %s:%i has been closed.',
+        self.__peer__.host, self.__peer__.port)
+
+class EventSocketServerFactory(ServerFactory):
+  '''
+  Accepts the outbound event socket connections FreeSWITCH opens for calls.
+
+  Arguments: observer_factory - A callable returning a new observer for
+                                every connection.
+  '''
+  def __init__(self, observer_factory, lazy_headers = False, batch_events = False):
+    self.__logger__ = logging.getLogger('freepy.lib.esl.eventsocketserverfactory')
+    self.__observer_factory__ = observer_factory
+    self.__lazy_headers__ = lazy_headers
+    self.__batch_events__ = batch_events
+
+  def buildProtocol(self, addr):
+    if self.__logger__.isEnabledFor(logging.DEBUG):
+      self.__logger__.debug('Accepted an outbound connection from %s:%i.',
+        addr.host, addr.port)
+    return OutboundEventSocket(self.__observer_factory__(),
+      lazy_headers = self.__lazy_headers__,
+      batch_events = self.__batch_events__)
@@ -20,8 +20,32 @@
 '''
 In this module we implement a declarative finite state machine using method decorators.
 '''
+from bisect import bisect_left
+from lib.clock import monotonic
+from threading import Lock
+
 import types
 
+# The sink that receives every transition taken by a finite state machine.
+# Transitions are not traced while no sink is set.
+__transition_sink__ = None
+
+def get_transition_sink():
+  '''
+  Returns: The sink that receives every transition or None when transitions
+           are not traced.
+  '''
+  return __transition_sink__
+
+def set_transition_sink(sink):
+  '''
+  Starts tracing transitions, or stops when the sink is None.
+
+  Arguments: sink - The TransitionSink that receives every transition.
+  '''
+  global __transition_sink__
+  __transition_sink__ = sink
+
 class FiniteStateMachineError(Exception):
   '''
   A finite state machine exception.
@@ -33,6 +57,87 @@ class FiniteStateMachineError(Exception):
   def __str__(self):
     return self.message
 
+class TransitionSink(object):
+  '''
+  Receives the transitions taken by every finite state machine while
+  transitions are traced. Sinks are called by the thread that took the
+  transition.
+  '''
+  def on_transition(self, machine, begin, end, timestamp, dwell):
+    '''
+    Records a transition.
+
+    Arguments: machine   - The finite state machine.
+               begin     - The state that was left.
+               end       - The state that was entered.
+               timestamp - The monotonic time of the transition in seconds.
+               dwell     - The number of seconds spent in the state that was
+                           left or None when it is unknown.
+    '''
+    pass
+
+class TransitionHistogram(TransitionSink):
+  '''
+  Counts the transitions taken by every class of finite state machine and
+  keeps a histogram of the time spent in each of their states.
+
+  Arguments: buckets - The upper bounds of the histogram buckets in
+                       milliseconds.
+  '''
+  BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+    30000, 60000]
+
+  def __init__(self, buckets = BUCKETS):
+    self.__buckets__ = list(buckets)
+    self.__lock__ = Lock()
+    # The transition counts keyed by class name, beginning and end state.
+    self.__counts__ = dict()
+    # The dwell time counts and totals keyed by class name and state.
+    self.__dwell__ = dict()
+
+  def get_dwell_times(self):
+    '''
+    Returns: A dictionary keyed by class name and state with the number of
+             times each state was left, the total time in milliseconds and
+             a list of (upper bound, count) for every bucket. The last
+             bucket has no upper bound.
+    '''
+    dwell_times = dict()
+    with self.__lock__:
+      for (name, state), (counts, total) in self.__dwell__.items():
+        bounds = self.__buckets__ + [None]
+        dwell_times.setdefault(name, dict()).update({state: {
+          'count': sum(counts),
+          'total': total,
+          'buckets': zip(bounds, counts)
+        }})
+    return dwell_times
+
+  def get_transition_counts(self):
+    '''
+    Returns: A dictionary keyed by class name and a (beginning state, end
+             state) tuple with the number of times the transition was taken.
+    '''
+    transition_counts = dict()
+    with self.__lock__:
+      for (name, begin, end), count in self.__counts__.items():
+        transition_counts.setdefault(name, dict()).update({(begin, end): count})
+    return transition_counts
+
+  def on_transition(self, machine, begin, end, timestamp, dwell):
+    name = machine.__class__.__name__
+    with self.__lock__:
+      key = (name, begin, end)
+      self.__counts__[key] = self.__counts__.get(key, 0) + 1
+      if dwell is not None:
+        milliseconds = dwell * 1000
+        histogram = self.__dwell__.get((name, begin))
+        if histogram is None:
+          histogram = [[0] * (len(self.__buckets__) + 1), 0]
+          self.__dwell__.update({(name, begin): histogram})
+        histogram[0][bisect_left(self.__buckets__, milliseconds)] += 1
+        histogram[1] += milliseconds
+
 class Action(object):
   '''
   The Action decorator adds metadata to methods so they can be used by the finite
@@ -110,23 +215,40 @@ class Guard(object):
 class FiniteStateMachine(object):
   '''
   A finite state machine.
+
+  The transition lookup table is created once for every class, the first
+  time the class is instantiated, and shared by all of its instances.
   '''
+  # The parent of every nested state. Nested states can take the
+  # transitions and triggers declared for their parents.
+  parent_states = dict()
+
+  # The transitions taken when a message is received. Every entry is a
+  # three-tuple of the beginning state, the trigger and the end state where
+  # the trigger is the Event-Name of an event, the Content-Type of an event
+  # without a name or the class of any other message.
+  triggers = list()
+
   def __init__(self, *args, **kwargs):
     super(FiniteStateMachine, self).__init__(*args, **kwargs)
-    self.__fsm_transition_table__ = self.__create_lookup_table__()
+    self.__fsm_transition_table__ = self.__get_lookup_table__()
+    self.__fsm_trigger_table__ = self.__get_trigger_table__()
     self.__state__ = self.initial_state
+    if __transition_sink__ is not None:
+      self.__fsm_entered__ = monotonic()
 
-  def __create_lookup_table__(self):
+  @classmethod
+  def __create_lookup_table__(cls):
     '''
     Creates a transition lookup table based on the possible transitions.
     '''
-    actions = self.__get_actions__()
-    guards = self.__get_guards__()
-    states = self.__get_states__()
-    state_map = self.__create_state_map__(actions, guards, states)
+    actions = cls.__get_actions__()
+    guards = cls.__get_guards__()
+    states = cls.__get_states__()
+    state_map = cls.__create_state_map__(actions, guards, states)
     # Create the lookup table.
     lookup_table = dict()
-    for begin, end in self.transitions:
+    for begin, end in cls.transitions:
       transitions = lookup_table.get(begin)
       if not transitions:
         transitions = dict()
@@ -139,9 +261,21 @@ class FiniteStateMachine(object):
         transition.update({ 'beginning_state': state_map.get(begin) })
       if not transition.has_key('end_state'):
         transition.update({ 'end_state': state_map.get(end) })
+    # Nested states take the transitions of their parents unless they
+    # declare a transition to the same end state.
+    for state in states:
+      for parent in cls.__get_ancestors__(state)[1:]:
+        for end, transition in lookup_table.get(parent, dict()).items():
+          transitions = lookup_table.setdefault(state, dict())
+          if not transitions.has_key(end):
+            transitions.update({ end: {
+              'beginning_state': state_map.get(state),
+              'end_state': transition.get('end_state')
+            }})
     return lookup_table
 
-  def __create_state_map__(self, actions, guards, states):
+  @classmethod
+  def __create_state_map__(cls, actions, guards, states):
     '''
     Creates a map from states to actions and guards.
 
@@ -163,19 +297,19 @@ class FiniteStateMachine(object):
         state_name, action.__name__))
       state = state_map.get(state_name)
       on_enter = action.__fsm_action_on_enter__
-      if not state.has_key('on_enter'):
-        if on_enter:
+      if on_enter:
+        if not state.has_key('on_enter'):
           state.update({ 'on_enter': action })
-      else:
-        raise FiniteStateMachineError('The %s state can only have one \
-        action declared for on_enter.' % (state_name))
+        else:
+          raise FiniteStateMachineError('The %s state can only have one \
+          action declared for on_enter.' % (state_name))
       on_exit = action.__fsm_action_on_exit__
-      if not state.has_key('on_exit'):
-        if on_exit:
+      if on_exit:
+        if not state.has_key('on_exit'):
           state.update({ 'on_exit': action })
-      else:
-        raise FiniteStateMachineError('The %s state can only have one \
-        action declared for on_exit.' % (state_name))
+        else:
+          raise FiniteStateMachineError('The %s state can only have one \
+          action declared for on_exit.' % (state_name))
     # Attach guards to their states.
     for guard in guards:
       state_name = guard.__fsm_guard_state__
@@ -192,57 +326,193 @@ class FiniteStateMachine(object):
         declared' % (state_name))
     return state_map
 
-  def __get_actions__(self):
+  @classmethod
+  def __create_trigger_table__(cls):
+    '''
+    Creates a trigger lookup table based on the declared triggers.
+    '''
+    lookup_table = cls.__get_lookup_table__()
+    states = cls.__get_states__()
+    declared = dict()
+    for begin, trigger, end in cls.triggers:
+      if begin not in states:
+        raise FiniteStateMachineError('A state named %s is not declared \
+        in the transitions list.\n Please add %s to the list of possible \
+        transitions or modify the trigger %s.' % (begin, begin, trigger))
+      declared.setdefault(begin, dict()).setdefault(trigger, end)
+    trigger_table = dict()
+    for state in states:
+      # Triggers declared for a nested state win over those of its parents.
+      triggers = dict()
+      for ancestor in reversed(cls.__get_ancestors__(state)):
+        triggers.update(declared.get(ancestor, dict()))
+      for trigger, end in triggers.items():
+        if not lookup_table.get(state, dict()).has_key(end):
+          raise FiniteStateMachineError('The trigger %s can not take the \
+          transition from %s to %s because it is invalid.' % (trigger,
+          state, end))
+      if triggers:
+        trigger_table.update({ state: triggers })
+    return trigger_table
+
+  @classmethod
+  def __get_actions__(cls):
     '''
     Returns: All the actions declared for this finite state machine.
     '''
     return filter(
       lambda callable: hasattr(callable, '__fsm_action__'),
-      self.__get_callables__()
+      cls.__get_callables__()
     )
 
-  def __get_callables__(self):
+  @classmethod
+  def __get_ancestors__(cls, state):
+    '''
+    Returns: The state followed by its parent states from the nearest to the
+             farthest.
+
+    Arguments: state - The state.
     '''
-    Returns: All the methods for this object.
+    ancestors = [state]
+    parent = cls.parent_states.get(state)
+    while parent:
+      if parent in ancestors:
+        raise FiniteStateMachineError('The parent states of %s form a \
+        cycle.' % (state))
+      ancestors.append(parent)
+      parent = cls.parent_states.get(parent)
+    return ancestors
+
+  @classmethod
+  def __get_callables__(cls):
+    '''
+    Returns: All the functions for this class. Actions and guards are
+             called with the instance as their first argument.
     '''
     actions = list()
-    results = dir(self)
+    results = dir(cls)
     for result in results:
-      attr = getattr(self, result)
+      attr = getattr(cls, result)
       if hasattr(attr, '__call__'):
-        actions.append(attr)
+        actions.append(getattr(attr, 'im_func', attr))
     return actions
 
-  def __get_guards__(self):
+  @classmethod
+  def __get_guards__(cls):
     '''
     Returns: All the guards declared for this finite state machine.
     '''
     return filter(
       lambda callable: hasattr(callable, '__fsm_guard__'),
-      self.__get_callables__()
+      cls.__get_callables__()
     )
 
-  def __get_states__(self):
+  @classmethod
+  def __get_lookup_table__(cls):
+    '''
+    Returns: The transition lookup table for this class.
+    '''
+    # The class dictionary is used so subclasses never share the lookup
+    # table of their parent.
+    lookup_table = cls.__dict__.get('__fsm_lookup_table__')
+    if lookup_table is None:
+      lookup_table = cls.__create_lookup_table__()
+      cls.__fsm_lookup_table__ = lookup_table
+    return lookup_table
+
+  @classmethod
+  def __get_states__(cls):
     '''
     Returns: The possible states based on the declared transitions.
     '''
     # Make sure the user declared a set of possible transitions.
-    if not self.transitions:
+    if not cls.transitions:
       raise FiniteStateMachineError('Please specify a list of possible \
       transitions.\n Each entry in the list is a two-tuple where the \
       first value is the beginning state and the second value is the \
       end state.')
     states = list()
-    for begin, end in self.transitions:
+    for begin, end in cls.transitions:
       if begin not in states:
         states.append(begin)
       if end not in states:
         states.append(end)
+    # Parent states only used to group nested states are states too.
+    for state, parent in sorted(cls.parent_states.items()):
+      for name in [state, parent]:
+        if name not in states:
+          states.append(name)
     return states
 
+  @classmethod
+  def __get_trigger_table__(cls):
+    '''
+    Returns: The trigger lookup table for this class.
+    '''
+    # The class dictionary is used so subclasses never share the trigger
+    # table of their parent.
+    trigger_table = cls.__dict__.get('__fsm_trigger_lookup_table__')
+    if trigger_table is None:
+      trigger_table = cls.__create_trigger_table__()
+      cls.__fsm_trigger_lookup_table__ = trigger_table
+    return trigger_table
+
+  def __trace__(self, begin, end):
+    '''
+    Sends a transition to the transition sink.
+
+    Arguments: begin - The state that was left.
+               end   - The state that was entered.
+    '''
+    sink = __transition_sink__
+    if sink is None:
+      return
+    now = monotonic()
+    entered = getattr(self, '__fsm_entered__', None)
+    self.__fsm_entered__ = now
+    if entered is None:
+      sink.on_transition(self, begin, end, now, None)
+    else:
+      sink.on_transition(self, begin, end, now, now - entered)
+
+  def in_state(self, state):
+    '''
+    Returns: True if the current state is the state or one of its nested
+             states.
+
+    Arguments: state - The state.
+    '''
+    return state in self.__get_ancestors__(self.state())
+
   def state(self):
     return self.__state__
 
+  def trigger(self, message):
+    '''
+    Takes the transition declared by the triggers for the current state and
+    a message. Events are matched by name before they are matched by class.
+
+    Arguments: message - The message that was received.
+
+    Returns: True if a transition was taken or False if no trigger matches.
+    '''
+    triggers = self.__fsm_trigger_table__.get(self.state())
+    if not triggers:
+      return False
+    end = None
+    get_header = getattr(message, 'get_header', None)
+    if get_header is not None:
+      end = triggers.get(get_header('Event-Name') or get_header('Content-Type'))
+    if end is None:
+      for klass in getattr(message.__class__, '__mro__', ()):
+        end = triggers.get(klass)
+        if end is not None:
+          break
+      else:
+        return False
+    self.transition(to = end, event = message)
+    return True
+
   def transition(self, to = None, event = None):
     '''
     Transitions the finite state machine to a new state.
@@ -262,7 +532,7 @@ class FiniteStateMachine(object):
       invalid.' % (self.__state__, to))
     # If there are any guards lets execute those now.
     if transition.get('end_state').has_key('guard'):
-      allowed = transition.get('end_state').get('guard')()
+      allowed = transition.get('end_state').get('guard')(self)
       if not type(allowed) == types.BooleanType:
         raise FiniteStateMachineError('A guard must only return True \
         or False values.')
@@ -271,9 +541,117 @@ class FiniteStateMachine(object):
         from %s to %s.' % (self.__state__, to))
     # Try to execute the action associated with leaving the current state.
     if transition.get('beginning_state').has_key('on_exit'):
-      transition.get('beginning_state').get('on_exit')(event)
+      transition.get('beginning_state').get('on_exit')(self, event)
     # Try to execute the action associated with entering the new state.
     if transition.get('end_state').has_key('on_enter'):
-      transition.get('end_state').get('on_enter')(event)
+      transition.get('end_state').get('on_enter')(self, event)
+    # Enter the new state and we're done.
+    if __transition_sink__ is None:
+      self.__state__ = to
+    else:
+      begin = self.__state__
+      self.__state__ = to
+      self.__trace__(begin, to)
+
+class CompiledTransition(object):
+  '''
+  A transition between two states of a compiled finite state machine with
+  the guard and actions that are executed when it is taken.
+  '''
+  __slots__ = ('end', 'guard', 'on_enter', 'on_exit')
+
+  def __init__(self, end, guard, on_enter, on_exit):
+    self.end = end
+    self.guard = guard
+    self.on_enter = on_enter
+    self.on_exit = on_exit
+
+class CompiledFiniteStateMachine(FiniteStateMachine):
+  '''
+  A finite state machine that is compiled once for every class into a dense
+  table indexed by state numbers. Every transition costs one dictionary
+  lookup for the desired end state and the guard and actions of every
+  transition are resolved ahead of time. States are still declared and
+  reported by name.
+  '''
+  def __init__(self, *args, **kwargs):
+    # The lookup table used by the FiniteStateMachine is not needed.
+    super(FiniteStateMachine, self).__init__(*args, **kwargs)
+    states, state_ids, table = self.__get_compiled_table__()
+    self.__fsm_states__ = states
+    self.__fsm_state_ids__ = state_ids
+    self.__fsm_table__ = table
+    self.__fsm_state__ = state_ids.get(self.initial_state)
+    self.__fsm_trigger_table__ = self.__get_trigger_table__()
+    if __transition_sink__ is not None:
+      self.__fsm_entered__ = monotonic()
+
+  @classmethod
+  def __get_compiled_table__(cls):
+    '''
+    Returns: The state names ordered by number, a map from state names to
+             numbers and the transition table for this class.
+    '''
+    # The class dictionary is used so subclasses never share the compiled
+    # table of their parent.
+    compiled = cls.__dict__.get('__fsm_compiled_table__')
+    if compiled is None:
+      lookup_table = cls.__get_lookup_table__()
+      states = tuple(cls.__get_states__())
+      state_ids = dict([(state, index) for index, state in enumerate(states)])
+      table = list()
+      for begin in states:
+        row = [None] * len(states)
+        for end, transition in lookup_table.get(begin, dict()).items():
+          beginning_state = transition.get('beginning_state')
+          end_state = transition.get('end_state')
+          row[state_ids.get(end)] = CompiledTransition(state_ids.get(end),
+            end_state.get('guard'), end_state.get('on_enter'),
+            beginning_state.get('on_exit'))
+        table.append(tuple(row))
+      compiled = (states, state_ids, tuple(table))
+      cls.__fsm_compiled_table__ = compiled
+    return compiled
+
+  def state(self):
+    return self.__fsm_states__[self.__fsm_state__]
+
+  def transition(self, to = None, event = None):
+    '''
+    Transitions the finite state machine to a new state.
+
+    Arguments: to - The desired end state.
+               event - The event that caused the state change.
+    '''
+    transitions = self.__fsm_table__[self.__fsm_state__]
+    end = self.__fsm_state_ids__.get(to)
+    if end is None or transitions[end] is None:
+      # Make sure we are in a good state.
+      if not any(transitions):
+        raise FiniteStateMachineError('The %s state is invalid, or we \
+        have entered a terminal state.' % (self.state()))
+      raise FiniteStateMachineError('The transition from %s to %s is \
+      invalid.' % (self.state(), to))
+    transition = transitions[end]
+    # If there are any guards lets execute those now.
+    if transition.guard is not None:
+      allowed = transition.guard(self)
+      if allowed is not True:
+        if not allowed is False:
+          raise FiniteStateMachineError('A guard must only return True \
+          or False values.')
+        raise FiniteStateMachineError('A guard declined the transition \
+        from %s to %s.' % (self.state(), to))
+    # Try to execute the action associated with leaving the current state.
+    if transition.on_exit is not None:
+      transition.on_exit(self, event)
+    # Try to execute the action associated with entering the new state.
+    if transition.on_enter is not None:
+      transition.on_enter(self, event)
     # Enter the new state and we're done.
-    self.__state__ = to
\ No newline at end of file
+    if __transition_sink__ is None:
+      self.__fsm_state__ = end
+    else:
+      begin = self.__fsm_states__[self.__fsm_state__]
+      self.__fsm_state__ = end
+      self.__trace__(begin, to)
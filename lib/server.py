@@ -17,18 +17,56 @@
 #
 # Thomas Quintana <quintana.thomas@gmail.com>
 
+from collections import deque, OrderedDict
 from conf.settings import *
+from lib.clock import monotonic
 from lib.commands import *
 from lib.core import *
 from lib.esl import *
 from lib.fsm import *
 from lib.services import *
-from pykka import ActorRegistry, ThreadingActor
+from pykka import ActorRef, ActorRegistry
+from threading import Lock
 from twisted.internet import reactor
+from twisted.internet.protocol import ClientFactory, ProcessProtocol, \
+  ServerFactory
+from twisted.protocols.basic import Int32StringReceiver
 
 import logging
+import os
 import re
+import shutil
 import sys
+import tempfile
+import time
+
+# Calls are sharded across event socket connections by the first
+# hexadecimal digit of their UUID.
+UUID_DIGITS = '0123456789abcdef'
+
+def shard_digits(shard, shards):
+  '''
+  Returns: The leading UUID digits owned by a shard.
+  '''
+  return ''.join([digit for index, digit in enumerate(UUID_DIGITS)
+    if index * shards / len(UUID_DIGITS) == shard])
+
+def shard_for_uuid(uuid, shards, digit = 0):
+  '''
+  Returns: The shard that owns a UUID.
+
+  Arguments: uuid   - The UUID.
+             shards - The number of shards, at most 16.
+             digit  - The position of the hexadecimal digit that picks the
+                      shard. Calls are spread across connections by the
+                      first digit, across the threads or processes behind a
+                      connection by the last one and across the threads of
+                      a worker process by the one before the last.
+  '''
+  try:
+    return int(uuid[digit], 16) * shards / len(UUID_DIGITS)
+  except (IndexError, ValueError):
+    return 0
 
 # Commands used only by the Freepy server.
 class AuthCommand(object):
@@ -38,6 +76,10 @@ class AuthCommand(object):
   def __str__(self):
     return 'auth %s\n\n' % (self.__password__)
 
+class ConnectCommand(object):
+  def __str__(self):
+    return 'connect\n\n'
+
 class EventsCommand(object):
   def __init__ (self, events, format = 'plain'):
     if(not format == 'json' and not format == 'plain' and not format == 'xml'):
@@ -49,7 +91,35 @@ class EventsCommand(object):
   def __str__(self):
     return 'event %s %s\n\n' % (self.__format__, ' '.join(self.__events__))
 
+class FilterCommand(object):
+  def __init__(self, name, value):
+    self.__name__ = name
+    self.__value__ = value
+
+  def get_name(self):
+    return self.__name__
+
+  def get_value(self):
+    return self.__value__
+
+  def __str__(self):
+    return 'filter %s %s\n\n' % (self.__name__, self.__value__)
+
+class FilterDeleteCommand(FilterCommand):
+  def __str__(self):
+    return 'filter delete %s %s\n\n' % (self.__name__, self.__value__)
+
 # Events used only between the Dispatcher and the Dispatcher Proxy.
+class DispatcherReadyEvent(object):
+  pass
+
+class EventBatch(object):
+  def __init__(self, events):
+    self.__events__ = events
+
+  def get_events(self):
+    return self.__events__
+
 class InitializeDispatcherEvent(object):
   def __init__(self, apps, client, events):
     self.__apps__ = apps
@@ -80,6 +150,28 @@ class RegisterJobObserverCommand(object):
   def get_observer(self):
     return self.__observer__
 
+class ReleaseSwitchletCommand(object):
+  '''
+  Sent by a switchlet once it is done with a call so it can be handed back
+  to its pool.
+  '''
+  def __init__(self, switchlet):
+    self.__switchlet__ = switchlet
+
+  def get_switchlet(self):
+    return self.__switchlet__
+
+class JobTimeoutEvent(object):
+  '''
+  Sent to the sender of a command that was not answered, or to a job
+  observer that was not unregistered, before its entry expired.
+  '''
+  def __init__(self, uuid):
+    self.__job_uuid__ = uuid
+
+  def get_job_uuid(self):
+    return self.__job_uuid__
+
 class UnregisterJobObserverCommand(object):
   def __init__(self, uuid):
     self.__job_uuid__ = uuid
@@ -87,24 +179,81 @@ class UnregisterJobObserverCommand(object):
   def get_job_uuid(self):
     return self.__job_uuid__
 
+class SubscribeCallEventsCommand(object):
+  '''
+  Delivers the events of a call with one of the specified event names to an
+  observer. The command itself is the handle used to unsubscribe later.
+
+  Arguments: observer - The actor that receives the events.
+             uuid     - The Channel-Call-UUID of the call.
+             events   - The event names.
+  '''
+  def __init__(self, *args, **kwargs):
+    self.__observer__ = args[0]
+    self.__uuid__ = args[1]
+    self.__events__ = frozenset(args[2])
+
+  def get_events(self):
+    return self.__events__
+
+  def get_observer(self):
+    return self.__observer__
+
+  def get_uuid(self):
+    return self.__uuid__
+
+class UnsubscribeCallEventsCommand(object):
+  '''
+  Removes a subscription.
+
+  Arguments: subscription - The SubscribeCallEventsCommand to be removed.
+  '''
+  def __init__(self, *args, **kwargs):
+    self.__subscription__ = args[0]
+
+  def get_subscription(self):
+    return self.__subscription__
+
+  def get_uuid(self):
+    return self.__subscription__.get_uuid()
+
 class UnwatchEventCommand(object):
+  '''
+  Removes a watch. The watch is either the WatchEventCommand that created
+  it, passed as the watch keyword argument, or the watch for a name and a
+  pattern or a value that was created by an optional observer.
+  '''
   def __init__(self, *args, **kwargs):
     self.__name__ = kwargs.get('name', None)
+    self.__observer__ = kwargs.get('observer', None)
     self.__pattern__ = kwargs.get('pattern', None)
     self.__value__ = kwargs.get('value', None)
-    if not self.__name__ or self.__pattern__ and self.__value__:
+    self.__watch__ = kwargs.get('watch', None)
+    if not self.__watch__ and \
+       (not self.__name__ or self.__pattern__ and self.__value__):
       raise ValueError('Please specify a name and a pattern or a value but not both.')
 
   def get_name(self):
     return self.__name__
 
+  def get_observer(self):
+    return self.__observer__
+
   def get_pattern(self):
     return self.__pattern__
 
   def get_value(self):
     return self.__value__
 
+  def get_watch(self):
+    return self.__watch__
+
 class WatchEventCommand(UnwatchEventCommand):
+  '''
+  Adds a watch that delivers the events with a header that matches a value
+  or a pattern to an observer. The command itself is the handle used to
+  remove the watch later.
+  '''
   def __init__(self, *args, **kwargs):
     super(WatchEventCommand, self).__init__(*args, **kwargs)
     self.__observer__ = args[0]
@@ -118,7 +267,16 @@ class ApplicationFactory(object):
     self.__classes__ = dict()
     self.__singletons__ = dict()
     self.__init_event__ = InitializeSwitchletEvent(dispatcher)
+    self.__reset_event__ = ResetSwitchletEvent()
     self.__uninit_event__ = UninitializeSwitchletEvent()
+    # Pre-started switchlets waiting to be handed out keyed by name, the
+    # size of every pool and the pooled switchlets handed out keyed by
+    # actor urn. Dispatcher shards share the factory so the pools are
+    # protected by a lock.
+    self.__lock__ = Lock()
+    self.__pools__ = dict()
+    self.__pool_sizes__ = dict()
+    self.__leases__ = dict()
 
   def __contains_name__(self, name):
     return self.__classes__.has_key(name) or self.__singletons__.has_key(name)
@@ -132,17 +290,77 @@ class ApplicationFactory(object):
       module = __import__(path, globals(), locals(), [klass], -1)
       return getattr(module, klass)
 
-  def get_instance(self, name):
+  def __get_queue_depth__(self, instances):
+    depths = [instance.actor_inbox.qsize() for instance in instances]
+    return {
+      'instances': len(depths),
+      'total': sum(depths),
+      'largest': max(depths or [0])
+    }
+
+  def __start_instance__(self, klass):
+    instance = klass().start()
+    instance.tell({'content': self.__init_event__})
+    return instance
+
+  def __stop_pool__(self, name):
+    with self.__lock__:
+      pool = self.__pools__.pop(name, list())
+      self.__pool_sizes__.pop(name, None)
+    for instance in pool:
+      if instance.is_alive():
+        instance.stop(block = False)
+
+  def get_instance(self, name, dispatcher = None):
     klass = self.__classes__.get(name)
     if klass:
-      instance = klass().start()
-      instance.tell({'content': self.__init_event__})
+      if dispatcher:
+        instance = klass().start()
+        instance.tell({'content': InitializeSwitchletEvent(dispatcher)})
+        return instance
+      instance = None
+      with self.__lock__:
+        pool = self.__pools__.get(name)
+        while pool and not instance:
+          instance = pool.pop()
+          if not instance.is_alive():
+            instance = None
+      if not instance:
+        instance = self.__start_instance__(klass)
+      if pool is not None:
+        # Switchlets started when the pool is empty join the pool once
+        # they are released.
+        with self.__lock__:
+          self.__leases__.update({instance.actor_urn: name})
       return instance
     else:
       instance = self.__singletons__.get(name)
       return instance
 
-  def register(self, name, type = 'class'):
+  def get_pool_size(self, name):
+    '''
+    Returns: The number of pre-started switchlets waiting to be handed out.
+
+    Arguments: name - The name of the switchlet.
+    '''
+    with self.__lock__:
+      return len(self.__pools__.get(name, ()))
+
+  def get_queue_depths(self):
+    '''
+    Returns: A dictionary with the number of running instances and the
+             total and largest number of messages waiting in their
+             mailboxes for every registered switchlet.
+    '''
+    gauges = dict()
+    for name, klass in self.__classes__.items():
+      gauges.update({name: self.__get_queue_depth__(
+        ActorRegistry.get_by_class(klass))})
+    for name, singleton in self.__singletons__.items():
+      gauges.update({name: self.__get_queue_depth__([singleton])})
+    return gauges
+
+  def register(self, name, type = 'class', pool_size = 0):
     if self.__contains_name__(name):
       raise ValueError("Names must be unique across classes and singletons.\n\
       %s already exists please choose a different name and try again.",
@@ -150,14 +368,40 @@ class ApplicationFactory(object):
     klass = self.__get_klass__(name)
     if type == 'class':
       self.__classes__.update({name: klass})
+      if pool_size > 0:
+        pool = [self.__start_instance__(klass) for index in range(pool_size)]
+        with self.__lock__:
+          self.__pools__.update({name: pool})
+          self.__pool_sizes__.update({name: pool_size})
     if type == 'singleton':
       singleton = klass.start()
       singleton.tell({'content': self.__init_event__})
       self.__singletons__.update({name: singleton})
 
+  def release(self, instance):
+    '''
+    Hands a switchlet back to its pool once it is done with a call. The
+    switchlet is reset before it can be handed out again unless its pool
+    is full or the switchlet is not pooled in which case it is stopped.
+
+    Arguments: instance - The actor ref for the switchlet.
+    '''
+    with self.__lock__:
+      name = self.__leases__.pop(instance.actor_urn, None)
+      pool = self.__pools__.get(name)
+      if pool is not None and instance.is_alive() and \
+         len(pool) < self.__pool_sizes__.get(name):
+        # The reset is queued before the switchlet can be handed out again.
+        instance.tell({'content': self.__reset_event__})
+        pool.append(instance)
+        return
+    if instance.is_alive():
+      instance.stop(block = False)
+
   def unregister(self, name):
     klass = self.__classes__.get(name)
     if klass:
+      self.__stop_pool__(name)
       del self.__classes__[name]
     else:
       singleton = self.__singletons__.get(name)
@@ -168,29 +412,443 @@ class ApplicationFactory(object):
         del self.__singletons__[name]
 
   def shutdown(self):
+    # Cleanup the pooled switchlets waiting to be handed out.
+    for name in self.__pools__.keys():
+      self.__stop_pool__(name)
     # Cleanup the singletons being managed.
     names = self.__singletons__.keys()
     for name in names:
       self.unregister(name) 
 
+class DispatchRules(object):
+  '''
+  An index of the dispatch rules that is built once at startup. Rules that
+  match a header value are looked up in a dictionary and rules that match
+  a header pattern are compiled ahead of time and grouped by header name.
+  When several rules match an event the one declared first wins.
+  '''
+  def __init__(self, rules):
+    self.__names__ = list()
+    self.__patterns__ = dict()
+    self.__values__ = dict()
+    for order, rule in enumerate(rules):
+      name = rule.get('header_name')
+      target = rule.get('target')
+      if not name in self.__names__:
+        self.__names__.append(name)
+      value = rule.get('header_value')
+      if value:
+        key = (name, value)
+        if not self.__values__.has_key(key):
+          self.__values__.update({key: (order, target)})
+      pattern = rule.get('header_pattern')
+      if pattern:
+        patterns = self.__patterns__.get(name)
+        if patterns is None:
+          patterns = list()
+          self.__patterns__.update({name: patterns})
+        patterns.append((order, re.compile(pattern), target))
+
+  def get_target(self, message):
+    '''
+    Returns: The target of the first rule that matches the message or
+             None if no rule matches.
+
+    Arguments: message - The event to be matched.
+    '''
+    result = None
+    for name in self.__names__:
+      header = message.get_header(name)
+      if not header:
+        continue
+      match = self.__values__.get((name, header))
+      if match and (not result or match[0] < result[0]):
+        result = match
+      for order, pattern, target in self.__patterns__.get(name, ()):
+        if result and result[0] < order:
+          break
+        if pattern.search(header):
+          result = (order, target)
+          break
+    if result:
+      return result[1]
+
+class ExpiryWheel(object):
+  '''
+  A hashed timing wheel that expires keys once their time to live, counted
+  in ticks, has elapsed. Keys are added and removed in constant time and
+  every tick only visits the keys in one bucket.
+
+  Arguments: size - The number of buckets in the wheel.
+  '''
+  def __init__(self, size = 256):
+    self.__buckets__ = [dict() for index in range(size)]
+    self.__locations__ = dict()
+    self.__tick__ = 0
+
+  def __len__(self):
+    return len(self.__locations__)
+
+  def add(self, key, ttl):
+    '''
+    Adds a key or resets the time to live of an existing key.
+
+    Arguments: key - The key to be expired.
+               ttl - The number of ticks before the key expires.
+    '''
+    self.remove(key)
+    ttl = max(1, ttl)
+    size = len(self.__buckets__)
+    index = (self.__tick__ + ttl) % size
+    # The number of times the wheel turns before the key expires.
+    self.__buckets__[index][key] = (ttl - 1) / size
+    self.__locations__[key] = index
+
+  def remove(self, key):
+    '''
+    Returns: True if the key was removed or False if it was never added.
+
+    Arguments: key - The key to be removed.
+    '''
+    index = self.__locations__.pop(key, None)
+    if index is None:
+      return False
+    del self.__buckets__[index][key]
+    return True
+
+  def tick(self):
+    '''
+    Advances the wheel by one tick.
+
+    Returns: The keys that expired.
+    '''
+    self.__tick__ += 1
+    bucket = self.__buckets__[self.__tick__ % len(self.__buckets__)]
+    expired = list()
+    for key, turns in bucket.items():
+      if turns:
+        bucket[key] = turns - 1
+      else:
+        del bucket[key]
+        del self.__locations__[key]
+        expired.append(key)
+    return expired
+
+class ExpiringMap(object):
+  '''
+  A map whose keys are forgotten once their time to live, in seconds, has
+  elapsed. The keys are kept in an ExpiryWheel which is advanced by the
+  seconds elapsed on the monotonic clock every time the map is used.
+
+  Arguments: ttl - The number of seconds a key is kept.
+  '''
+  def __init__(self, ttl):
+    self.__entries__ = dict()
+    self.__expiry__ = ExpiryWheel()
+    self.__ttl__ = ttl
+    self.__now__ = int(monotonic())
+
+  def __len__(self):
+    self.__advance__()
+    return len(self.__entries__)
+
+  def __advance__(self):
+    now = int(monotonic())
+    elapsed = now - self.__now__
+    self.__now__ = now
+    if elapsed >= self.__ttl__:
+      # Every key has expired.
+      if self.__entries__:
+        self.clear()
+      return
+    for tick in xrange(elapsed):
+      for key in self.__expiry__.tick():
+        del self.__entries__[key]
+
+  def clear(self):
+    self.__entries__.clear()
+    self.__expiry__ = ExpiryWheel()
+
+  def get(self, key):
+    self.__advance__()
+    return self.__entries__.get(key)
+
+  def pop(self, key, default = None):
+    '''
+    Returns: The value of the key or the default if the key is not in the
+             map.
+    '''
+    self.__advance__()
+    self.__expiry__.remove(key)
+    return self.__entries__.pop(key, default)
+
+  def put(self, key, value):
+    '''
+    Adds a key or replaces the value of a key and resets its time to live.
+    '''
+    self.__advance__()
+    self.__entries__[key] = value
+    self.__expiry__.add(key, self.__ttl__)
+
 class DispatcherProxy(IEventSocketClientObserver):
-  def __init__(self, apps, dispatcher, events):
+  '''
+  Forwards the messages received by an event socket client to a dispatcher.
+  When the dispatcher mailbox reaches the high watermark the client stops
+  reading from FreeSWITCH until the mailbox drains to the low watermark.
+  '''
+  POLL_INTERVAL = 0.01          # Check a full mailbox every 10 milliseconds.
+
+  def __init__(self, apps, dispatcher, events, high_watermark = None,
+               low_watermark = None):
+    self.__logger__ = logging.getLogger('freepy.lib.server.dispatcherproxy')
     self.__apps__ = apps
     self.__dispatcher__ = dispatcher
     self.__events__ = events
+    self.__high_watermark__ = high_watermark
+    self.__low_watermark__ = low_watermark
+    self.__client__ = None
+    self.__paused__ = False
+
+  def __check_mailbox__(self):
+    if not self.__high_watermark__ or self.__paused__:
+      return
+    depth = self.get_mailbox_depth()
+    if depth >= self.__high_watermark__:
+      self.__logger__.warning('The dispatcher has %i messages waiting. \
+      Reading from FreeSWITCH will resume once the dispatcher catches up.',
+        depth)
+      self.__paused__ = True
+      self.__client__.pause()
+      reactor.callLater(DispatcherProxy.POLL_INTERVAL, self.__poll_mailbox__)
+
+  def __poll_mailbox__(self):
+    if not self.__paused__:
+      return
+    if self.get_mailbox_depth() <= self.__low_watermark__:
+      self.__paused__ = False
+      self.__client__.resume()
+    else:
+      reactor.callLater(DispatcherProxy.POLL_INTERVAL, self.__poll_mailbox__)
+
+  def get_mailbox_depth(self):
+    return self.__dispatcher__.get_mailbox_depth()
+
+  def is_paused(self):
+    return self.__paused__
 
   def on_event(self, event):
     self.__dispatcher__.tell({'content': event})
+    self.__check_mailbox__()
+
+  def on_events(self, events):
+    if len(events) == 1:
+      self.__dispatcher__.tell({'content': events[0]})
+    else:
+      self.__dispatcher__.tell({'content': EventBatch(events)})
+    self.__check_mailbox__()
 
   def on_start(self, client):
+    self.__client__ = client
     event = InitializeDispatcherEvent(self.__apps__, client, self.__events__)
     self.__dispatcher__.tell({'content': event})
 
   def on_stop(self):
+    self.__client__ = None
+    self.__paused__ = False
     event = KillDispatcherEvent()
     self.__dispatcher__.tell({'content': event})
 
-class Dispatcher(FiniteStateMachine, ThreadingActor):
+class NodeStatus(object):
+  '''
+  Health and load counters for a FreeSWITCH node. The counters are updated
+  by the dispatchers connected to the node and may be read from any thread.
+
+  Arguments: name - The name of the FreeSWITCH node.
+  '''
+  # The HEARTBEAT headers used to measure the load on a node.
+  HEARTBEAT_HEADERS = [
+    'Idle-CPU',
+    'Max-Sessions',
+    'Session-Count',
+    'Session-Per-Sec',
+    'Session-Peak-Max',
+    'Up-Time'
+  ]
+
+  def __init__(self, name):
+    self.__name__ = name
+    self.__lock__ = Lock()
+    self.__commands__ = 0
+    self.__connections__ = 0
+    self.__events__ = 0
+    self.__failures__ = 0
+    self.__heartbeat__ = dict()
+    self.__last_heartbeat__ = None
+    self.__expired_observers__ = 0
+    self.__expired_transactions__ = 0
+    # The size of the transaction and job observer tables of every
+    # dispatcher keyed by the dispatcher's urn.
+    self.__tables__ = dict()
+
+  def get_commands(self):
+    return self.__commands__
+
+  def get_connections(self):
+    return self.__connections__
+
+  def get_events(self):
+    return self.__events__
+
+  def get_expired_observers(self):
+    return self.__expired_observers__
+
+  def get_expired_transactions(self):
+    return self.__expired_transactions__
+
+  def get_failures(self):
+    return self.__failures__
+
+  def get_heartbeat(self):
+    return self.__heartbeat__
+
+  def get_last_heartbeat(self):
+    return self.__last_heartbeat__
+
+  def get_load(self):
+    '''
+    Returns: The ratio of active sessions to the maximum number of sessions
+             reported by the last heartbeat or None if it is unknown.
+    '''
+    try:
+      count = int(self.__heartbeat__.get('Session-Count'))
+      maximum = int(self.__heartbeat__.get('Max-Sessions'))
+      return float(count) / maximum
+    except (TypeError, ValueError, ZeroDivisionError):
+      return None
+
+  def get_name(self):
+    return self.__name__
+
+  def get_observers(self):
+    '''
+    Returns: The number of job observers registered with the dispatchers.
+    '''
+    with self.__lock__:
+      return sum([observers for transactions, observers
+        in self.__tables__.values()])
+
+  def get_transactions(self):
+    '''
+    Returns: The number of commands waiting for a reply.
+    '''
+    with self.__lock__:
+      return sum([transactions for transactions, observers
+        in self.__tables__.values()])
+
+  def is_healthy(self):
+    return self.__connections__ > 0
+
+  def record_command(self):
+    with self.__lock__:
+      self.__commands__ += 1
+
+  def record_connect(self):
+    with self.__lock__:
+      self.__connections__ += 1
+
+  def record_disconnect(self):
+    with self.__lock__:
+      self.__connections__ -= 1
+
+  def record_events(self, count):
+    with self.__lock__:
+      self.__events__ += count
+
+  def record_expired(self, transactions, observers):
+    with self.__lock__:
+      self.__expired_transactions__ += transactions
+      self.__expired_observers__ += observers
+
+  def record_failure(self):
+    with self.__lock__:
+      self.__failures__ += 1
+
+  def record_heartbeat(self, event):
+    heartbeat = dict()
+    for name in NodeStatus.HEARTBEAT_HEADERS:
+      heartbeat[name] = event.get_header(name)
+    self.__heartbeat__ = heartbeat
+    self.__last_heartbeat__ = time.time()
+
+  def record_tables(self, dispatcher, transactions, observers):
+    with self.__lock__:
+      if transactions or observers:
+        self.__tables__[dispatcher] = (transactions, observers)
+      else:
+        self.__tables__.pop(dispatcher, None)
+
+class DispatcherPool(object):
+  '''
+  Spreads calls across several dispatchers, each one with its own event
+  socket connection, and routes the messages sent by switchlets to the
+  dispatcher that owns the call or job.
+
+  Arguments: dispatchers - The dispatchers ordered by shard.
+  '''
+  def __init__(self, dispatchers):
+    self.__dispatchers__ = dispatchers
+
+  def __route__(self, uuid):
+    shard = shard_for_uuid(uuid, len(self.__dispatchers__))
+    return self.__dispatchers__[shard]
+
+  def get_dispatchers(self):
+    return self.__dispatchers__
+
+  def get_mailbox_depth(self):
+    '''
+    Returns: The number of messages waiting for the busiest dispatcher.
+    '''
+    return max([dispatcher.get_mailbox_depth()
+      for dispatcher in self.__dispatchers__])
+
+  def is_alive(self):
+    for dispatcher in self.__dispatchers__:
+      if not dispatcher.is_alive():
+        return False
+    return True
+
+  def tell(self, message):
+    content = message.get('content')
+    if isinstance(content, UUIDCommand):
+      self.__route__(content.get_uuid()).tell(message)
+    elif isinstance(content, BackgroundCommand) or \
+         isinstance(content, RegisterJobObserverCommand) or \
+         isinstance(content, UnregisterJobObserverCommand):
+      self.__route__(content.get_job_uuid()).tell(message)
+    elif isinstance(content, SubscribeCallEventsCommand) or \
+         isinstance(content, UnsubscribeCallEventsCommand):
+      self.__route__(content.get_uuid()).tell(message)
+    elif isinstance(content, UnwatchEventCommand):
+      # Watches apply to the events received by every dispatcher.
+      for dispatcher in self.__dispatchers__:
+        dispatcher.tell(message)
+    else:
+      self.__dispatchers__[0].tell(message)
+
+class DispatcherRef(ActorRef):
+  '''
+  The actor reference of a dispatcher.
+  '''
+  def get_mailbox_depth(self):
+    '''
+    Returns: The number of messages waiting for the dispatcher.
+    '''
+    return self.actor_inbox.qsize()
+
+class Dispatcher(CompiledFiniteStateMachine, RuntimeActor):
+  EXPIRY_INTERVAL = 1000        # Expire transactions every second.
+
   initial_state = 'not ready'
 
   transitions = [
@@ -204,20 +862,86 @@ class Dispatcher(FiniteStateMachine, ThreadingActor):
   ]
 
   def __init__(self, *args, **kwargs):
+    # The shard of the calls handled by this dispatcher when the calls
+    # are spread across several event socket connections.
+    self.__shard__ = kwargs.pop('shard', 0)
+    self.__shards__ = kwargs.pop('shards', 1)
+    # The FreeSWITCH node this dispatcher is connected to.
+    self.__node__ = kwargs.pop('node', freeswitch_hosts[0])
+    self.__status__ = kwargs.pop('status', None)
+    if not self.__status__:
+      self.__status__ = NodeStatus(self.__node__.get('name'))
+    # The dispatcher shards that share this dispatcher's connection.
+    self.__peers__ = kwargs.pop('peers', list())
     super(Dispatcher, self).__init__(*args, **kwargs)
+    self.actor_ref = DispatcherRef(self)
     self.__logger__ = logging.getLogger('freepy.lib.server.dispatcher')
     self.__observers__ = dict()
     self.__transactions__ = dict()
-    self.__watches__ = list()
+    # Expires the transactions and job observers that were left behind.
+    self.__expiry__ = ExpiryWheel()
+    self.__watches__ = WatchRegistry()
+    # The observers subscribed to the events of a call keyed by the
+    # call's uuid and the event name.
+    self.__subscriptions__ = dict()
+    self.__rules__ = DispatchRules(dispatch_rules)
+    # Reference counts for the event filters requested by the dispatch
+    # rules and the watches. Filters are only sent to FreeSWITCH once
+    # the event subscription has been made.
+    self.__filters__ = dict()
+    self.__filtering__ = False
+    if self.__shards__ > 1:
+      # Every connection receives the calls and jobs in its shard while
+      # the first connection also receives the events without a call.
+      digits = shard_digits(self.__shard__, self.__shards__)
+      value = '/^[%s%s]/' % (digits, digits.upper().translate(None, '0123456789'))
+      self.__add_filter__('Channel-Call-UUID', value)
+      self.__add_filter__('Job-UUID', value)
+    else:
+      self.__add_filter__('Event-Name', 'BACKGROUND_JOB')
+    if self.__shard__ == 0:
+      # The node status measures the load on the node using the HEARTBEAT
+      # events even when no switchlet handles them.
+      self.__add_filter__('Event-Name', 'HEARTBEAT')
+      for rule in dispatch_rules:
+        self.__add_filter__(rule.get('header_name'),
+          self.__filter_value__(rule.get('header_value'),
+            rule.get('header_pattern')))
+
+  def __add_filter__(self, name, value):
+    key = (name, value)
+    count = self.__filters__.get(key, 0)
+    self.__filters__[key] = count + 1
+    if count == 0 and self.__filtering__:
+      self.__client__.send(FilterCommand(name, value))
+
+  def __add_subscription__(self, subscription):
+    uuid = subscription.get_uuid()
+    for name in subscription.get_events():
+      observers = self.__subscriptions__.get((uuid, name))
+      if observers is None:
+        observers = OrderedDict()
+        self.__subscriptions__.update({(uuid, name): observers})
+      observers[subscription] = None
+    # A sharded dispatcher already receives every event for its calls.
+    if self.__shards__ == 1:
+      self.__add_filter__('Channel-Call-UUID', uuid)
+
+  def __add_watch__(self, watch):
+    self.__watches__.add(watch)
+    if self.__shard__ == 0:
+      self.__add_filter__(watch.get_name(),
+        self.__filter_value__(watch.get_value(), watch.get_pattern()))
 
   @Action(state = 'authenticating')
   def __authenticate__(self, message):
-    password = freeswitch_host.get('password')
+    password = self.__node__.get('password')
     auth_command = AuthCommand(password)
     self.__client__.send(auth_command)
 
   @Action(state = 'done')
   def __cleanup__(self, message):
+    self.__stop_expiry__()
     self.__apps__.shutdown()
     self.stop()
 
@@ -229,23 +953,17 @@ class Dispatcher(FiniteStateMachine, ThreadingActor):
       elif isinstance(message, ServiceRequest):
         self.__dispatch_service_request__(message)
       elif isinstance(message, RegisterJobObserverCommand):
-        observer = message.get_observer()
-        uuid = message.get_job_uuid()
-        if observer and uuid:
-          self.__observers__.update({uuid: observer})
+        self.__register_job_observer__(message)
       elif isinstance(message, UnregisterJobObserverCommand):
-        uuid = message.get_job_uuid()
-        if self.__observers__.has_key(uuid):
-          del self.__observers__[uuid]
+        self.__unregister_job_observer__(message)
       else:
-        headers = message.get_headers()
-        content_type = headers.get('Content-Type')
+        content_type = message.get_header('Content-Type')
         if content_type == 'command/reply':
-          uuid = headers.get('Job-UUID')
+          uuid = message.get_header('Job-UUID')
           if uuid:
             self.__dispatch_response__(uuid, message)
-        elif content_type == 'text/event-plain':
-          uuid = headers.get('Job-UUID')
+        elif content_type in EVENT_CONTENT_TYPES:
+          uuid = message.get_header('Job-UUID')
           if uuid:
             self.__dispatch_observer_event__(uuid, message)
           else:
@@ -256,61 +974,58 @@ class Dispatcher(FiniteStateMachine, ThreadingActor):
     uuid = message.get_job_uuid()
     sender = message.get_sender()
     self.__transactions__.update({uuid: sender})
+    self.__expiry__.add(('transaction', uuid), dispatcher_transaction_ttl)
     # Send the command.
     self.__client__.send(message)
+    self.__status__.record_command()
 
   def __dispatch_incoming__(self, message):
-    if not self.__dispatch_incoming_using_dispatch_rules__(message) and \
-       not self.__dispatch_incoming_using_watches__(message):
+    if not self.__dispatch_incoming_using_subscriptions__(message) and \
+       not self.__dispatch_incoming_using_dispatch_rules__(message) and \
+       not self.__dispatch_incoming_using_watches__(message) and \
+       self.__logger__.isEnabledFor(logging.INFO):
       self.__logger__.info('No route was defined for the following message.\n \
       %s\n%s', str(message.get_headers()), str(message.get_body()))
 
   def __dispatch_incoming_using_dispatch_rules__(self, message):
-    headers = message.get_headers()
     # Dispatch based on the pre-defined dispatch rules.
-    for rule in dispatch_rules:
-      target = rule.get('target')
-      name = rule.get('header_name')
-      header = headers.get(name)
-      if not header:
-        continue
-      value = rule.get('header_value')
-      if value and header == value:
-        self.__apps__.get_instance(target).tell({'content': message})
-        return True
-      pattern = rule.get('header_pattern')
-      if pattern:
-        match = re.search(pattern, header)
-        if match:
-          self.__apps__.get_intance(target).tell({'content': message})
-          return True
+    target = self.__rules__.get_target(message)
+    if target:
+      self.__apps__.get_instance(target).tell({'content': message})
+      return True
     return False
 
+  def __dispatch_incoming_using_subscriptions__(self, message):
+    # Dispatch based on the call event subscriptions defined by switchlets.
+    uuid = message.get_header('Channel-Call-UUID')
+    if not uuid:
+      return False
+    observers = self.__subscriptions__.get((uuid,
+      message.get_header('Event-Name')))
+    if not observers:
+      return False
+    dispatched = False
+    for subscription in observers.keys():
+      observer = subscription.get_observer()
+      if observer.is_alive():
+        observer.tell({'content': message})
+        dispatched = True
+      else:
+        self.__remove_subscription__(subscription)
+    return dispatched
+
   def __dispatch_incoming_using_watches__(self, message):
-    headers = message.get_headers()
     # Dispatch based on runtime watches defined by switchlets.
-    result = None
-    for watch in self.__watches__:
-      name = watch.get_name()
-      header = headers.get(name)
-      if not header:
-        continue
-      value = watch.get_value()
-      if value and header == value:
-        result = watch
-      pattern = watch.get_pattern()
-      if pattern:
-        match = re.search(pattern, header)
-        if match:
-          result = watch
-    if result:
-      observer = result.get_observer()
+    dispatched = False
+    for watch in self.__watches__.get_matches(message):
+      observer = watch.get_observer()
       if observer.is_alive():
         observer.tell({'content': message})
-        return True
+        dispatched = True
       else:
-        self.__watches__.remove(result)
-    return False
+        while self.__watches__.contains(watch):
+          self.__remove_watch__(watch)
+    return dispatched
 
   def __dispatch_observer_event__(self, uuid, message):
     recipient = self.__observers__.get(uuid)
@@ -319,11 +1034,13 @@ class Dispatcher(FiniteStateMachine, ThreadingActor):
         recipient.tell({'content': message})
       else:
         del self.__observers__[uuid]
+        self.__expiry__.remove(('observer', uuid))
 
   def __dispatch_response__(self, uuid, message):
     recipient = self.__transactions__.get(uuid)
     if recipient:
       del self.__transactions__[uuid]
+      self.__expiry__.remove(('transaction', uuid))
       if recipient.is_alive():
         recipient.tell({'content': message})
 
@@ -334,14 +1051,37 @@ class Dispatcher(FiniteStateMachine, ThreadingActor):
       service = self.__apps__.get_instance(target)
       service.tell({ 'content': message })
 
+  def __expire__(self, kind, uuid):
+    if kind == 'transaction':
+      recipient = self.__transactions__.pop(uuid, None)
+    else:
+      recipient = self.__observers__.get(uuid)
+      self.__unregister_job_observer__(UnregisterJobObserverCommand(uuid))
+    if self.__logger__.isEnabledFor(logging.DEBUG):
+      self.__logger__.debug('The %s for job %s expired.', kind, uuid)
+    if dispatcher_expiry_notifications and recipient and recipient.is_alive():
+      recipient.tell({'content': JobTimeoutEvent(uuid)})
+
+  def __filter_value__(self, value, pattern):
+    # FreeSWITCH treats filter values enclosed in slashes as regular expressions.
+    if value:
+      return value
+    else:
+      return '/%s/' % pattern
+
   @Action(state = 'initializing')
   def __initialize__(self, message):
     if 'BACKGROUND_JOB' not in dispatch_events:
       # The BACKGROUND_JOB events must be added at the front of the
       # list in case the list ends with CUSTOM events.
       dispatch_events.insert(0, 'BACKGROUND_JOB')
-    events_command = EventsCommand(dispatch_events)
+    events_command = EventsCommand(dispatch_events, format = event_socket_format)
     self.__client__.send(events_command)
+    # Only ask FreeSWITCH for the events we know how to route.
+    if event_socket_filters or self.__shards__ > 1:
+      self.__filtering__ = True
+      for name, value in self.__filters__.keys():
+        self.__client__.send(FilterCommand(name, value))
 
   def __on_auth__(self, message):
     if self.state() == 'not ready':
@@ -357,54 +1097,167 @@ class Dispatcher(FiniteStateMachine, ThreadingActor):
       if reply == '+OK accepted':
         self.transition(to = 'initializing', event = message)
       elif reply == '-ERR invalid':
+        self.__status__.record_failure()
         self.transition(to = 'failed authentication', event = message)
     if self.state() == 'initializing':
-      if reply == '+OK event listener enabled plain':
+      if reply == '+OK event listener enabled %s' % event_socket_format:
         self.transition(to = 'dispatching')
+        self.__start_expiry__()
+        for peer in self.__peers__:
+          peer.tell({'content': DispatcherReadyEvent()})
       elif reply == '-ERR no keywords supplied':
+        self.__status__.record_failure()
         self.transition(to = 'failed initialization', event = message)
     if self.state() == 'dispatching':
       self.transition(to = 'dispatching', event = message)
 
   def __on_event__(self, message):
-    if self.state() == 'dispatching':
+    if self.state() == 'dispatching' and self.__owns__(message):
+      if message.get_header('Event-Name') == 'HEARTBEAT':
+        self.__status__.record_heartbeat(message)
       self.transition(to = 'dispatching', event = message)
 
   def __on_init__(self, message):
     self.__apps__ = message.get_apps()
     self.__client__ = message.get_client()
     self.__events__ = message.get_events()
+    self.__status__.record_connect()
 
   def __on_kill__(self, message):
+    self.__status__.record_disconnect()
     if self.state() == 'dispatching':
       self.transition(to = 'done', event = message)
 
+  # Filters requested by worker processes are not handled as a state change
+  # because they share the reference counts of this dispatcher's filters.
+  def __on_filter__(self, message):
+    if isinstance(message, FilterDeleteCommand):
+      self.__remove_filter__(message.get_name(), message.get_value())
+    else:
+      self.__add_filter__(message.get_name(), message.get_value())
+
   def __on_observer__(self, message):
     if self.state() == 'dispatching':
       self.transition(to = 'dispatching', event = message)
 
+  def __on_socket_event__(self, message):
+    content_type = message.get_header('Content-Type')
+    if content_type == 'auth/request':
+      self.__on_auth__(message)
+    elif content_type == 'command/reply':
+      self.__on_command_reply__(message)
+    elif content_type in EVENT_CONTENT_TYPES:
+      self.__on_event__(message)
+
   def __on_service_request__(self, message):
     if self.state() == 'dispatching':
       self.transition(to = 'dispatching', event = message)
 
+  # Switchlets are released by the factory regardless of the dispatcher's
+  # state so they are not left behind while the dispatcher reconnects.
+  def __on_release__(self, message):
+    self.__apps__.release(message.get_switchlet())
+
+  # Subscriptions are not handled as a state change because switchlets
+  # may subscribe before the dispatcher's FSM is ready.
+  def __on_subscription__(self, message):
+    if isinstance(message, SubscribeCallEventsCommand):
+      self.__add_subscription__(message)
+    elif isinstance(message, UnsubscribeCallEventsCommand):
+      self.__remove_subscription__(message.get_subscription())
+
+  # The expiry timer keeps running regardless of the dispatcher's state.
+  def __on_timeout__(self, message):
+    expired = {'transaction': 0, 'observer': 0}
+    for kind, uuid in self.__expiry__.tick():
+      self.__expire__(kind, uuid)
+      expired[kind] += 1
+    if expired.get('transaction') or expired.get('observer'):
+      self.__status__.record_expired(expired.get('transaction'),
+        expired.get('observer'))
+    self.__status__.record_tables(self.actor_urn, len(self.__transactions__),
+      len(self.__observers__))
+
   # Watches are not handled as a state change because singleton switchlets
   # may add watches during initialization at which point the dispatcher's
   # FSM is still not ready.
   def __on_watch__(self, message):
     if isinstance(message, WatchEventCommand):
-      self.__watches__.append(message)
+      self.__add_watch__(message)
     elif isinstance(message, UnwatchEventCommand):
-      name = message.get_name()
-      value = message.get_value()
-      if not value:
-        value = message.get_pattern()
-      match = None
-      for watch in self.__watches__:
-        if name == watch.get_name() and value == watch.get_value() or \
-           value == watch.get_pattern:
-          match = watch
-      if match:
-        self.__watches__.remove(match)
+      watch = message.get_watch()
+      if not watch:
+        watch = self.__watches__.find(message.get_name(), message.get_value(),
+          message.get_pattern(), message.get_observer())
+      if watch:
+        self.__remove_watch__(watch)
+
+  def __register_job_observer__(self, message):
+    observer = message.get_observer()
+    uuid = message.get_job_uuid()
+    if observer and uuid:
+      self.__observers__.update({uuid: observer})
+      self.__expiry__.add(('observer', uuid), dispatcher_observer_ttl)
+
+  def __remove_filter__(self, name, value):
+    key = (name, value)
+    count = self.__filters__.get(key)
+    if not count:
+      return
+    if count == 1:
+      del self.__filters__[key]
+      if self.__filtering__:
+        self.__client__.send(FilterDeleteCommand(name, value))
+    else:
+      self.__filters__[key] = count - 1
+
+  def __remove_subscription__(self, subscription):
+    uuid = subscription.get_uuid()
+    removed = False
+    for name in subscription.get_events():
+      observers = self.__subscriptions__.get((uuid, name))
+      if observers and observers.has_key(subscription):
+        del observers[subscription]
+        removed = True
+        if not observers:
+          del self.__subscriptions__[(uuid, name)]
+    if removed and self.__shards__ == 1:
+      self.__remove_filter__('Channel-Call-UUID', uuid)
+
+  def __remove_watch__(self, watch):
+    if not self.__watches__.remove(watch):
+      return
+    if self.__shard__ == 0:
+      self.__remove_filter__(watch.get_name(),
+        self.__filter_value__(watch.get_value(), watch.get_pattern()))
+
+  def __owns__(self, message):
+    # The first connection also receives events owned by other shards
+    # because of the filters used to route events without a call.
+    if self.__shards__ == 1:
+      return True
+    uuid = message.get_header('Job-UUID')
+    if not uuid:
+      uuid = message.get_header('Channel-Call-UUID')
+    if not uuid:
+      return self.__shard__ == 0
+    return shard_for_uuid(uuid, self.__shards__) == self.__shard__
+
+  def __start_expiry__(self):
+    if self.__events__:
+      self.__dispatch_service_request__(ReceiveTimeoutCommand(self.actor_ref,
+        Dispatcher.EXPIRY_INTERVAL, recurring = True))
+
+  def __stop_expiry__(self):
+    if self.__events__:
+      self.__dispatch_service_request__(StopTimeoutCommand(self.actor_ref))
+    self.__status__.record_tables(self.actor_urn, 0, 0)
+
+  def __unregister_job_observer__(self, message):
+    uuid = message.get_job_uuid()
+    if self.__observers__.has_key(uuid):
+      del self.__observers__[uuid]
+    self.__expiry__.remove(('observer', uuid))
 
   def on_failure(self, exception_type, exception_value, traceback):
     self.__logger__.error(exception_value)
@@ -417,13 +1270,12 @@ class Dispatcher(FiniteStateMachine, ThreadingActor):
       return
     # Handle the message.
     if isinstance(message, Event):
-      content_type = message.get_header('Content-Type')
-      if content_type == 'auth/request':
-        self.__on_auth__(message)
-      elif content_type == 'command/reply':
-        self.__on_command_reply__(message)
-      elif content_type == 'text/event-plain':
-        self.__on_event__(message)
+      self.__status__.record_events(1)
+      self.__on_socket_event__(message)
+    elif isinstance(message, EventBatch):
+      self.__status__.record_events(len(message.get_events()))
+      for event in message.get_events():
+        self.__on_socket_event__(event)
     elif isinstance(message, BackgroundCommand):
       self.__on_command__(message)
     elif isinstance(message, ServiceRequest):
@@ -436,10 +1288,772 @@ class Dispatcher(FiniteStateMachine, ThreadingActor):
       self.__on_init__(message)
     elif isinstance(message, KillDispatcherEvent):
       self.__on_kill__(message)
+    elif isinstance(message, TimeoutEvent):
+      self.__on_timeout__(message)
+    elif isinstance(message, FilterCommand):
+      self.__on_filter__(message)
+    elif isinstance(message, SubscribeCallEventsCommand):
+      self.__on_subscription__(message)
+    elif isinstance(message, UnsubscribeCallEventsCommand):
+      self.__on_subscription__(message)
     elif isinstance(message, UnwatchEventCommand):
       self.__on_watch__(message)
     elif isinstance(message, WatchEventCommand):
       self.__on_watch__(message)
+    elif isinstance(message, ReleaseSwitchletCommand):
+      self.__on_release__(message)
+
+class DispatcherShard(Dispatcher):
+  '''
+  A dispatcher that shares the event socket connection of another
+  dispatcher. The dispatcher that owns the connection authenticates,
+  subscribes to events and manages the filters for the dispatch rules and
+  watches while this dispatcher starts dispatching once it is told the
+  connection is ready.
+  '''
+  transitions = Dispatcher.transitions + [('not ready', 'dispatching')]
+  # When False the dispatcher that owns the connection adds the filters for
+  # the watches.
+  owns_filters = False
+
+  def __init__(self, *args, **kwargs):
+    super(DispatcherShard, self).__init__(*args, **kwargs)
+    self.__logger__ = logging.getLogger('freepy.lib.server.dispatchershard')
+    # Only the filters for this shard's subscriptions are kept.
+    self.__filters__ = dict()
+    # The events received before this dispatcher was told the connection
+    # is ready. The owner may route events to this dispatcher in the same
+    # read as the reply that makes the connection ready.
+    self.__pending__ = list()
+
+  def __add_watch__(self, watch):
+    if self.owns_filters:
+      super(DispatcherShard, self).__add_watch__(watch)
+    else:
+      self.__watches__.add(watch)
+
+  @Action(state = 'done')
+  def __cleanup__(self, message):
+    # The switchlets are shutdown by the dispatcher that owns the connection.
+    self.__stop_expiry__()
+    self.stop()
+
+  def __on_event__(self, message):
+    if self.state() == 'not ready':
+      self.__pending__.append(message)
+    else:
+      super(DispatcherShard, self).__on_event__(message)
+
+  def __on_init__(self, message):
+    self.__apps__ = message.get_apps()
+    self.__client__ = message.get_client()
+    self.__events__ = message.get_events()
+
+  def __on_kill__(self, message):
+    self.__pending__ = list()
+    if self.state() == 'dispatching':
+      self.transition(to = 'done', event = message)
+    elif not self.state() == 'done':
+      self.stop()
+
+  def __on_ready__(self, message):
+    if self.state() == 'not ready':
+      # Filter just like the dispatcher that owns the connection or the
+      # filters of a single call would hide the events of every other call.
+      if event_socket_filters or self.__shards__ > 1:
+        self.__filtering__ = True
+        for name, value in self.__filters__.keys():
+          self.__client__.send(FilterCommand(name, value))
+      self.transition(to = 'dispatching')
+      self.__start_expiry__()
+      pending = self.__pending__
+      self.__pending__ = list()
+      for event in pending:
+        self.__on_event__(event)
+
+  def __remove_watch__(self, watch):
+    if self.owns_filters:
+      super(DispatcherShard, self).__remove_watch__(watch)
+    else:
+      self.__watches__.remove(watch)
+
+  def on_receive(self, message):
+    if isinstance(message.get('content'), DispatcherReadyEvent):
+      self.__on_ready__(message.get('content'))
+    else:
+      super(DispatcherShard, self).on_receive(message)
+
+class WorkerDispatcher(DispatcherShard):
+  '''
+  A dispatcher running in a worker process. The worker front owns the event
+  socket connection and merges the filters requested by every worker, so
+  unlike other dispatcher shards this dispatcher asks for watch filters.
+  '''
+  owns_filters = True
+
+  def __init__(self, *args, **kwargs):
+    super(WorkerDispatcher, self).__init__(*args, **kwargs)
+    self.__logger__ = logging.getLogger('freepy.lib.server.workerdispatcher')
+
+class OutboundDispatcher(Dispatcher):
+  '''
+  A dispatcher bound to a single call that connected to freepy using the
+  outbound event socket. FreeSWITCH does not ask outbound connections to
+  authenticate so the authenticating state is used to request the channel
+  data instead. Once subscribed, only the events for the call and the jobs
+  it started are delivered so every incoming event is routed to the call's
+  switchlet without consulting the dispatch rules.
+
+  Arguments: target - The name of the switchlet that handles the call.
+  '''
+  def __init__(self, *args, **kwargs):
+    self.__target__ = kwargs.pop('target')
+    super(OutboundDispatcher, self).__init__(*args, **kwargs)
+    self.__logger__ = logging.getLogger('freepy.lib.server.outbounddispatcher')
+    self.__channel__ = None
+    self.__switchlet__ = None
+    # The events for the call are selected using filters added once
+    # the channel data has been received.
+    self.__filters__ = dict()
+
+  def __add_watch__(self, watch):
+    # The events are already limited to the call so watches need no filters.
+    self.__watches__.add(watch)
+
+  @Action(state = 'authenticating')
+  def __authenticate__(self, message):
+    self.__client__.send(ConnectCommand())
+
+  @Action(state = 'done')
+  def __cleanup__(self, message):
+    self.__stop_expiry__()
+    if self.__switchlet__ and self.__switchlet__.is_alive():
+      self.__switchlet__.stop()
+    self.stop()
+
+  def __dispatch_incoming__(self, message):
+    if self.__dispatch_incoming_using_subscriptions__(message) or \
+       self.__dispatch_incoming_using_watches__(message):
+      return
+    if self.__switchlet__ and self.__switchlet__.is_alive():
+      self.__switchlet__.tell({'content': message})
+
+  @Action(state = 'initializing')
+  def __initialize__(self, message):
+    self.__channel__ = message
+    self.__add_filter__('Unique-ID', message.get_header('Unique-ID'))
+    super(OutboundDispatcher, self).__initialize__(message)
+    # The filters are required to keep the events of other calls out.
+    if not self.__filtering__:
+      self.__filtering__ = True
+      for name, value in self.__filters__.keys():
+        self.__client__.send(FilterCommand(name, value))
+
+  def __on_command_reply__(self, message):
+    if self.state() == 'authenticating':
+      if message.get_header('Unique-ID'):
+        self.transition(to = 'initializing', event = message)
+      else:
+        self.__status__.record_failure()
+        self.transition(to = 'failed authentication', event = message)
+    elif self.state() == 'initializing':
+      super(OutboundDispatcher, self).__on_command_reply__(message)
+      if self.state() == 'dispatching':
+        self.__start_switchlet__()
+    else:
+      super(OutboundDispatcher, self).__on_command_reply__(message)
+
+  def __on_init__(self, message):
+    super(OutboundDispatcher, self).__on_init__(message)
+    self.transition(to = 'authenticating', event = message)
+
+  def __on_kill__(self, message):
+    super(OutboundDispatcher, self).__on_kill__(message)
+    # The call may hang up before the dispatcher is ready.
+    if not self.state() == 'done':
+      self.stop()
+
+  def __register_job_observer__(self, message):
+    super(OutboundDispatcher, self).__register_job_observer__(message)
+    self.__add_filter__('Job-UUID', message.get_job_uuid())
+
+  def __remove_watch__(self, watch):
+    self.__watches__.remove(watch)
+
+  def __start_switchlet__(self):
+    self.__switchlet__ = self.__apps__.get_instance(self.__target__,
+      dispatcher = self.actor_ref)
+    self.__switchlet__.tell({'content': self.__channel__})
+
+  def __unregister_job_observer__(self, message):
+    super(OutboundDispatcher, self).__unregister_job_observer__(message)
+    self.__remove_filter__('Job-UUID', message.get_job_uuid())
+
+class ShardedDispatcher(object):
+  '''
+  Spreads the events received on one event socket connection across several
+  dispatcher threads. Events are hashed by their Job-UUID, Channel-Call-UUID
+  or Unique-ID so all the events for a call are handled in order by the same
+  dispatcher. The reply to a command is always delivered to the dispatcher
+  that sent the command.
+
+  Arguments: dispatchers - The dispatchers where the first one owns the
+                           connection.
+             digit       - The position of the UUID digit that picks the
+                           dispatcher.
+  '''
+  def __init__(self, dispatchers, digit = -1):
+    self.__dispatchers__ = dispatchers
+    self.__digit__ = digit
+    self.__lock__ = Lock()
+    # The dispatchers waiting for a command reply keyed by job uuid. The
+    # dispatchers are forgotten if the reply never arrives.
+    self.__senders__ = ExpiringMap(dispatcher_transaction_ttl)
+
+  def __broadcast__(self, message):
+    for dispatcher in self.__dispatchers__:
+      dispatcher.tell(message)
+
+  def __route__(self, uuid):
+    shard = shard_for_uuid(uuid, len(self.__dispatchers__), self.__digit__)
+    return self.__dispatchers__[shard]
+
+  def __route_event__(self, event):
+    uuid = event.get_header('Job-UUID')
+    if uuid:
+      if event.get_header('Content-Type') == 'command/reply':
+        with self.__lock__:
+          sender = self.__senders__.pop(uuid, None)
+        if sender:
+          return sender
+      return self.__route__(uuid)
+    uuid = event.get_header('Channel-Call-UUID')
+    if not uuid:
+      uuid = event.get_header('Unique-ID')
+    if uuid:
+      return self.__route__(uuid)
+    # Events without a call or job are handled by the connection owner.
+    return self.__dispatchers__[0]
+
+  def __tell_batch__(self, batch):
+    batches = OrderedDict()
+    for event in batch.get_events():
+      dispatcher = self.__route_event__(event)
+      events = batches.get(dispatcher)
+      if events is None:
+        events = list()
+        batches.update({dispatcher: events})
+      events.append(event)
+    for dispatcher, events in batches.items():
+      if len(events) == 1:
+        dispatcher.tell({'content': events[0]})
+      else:
+        dispatcher.tell({'content': EventBatch(events)})
+
+  def get_dispatchers(self):
+    return self.__dispatchers__
+
+  def get_mailbox_depth(self):
+    '''
+    Returns: The number of messages waiting for the busiest dispatcher.
+    '''
+    return max([dispatcher.get_mailbox_depth()
+      for dispatcher in self.__dispatchers__])
+
+  def is_alive(self):
+    for dispatcher in self.__dispatchers__:
+      if not dispatcher.is_alive():
+        return False
+    return True
+
+  def tell(self, message):
+    content = message.get('content')
+    if isinstance(content, Event):
+      self.__route_event__(content).tell(message)
+    elif isinstance(content, EventBatch):
+      self.__tell_batch__(content)
+    elif isinstance(content, BackgroundCommand):
+      # Commands for a call are sent by the same dispatcher to keep them
+      # in order.
+      if isinstance(content, UUIDCommand):
+        dispatcher = self.__route__(content.get_uuid())
+      else:
+        dispatcher = self.__route__(content.get_job_uuid())
+      with self.__lock__:
+        self.__senders__.put(content.get_job_uuid(), dispatcher)
+      dispatcher.tell(message)
+    elif isinstance(content, RegisterJobObserverCommand) or \
+         isinstance(content, UnregisterJobObserverCommand):
+      self.__route__(content.get_job_uuid()).tell(message)
+    elif isinstance(content, SubscribeCallEventsCommand) or \
+         isinstance(content, UnsubscribeCallEventsCommand):
+      self.__route__(content.get_uuid()).tell(message)
+    elif isinstance(content, InitializeDispatcherEvent) or \
+         isinstance(content, UnwatchEventCommand):
+      self.__broadcast__(message)
+    elif isinstance(content, KillDispatcherEvent):
+      with self.__lock__:
+        self.__senders__.clear()
+      self.__broadcast__(message)
+    else:
+      self.__dispatchers__[0].tell(message)
+
+class WatchRegistry(object):
+  '''
+  The watches added by switchlets at runtime. Watches for a value are
+  indexed by header name and value while watches for a pattern are compiled
+  and grouped by header name. Every watch is keyed by its handle, the
+  WatchEventCommand that created it, so it can be added and removed in
+  constant time. Adding the same handle twice requires removing it twice.
+  '''
+  def __init__(self):
+    self.__counts__ = dict()
+    self.__names__ = dict()
+    self.__patterns__ = dict()
+    self.__values__ = dict()
+
+  def __len__(self):
+    return len(self.__counts__)
+
+  def add(self, watch):
+    '''
+    Adds a watch.
+
+    Arguments: watch - The WatchEventCommand used as the handle.
+    '''
+    count = self.__counts__.get(watch, 0)
+    self.__counts__[watch] = count + 1
+    if count:
+      return
+    name = watch.get_name()
+    self.__names__[name] = self.__names__.get(name, 0) + 1
+    value = watch.get_value()
+    if value:
+      watches = self.__values__.get((name, value))
+      if watches is None:
+        watches = OrderedDict()
+        self.__values__.update({(name, value): watches})
+      watches[watch] = None
+    else:
+      watches = self.__patterns__.get(name)
+      if watches is None:
+        watches = OrderedDict()
+        self.__patterns__.update({name: watches})
+      watches[watch] = re.compile(watch.get_pattern())
+
+  def contains(self, watch):
+    return self.__counts__.has_key(watch)
+
+  def find(self, name, value = None, pattern = None, observer = None):
+    '''
+    Returns: The most recent watch for a name and a value or a pattern or
+             None if there is no such watch.
+
+    Arguments: name     - The header name.
+               value    - The header value.
+               pattern  - The header pattern.
+               observer - If specified only watches for this observer match.
+    '''
+    if value:
+      watches = self.__values__.get((name, value), ())
+    else:
+      watches = self.__patterns__.get(name, ())
+    result = None
+    for watch in watches:
+      if pattern and not watch.get_pattern() == pattern:
+        continue
+      if observer and not watch.get_observer() == observer:
+        continue
+      result = watch
+    return result
+
+  def get_matches(self, message):
+    '''
+    Returns: Every watch that matches a message.
+
+    Arguments: message - The event to be matched.
+    '''
+    matches = list()
+    for name in self.__names__:
+      header = message.get_header(name)
+      if not header:
+        continue
+      watches = self.__values__.get((name, header))
+      if watches:
+        matches.extend(watches)
+      watches = self.__patterns__.get(name)
+      if watches:
+        for watch, pattern in watches.items():
+          if pattern.search(header):
+            matches.append(watch)
+    return matches
+
+  def remove(self, watch):
+    '''
+    Removes a watch.
+
+    Returns: True if the watch was removed or False if it was never added.
+
+    Arguments: watch - The WatchEventCommand used as the handle.
+    '''
+    count = self.__counts__.get(watch)
+    if not count:
+      return False
+    if count > 1:
+      self.__counts__[watch] = count - 1
+      return True
+    del self.__counts__[watch]
+    name = watch.get_name()
+    value = watch.get_value()
+    if value:
+      key = (name, value)
+      index = self.__values__
+    else:
+      key = name
+      index = self.__patterns__
+    watches = index.get(key)
+    del watches[watch]
+    if not watches:
+      del index[key]
+    count = self.__names__.get(name)
+    if count == 1:
+      del self.__names__[name]
+    else:
+      self.__names__[name] = count - 1
+    return True
+
+class WorkerFront(IEventSocketClientObserver):
+  '''
+  Owns the event socket connection to a FreeSWITCH node on behalf of several
+  worker processes that run the switchlets. A dispatcher in the front
+  process authenticates and manages the event subscription and filters
+  while events are spread across the workers by their Job-UUID,
+  Channel-Call-UUID or Unique-ID. FreeSWITCH replies to commands in the
+  order they are sent so every reply is returned to the process that sent
+  the command.
+
+  Arguments: node    - The FreeSWITCH node.
+             status  - The node status.
+             workers - The number of worker processes.
+             connect - Called to connect to FreeSWITCH once every worker
+                       process has connected to the front.
+  '''
+  def __init__(self, node, status, workers, connect):
+    self.__logger__ = logging.getLogger('freepy.lib.server.workerfront')
+    self.__status__ = status
+    self.__connect__ = connect
+    self.__connected__ = False
+    self.__ready__ = False
+    self.__client__ = None
+    self.__workers__ = [None] * workers
+    # The owner of every command waiting for a reply in the order the
+    # commands were sent. The front's own commands are owned by None.
+    self.__lock__ = Lock()
+    self.__replies__ = deque()
+    # The worker that started every background job. The workers are
+    # forgotten if the job never completes.
+    self.__jobs__ = ExpiringMap(dispatcher_observer_ttl)
+    self.__dispatcher__ = Dispatcher.start(node = node, status = status,
+      peers = [self])
+
+  def __on_ready__(self):
+    self.__ready__ = True
+    for worker in self.__workers__:
+      if worker:
+        worker.send_frame(('ready',))
+
+  def __route__(self, event):
+    uuid = event.get_header('Job-UUID')
+    if uuid:
+      if event.get_header('Event-Name') == 'BACKGROUND_JOB':
+        index = self.__jobs__.pop(uuid, None)
+      else:
+        index = self.__jobs__.get(uuid)
+      if index is not None:
+        return index
+    else:
+      uuid = event.get_header('Channel-Call-UUID')
+      if not uuid:
+        uuid = event.get_header('Unique-ID')
+    if uuid:
+      return shard_for_uuid(uuid, len(self.__workers__), -1)
+    return 0
+
+  def __send__(self, owner, command):
+    with self.__lock__:
+      self.__replies__.append(owner)
+      self.__client__.send(command)
+
+  def add_worker(self, index, worker):
+    self.__workers__[index] = worker
+    if self.__ready__:
+      worker.send_frame(('ready',))
+    if not self.__connected__ and None not in self.__workers__:
+      self.__connected__ = True
+      self.__connect__()
+
+  def on_event(self, event):
+    self.on_events([event])
+
+  def on_events(self, events):
+    self.__status__.record_events(len(events))
+    batches = dict()
+    for event in events:
+      content_type = event.get_header('Content-Type')
+      if content_type == 'command/reply' or content_type == 'api/response':
+        with self.__lock__:
+          owner = None
+          if self.__replies__:
+            owner = self.__replies__.popleft()
+        if owner is None:
+          self.__dispatcher__.tell({'content': event})
+          continue
+        index = owner
+      elif content_type in EVENT_CONTENT_TYPES:
+        if event.get_header('Event-Name') == 'HEARTBEAT':
+          self.__status__.record_heartbeat(event)
+        index = self.__route__(event)
+      else:
+        self.__dispatcher__.tell({'content': event})
+        continue
+      batch = batches.get(index)
+      if batch is None:
+        batch = list()
+        batches.update({index: batch})
+      batch.append(event)
+    for index, batch in batches.items():
+      worker = self.__workers__[index]
+      if worker:
+        worker.send_frame(('events', batch))
+      else:
+        self.__logger__.warning('Worker %i is not connected. %i events \
+        were dropped.', index, len(batch))
+
+  def on_start(self, client):
+    self.__client__ = client
+    event = InitializeDispatcherEvent(ApplicationFactory(None), self, None)
+    self.__dispatcher__.tell({'content': event})
+
+  def on_stop(self):
+    with self.__lock__:
+      self.__replies__.clear()
+    self.__jobs__.clear()
+    self.__dispatcher__.tell({'content': KillDispatcherEvent()})
+    for worker in self.__workers__:
+      if worker:
+        worker.send_frame(('kill',))
+
+  def on_worker_frame(self, index, frame):
+    kind = frame[0]
+    if kind == 'command':
+      job_uuid, command = frame[1:]
+      if job_uuid:
+        self.__jobs__.put(job_uuid, index)
+      self.__send__(index, command)
+      self.__status__.record_command()
+    elif kind == 'filter':
+      self.__dispatcher__.tell({'content': frame[1]})
+
+  def remove_worker(self, index):
+    self.__logger__.error('Worker %i disconnected from the front.', index)
+    self.__workers__[index] = None
+
+  def send(self, command):
+    '''
+    Sends a command on behalf of the front's dispatcher.
+    '''
+    self.__send__(None, command)
+
+  def tell(self, message):
+    if isinstance(message.get('content'), DispatcherReadyEvent):
+      reactor.callFromThread(self.__on_ready__)
+
+def encode_frame(frame):
+  '''
+  Encodes a frame exchanged between the front and the worker processes.
+  Frames are tuples where the first value is the kind of frame. They are
+  sent as text, and events as event socket messages, so a frame can never
+  make the receiving process run code.
+
+  Arguments: frame - The frame to encode.
+  '''
+  kind = frame[0]
+  if kind == 'events':
+    payload = ''.join([encode_event(event) for event in frame[1]])
+  elif kind == 'command':
+    payload = '%s\n%s' % (frame[1] or '', frame[2])
+  elif kind == 'filter':
+    command = frame[1]
+    action = 'add'
+    if isinstance(command, FilterDeleteCommand):
+      action = 'delete'
+    payload = '%s\n%s\n%s' % (action, command.get_name(), command.get_value())
+  elif kind == 'hello':
+    payload = str(frame[1])
+  else:
+    payload = ''
+  return '%s\n%s' % (kind, payload)
+
+def decode_frame(data):
+  '''
+  Returns: The frame encoded by encode_frame.
+
+  Arguments: data - The encoded frame.
+  '''
+  kind, separator, payload = data.partition('\n')
+  if kind == 'events':
+    parser = EventSocketParser(lazy_headers = event_socket_lazy_headers)
+    parser.feed(payload)
+    events = list()
+    event = parser.next_event()
+    while event is not None:
+      events.append(event)
+      event = parser.next_event()
+    return (kind, events)
+  elif kind == 'command':
+    job_uuid, command = payload.split('\n', 1)
+    return (kind, job_uuid or None, command)
+  elif kind == 'filter':
+    action, name, value = payload.split('\n', 2)
+    if action == 'delete':
+      return (kind, FilterDeleteCommand(name, value))
+    return (kind, FilterCommand(name, value))
+  elif kind == 'hello':
+    return (kind, int(payload))
+  else:
+    return (kind,)
+
+def worker_socket_name(node, index):
+  '''
+  Returns: The file name of the UNIX socket for a FreeSWITCH node. Only
+           letters, digits, dots, dashes and underscores are kept from the
+           name of the node.
+
+  Arguments: node  - The name of the FreeSWITCH node.
+             index - The index of the node, which keeps the names of nodes
+                     that only differ in other characters apart.
+  '''
+  return '%i-%s.sock' % (index, re.sub(r'[^A-Za-z0-9_.-]', '_', node))
+
+class WorkerConnection(Int32StringReceiver):
+  '''
+  The front's end of the connection to a worker process. Frames are encoded
+  with encode_frame.
+  '''
+  MAX_LENGTH = 2 ** 30
+
+  def __init__(self, front):
+    self.__front__ = front
+    self.__index__ = None
+
+  def connectionLost(self, reason):
+    if self.__index__ is not None:
+      self.__front__.remove_worker(self.__index__)
+
+  def send_frame(self, frame):
+    self.sendString(encode_frame(frame))
+
+  def stringReceived(self, data):
+    frame = decode_frame(data)
+    if frame[0] == 'hello':
+      self.__index__ = frame[1]
+      self.__front__.add_worker(self.__index__, self)
+    else:
+      self.__front__.on_worker_frame(self.__index__, frame)
+
+class WorkerConnectionFactory(ServerFactory):
+  def __init__(self, front):
+    self.__front__ = front
+
+  def buildProtocol(self, addr):
+    return WorkerConnection(self.__front__)
+
+class FrontConnection(Int32StringReceiver):
+  '''
+  A worker process's end of the connection to the front. The dispatchers in
+  the worker use it as their event socket client.
+
+  Arguments: index       - The index of the worker process.
+             apps        - The worker's application factory.
+             dispatcher  - The worker's dispatcher.
+             dispatchers - Every dispatcher shard in the worker.
+             events      - The event lookup table for the services.
+  '''
+  MAX_LENGTH = 2 ** 30
+
+  def __init__(self, index, apps, dispatcher, dispatchers, events):
+    self.__logger__ = logging.getLogger('freepy.lib.server.frontconnection')
+    self.__index__ = index
+    self.__apps__ = apps
+    self.__dispatcher__ = dispatcher
+    self.__dispatchers__ = dispatchers
+    self.__events__ = events
+
+  def __send_frame__(self, frame):
+    self.sendString(encode_frame(frame))
+
+  def connectionLost(self, reason):
+    self.__logger__.info('Worker %i disconnected from the front.',
+      self.__index__)
+    self.__dispatcher__.tell({'content': KillDispatcherEvent()})
+    ActorRegistry.stop_all()
+    reactor.stop()
+
+  def connectionMade(self):
+    self.__send_frame__(('hello', self.__index__))
+    event = InitializeDispatcherEvent(self.__apps__, self, self.__events__)
+    self.__dispatcher__.tell({'content': event})
+
+  def send(self, command):
+    '''
+    Sends a command to FreeSWITCH through the front. It is safe to call this
+    method from any thread.
+
+    Arguments: command - The command to send.
+    '''
+    if isinstance(command, FilterCommand):
+      frame = ('filter', command)
+    elif isinstance(command, BackgroundCommand):
+      frame = ('command', command.get_job_uuid(), str(command))
+    else:
+      frame = ('command', None, str(command))
+    reactor.callFromThread(self.__send_frame__, frame)
+
+  def stringReceived(self, data):
+    frame = decode_frame(data)
+    kind = frame[0]
+    if kind == 'events':
+      events = frame[1]
+      if len(events) == 1:
+        self.__dispatcher__.tell({'content': events[0]})
+      else:
+        self.__dispatcher__.tell({'content': EventBatch(events)})
+    elif kind == 'ready':
+      for dispatcher in self.__dispatchers__:
+        dispatcher.tell({'content': DispatcherReadyEvent()})
+    elif kind == 'kill':
+      self.transport.loseConnection()
+
+class FrontConnectionFactory(ClientFactory):
+  def __init__(self, connection):
+    self.__connection__ = connection
+
+  def buildProtocol(self, addr):
+    return self.__connection__
+
+  def clientConnectionFailed(self, connector, reason):
+    logging.getLogger('freepy.lib.server.frontconnectionfactory').critical(
+      'Could not connect to the worker front: %s', reason.getErrorMessage())
+    reactor.stop()
+
+class WorkerProcessProtocol(ProcessProtocol):
+  def __init__(self, index):
+    self.__logger__ = logging.getLogger('freepy.lib.server.workerprocess')
+    self.__index__ = index
+
+  def processEnded(self, reason):
+    self.__logger__.error('Worker %i exited: %s', self.__index__,
+      reason.getErrorMessage())
 
 class FreepyServer(object):
   def __generate_event_lookup_table__(self):
@@ -452,6 +2066,10 @@ class FreepyServer(object):
 
   def __init__(self, *args, **kwargs):
     self.__logger__ = logging.getLogger('freepy.lib.server.freepyserver')
+    self.__nodes__ = list()
+    self.__apps__ = dict()
+    # The private directory holding the UNIX sockets of the worker processes.
+    self.__socket_directory__ = None
 
   def __load_apps_factory__(self, dispatcher):
     factory = ApplicationFactory(dispatcher)
@@ -459,7 +2077,8 @@ class FreepyServer(object):
       target = rule.get('target')
       persistent = rule.get('persistent')
       if not persistent:
-        factory.register(target, type = 'class')
+        factory.register(target, type = 'class',
+          pool_size = rule.get('pool_size', 0))
       else:
         factory.register(target, type = 'singleton')
     return factory
@@ -468,41 +2087,207 @@ class FreepyServer(object):
     for service in dispatcher_services:
       factory.register(service.get('target'), type = 'singleton')
 
+  def __start_outbound_socket__(self, events):
+    status = NodeStatus('outbound')
+    self.__nodes__.append(status)
+    target = outbound_socket.get('target')
+    apps = ApplicationFactory(None)
+    apps.register(target, type = 'class')
+    self.__load_services__(apps)
+    self.__apps__.update({'outbound': apps})
+    def create_observer():
+      dispatcher = OutboundDispatcher.start(target = target, status = status)
+      return DispatcherProxy(apps, dispatcher, events,
+        high_watermark = dispatcher_mailbox_high_watermark,
+        low_watermark = dispatcher_mailbox_low_watermark)
+    factory = EventSocketServerFactory(create_observer,
+      lazy_headers = event_socket_lazy_headers,
+      batch_events = event_socket_batch_events)
+    reactor.listenTCP(outbound_socket.get('port'), factory,
+      interface = outbound_socket.get('address'))
+
+  def __start_dispatcher__(self, **kwargs):
+    if dispatcher_shards == 1:
+      return Dispatcher.start(**kwargs)
+    # Every connection gets its own set of dispatcher threads.
+    peers = list()
+    for shard in range(dispatcher_shards - 1):
+      peers.append(DispatcherShard.start(**kwargs))
+    dispatcher = Dispatcher.start(peers = peers, **kwargs)
+    return ShardedDispatcher([dispatcher] + peers)
+
+  def __start_front__(self, node):
+    status = NodeStatus(node.get('name'))
+    self.__nodes__.append(status)
+    def connect():
+      factory = EventSocketClientFactory(front,
+        lazy_headers = event_socket_lazy_headers,
+        batch_events = event_socket_batch_events)
+      reactor.connectTCP(node.get('address'), node.get('port'), factory)
+    front = WorkerFront(node, status, worker_processes, connect)
+    path = os.path.join(self.__get_socket_directory__(),
+      worker_socket_name(node.get('name'), len(self.__nodes__)))
+    reactor.listenUNIX(path, WorkerConnectionFactory(front), mode = 0600)
+    script = os.path.abspath(sys.argv[0])
+    for index in range(worker_processes):
+      reactor.spawnProcess(WorkerProcessProtocol(index), sys.executable,
+        [sys.executable, script, 'worker', node.get('name'), str(index), path],
+        env = os.environ, childFDs = {0: 0, 1: 1, 2: 2})
+
+  def __get_socket_directory__(self):
+    '''
+    Returns: The directory for the UNIX sockets of the worker processes. It
+             is created the first time with a name nobody can predict and
+             only the current user can access it, so no one else can bind
+             or connect to the sockets. It is removed on shutdown.
+    '''
+    if self.__socket_directory__ is None:
+      self.__socket_directory__ = tempfile.mkdtemp(prefix = 'freepy-',
+        dir = worker_socket_directory)
+      reactor.addSystemEventTrigger('after', 'shutdown', shutil.rmtree,
+        self.__socket_directory__, True)
+    return self.__socket_directory__
+
+  def __start_node__(self, node, events):
+    status = NodeStatus(node.get('name'))
+    self.__nodes__.append(status)
+    # Create a dispatcher thread for every event socket connection.
+    dispatchers = list()
+    for shard in range(event_socket_connections):
+      dispatchers.append(self.__start_dispatcher__(shard = shard,
+        shards = event_socket_connections, node = node, status = status))
+    if len(dispatchers) == 1:
+      dispatcher = dispatchers[0]
+    else:
+      dispatcher = DispatcherPool(dispatchers)
+    # Load all the apps.
+    apps = self.__load_apps_factory__(dispatcher)
+    # Load the dispatcher services.
+    self.__load_services__(apps)
+    self.__apps__.update({node.get('name'): apps})
+    address = node.get('address')
+    port = node.get('port')
+    for shard_dispatcher in dispatchers:
+      # Create the proxy between the event socket client and the dispatcher.
+      dispatcher_proxy = DispatcherProxy(apps, shard_dispatcher, events,
+        high_watermark = dispatcher_mailbox_high_watermark,
+        low_watermark = dispatcher_mailbox_low_watermark)
+      # Create an event socket client factory.
+      factory = EventSocketClientFactory(dispatcher_proxy,
+        lazy_headers = event_socket_lazy_headers,
+        batch_events = event_socket_batch_events)
+      reactor.connectTCP(address, port, factory)
+
   def __validate_rule__(self, rule):
     name = rule.get('header_name')
     value = rule.get('header_value')
     pattern = rule.get('header_pattern')
     target = rule.get('target')
+    pool_size = rule.get('pool_size', 0)
     if not name or not target or not value and not pattern \
       or value and pattern:
       return False
+    elif not type(pool_size) == int or pool_size < 0 or \
+      pool_size > switchlet_pool_maximum or \
+      pool_size and rule.get('persistent'):
+      return False
     else:
       return True
 
+  def get_node_status(self):
+    '''
+    Returns: The health and load counters for every FreeSWITCH node.
+    '''
+    return self.__nodes__
+
+  def get_transition_metrics(self):
+    '''
+    Returns: The TransitionHistogram for the finite state machines or None
+             when fsm_tracing is turned off.
+    '''
+    return get_transition_sink()
+
+  def get_queue_depths(self):
+    '''
+    Returns: The mailbox depth gauges for the switchlets of every
+             FreeSWITCH node.
+    '''
+    gauges = dict()
+    for name, apps in self.__apps__.items():
+      gauges.update({name: apps.get_queue_depths()})
+    return gauges
+
   def start(self):
     # Initialize application wide logging.
     logging.basicConfig(filename = logging_filename, format = logging_format,
       level = logging_level)
+    if fsm_tracing:
+      set_transition_sink(TransitionHistogram())
     # Validate the list of rules.
     for rule in dispatch_rules:
       if not self.__validate_rule__(rule):
         self.__logger__.critical('The rule %s is invalid.', str(rule))
         return
-    # Create a dispatcher thread.
-    dispatcher = Dispatcher().start()
-    # Load all the apps.
-    apps = self.__load_apps_factory__(dispatcher)
-    # Load the dispatcher services.
-    self.__load_services__(apps)
+    if event_socket_connections < 1 or \
+       event_socket_connections > len(UUID_DIGITS):
+      self.__logger__.critical('The number of event socket connections must \
+      be between 1 and %i.', len(UUID_DIGITS))
+      return
+    if dispatcher_shards < 1 or dispatcher_shards > len(UUID_DIGITS):
+      self.__logger__.critical('The number of dispatcher shards must be \
+      between 1 and %i.', len(UUID_DIGITS))
+      return
+    if worker_processes > len(UUID_DIGITS):
+      self.__logger__.critical('The number of worker processes can not be \
+      more than %i.', len(UUID_DIGITS))
+      return
+    if worker_processes and (event_socket_connections > 1 or outbound_socket):
+      self.__logger__.critical('Worker processes can not be combined with \
+      several event socket connections or the outbound socket.')
+      return
     # Generate an event lookup table.
     events = self.__generate_event_lookup_table__()
-    # Create the proxy between the event socket client and the dispatcher.
-    dispatcher_proxy = DispatcherProxy(apps, dispatcher, events)
-    # Create an event socket client factory and start the reactor.
-    address = freeswitch_host.get('address')
-    port = freeswitch_host.get('port')
-    factory = EventSocketClientFactory(dispatcher_proxy)
-    reactor.connectTCP(address, port, factory)
+    # Every FreeSWITCH node gets its own dispatchers and switchlets so
+    # commands for a call always go back to the node that owns the call.
+    for node in freeswitch_hosts:
+      if worker_processes:
+        self.__start_front__(node)
+      else:
+        self.__start_node__(node, events)
+    if outbound_socket:
+      self.__start_outbound_socket__(events)
+    # Start the reactor.
+    reactor.run()
+
+  def start_worker(self, name, index, path):
+    '''
+    Starts a worker process that runs the switchlets for a share of the
+    calls on a FreeSWITCH node.
+
+    Arguments: name  - The name of the FreeSWITCH node.
+               index - The index of the worker process.
+               path  - The UNIX socket the front listens on.
+    '''
+    logging.basicConfig(filename = logging_filename, format = logging_format,
+      level = logging_level)
+    if fsm_tracing:
+      set_transition_sink(TransitionHistogram())
+    node = [node for node in freeswitch_hosts if node.get('name') == name][0]
+    status = NodeStatus(name)
+    dispatchers = list()
+    for shard in range(dispatcher_shards):
+      dispatchers.append(WorkerDispatcher.start(node = node, status = status))
+    if len(dispatchers) == 1:
+      dispatcher = dispatchers[0]
+    else:
+      # The front already spreads the calls across the workers by the last
+      # UUID digit so the threads of a worker use the one before it.
+      dispatcher = ShardedDispatcher(dispatchers, -2)
+    apps = self.__load_apps_factory__(dispatcher)
+    self.__load_services__(apps)
+    connection = FrontConnection(index, apps, dispatcher, dispatchers,
+      self.__generate_event_lookup_table__())
+    reactor.connectUNIX(path, FrontConnectionFactory(connection))
     reactor.run()
 
   def stop(self):
@@ -17,20 +17,45 @@
 #
 # Thomas Quintana <quintana.thomas@gmail.com>
 
+from conf.settings import timer_clock
+from itertools import count
+from lib.clock import monotonic
 from llist import dllist
 from pykka import ThreadingActor
 from threading import Thread
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 
 import logging, time
 
+# Generates the handles for timers scheduled without one.
+__timer_handles__ = count()
+
 class ServiceRequest(object):
   pass
 
 class ReceiveTimeoutCommand(ServiceRequest):
-  def __init__(self, sender, timeout, recurring = False):
+  '''
+  Asks the TimerService for a TimeoutEvent once the timeout, in milliseconds,
+  expires. An actor can have many timers as long as every timer has its own
+  handle. A timer with the same handle as a running timer replaces it.
+
+  Arguments: sender    - The actor that receives the TimeoutEvent.
+             timeout   - The timeout in milliseconds.
+             recurring - If True the timer is restarted every time it expires.
+             handle    - The handle used to tell the timers of an actor apart.
+                         A unique handle is generated when none is given.
+  '''
+  def __init__(self, sender, timeout, recurring = False, handle = None):
     self.__sender__ = sender
     self.__timeout__ = timeout
     self.__recurring__ = recurring
+    if handle is None:
+      handle = next(__timer_handles__)
+    self.__handle__ = handle
+
+  def get_handle(self):
+    return self.__handle__
 
   def get_sender(self):
     return self.__sender__
@@ -41,9 +66,32 @@ class ReceiveTimeoutCommand(ServiceRequest):
   def is_recurring(self):
     return self.__recurring__
 
+class ScheduleTimersCommand(ServiceRequest):
+  '''
+  Asks the TimerService to schedule many timers with one message.
+
+  Arguments: timers - A list of ReceiveTimeoutCommands.
+  '''
+  def __init__(self, timers):
+    self.__timers__ = timers
+
+  def get_timers(self):
+    return self.__timers__
+
 class StopTimeoutCommand(ServiceRequest):
-  def __init__(self, sender):
+  '''
+  Asks the TimerService to stop a timer.
+
+  Arguments: sender - The actor that owns the timer.
+             handle - The handle of the timer or None to stop every timer
+                      owned by the sender.
+  '''
+  def __init__(self, sender, handle = None):
     self.__sender__ = sender
+    self.__handle__ = handle
+
+  def get_handle(self):
+    return self.__handle__
 
   def get_sender(self):
     return self.__sender__
@@ -52,7 +100,25 @@ class ClockEvent(object):
   pass
 
 class TimeoutEvent(object):
-  pass
+  def __init__(self, handle = None):
+    self.__handle__ = handle
+
+  def get_handle(self):
+    return self.__handle__
+
+class TimeoutBatch(object):
+  '''
+  Carries the TimeoutEvents of all the timers owned by one actor that
+  expired during the same tick. Actors with a single expired timer receive
+  the TimeoutEvent on its own.
+
+  Arguments: events - A list of TimeoutEvents.
+  '''
+  def __init__(self, events):
+    self.__events__ = events
+
+  def get_events(self):
+    return self.__events__
 
 class MonotonicClock(Thread):
   def __init__(self, *args, **kwargs):
@@ -74,15 +140,69 @@ class MonotonicClock(Thread):
   def stop(self):
     self.__running__ = False
 
+class ReactorClock(object):
+  '''
+  Tells an actor a ClockEvent every interval from a LoopingCall running
+  inside the twisted reactor instead of a dedicated thread.
+
+  Arguments: actor    - The actor that receives the ClockEvents.
+             interval - The interval in seconds.
+  '''
+  def __init__(self, actor, interval):
+    self.__actor__ = actor
+    self.__interval__ = interval
+    self.__loop__ = LoopingCall(self.__tell__)
+    # Singleton instance of ClockEvent.
+    self.__event__ = ClockEvent()
+
+  def __start__(self):
+    if not self.__loop__.running:
+      self.__loop__.start(self.__interval__, now = False)
+
+  def __stop__(self):
+    if self.__loop__.running:
+      self.__loop__.stop()
+
+  def __tell__(self):
+    self.__actor__.tell({'content': self.__event__})
+
+  def start(self):
+    reactor.callFromThread(self.__start__)
+
+  def stop(self):
+    reactor.callFromThread(self.__stop__)
+
+def get_clock_class(clock):
+  '''
+  Returns: The class of the clock that drives the TimerService.
+
+  Arguments: clock - The name of the clock as in conf.settings.timer_clock.
+  '''
+  if clock == 'reactor':
+    return ReactorClock
+  elif clock == 'thread':
+    return MonotonicClock
+  else:
+    raise ValueError('The timer clock %s is invalid. Possible values are '
+      'reactor or thread.' % clock)
+
 class TimerService(ThreadingActor):
   '''
   The timer service uses the timing wheel algorithm borrowing from the
   approach used in the Linux kernel. Please refer to the email thread
   by Ingo Molnar @ https://lkml.org/lkml/2005/10/19/46.
+
+  Every ClockEvent advances the wheel by all the ticks that elapsed on the
+  monotonic clock since the last one, so the wheel catches up when the
+  process falls behind instead of drifting.
+
+  Arguments: clock - The name of the clock that drives the service, defaults
+                     to conf.settings.timer_clock.
   '''
   TICK_SIZE  = 0.1             # Tick every 100 milliseconds.
 
   def __init__(self, *args, **kwargs):
+    clock = kwargs.pop('clock', timer_clock)
     super(TimerService, self).__init__(*args, **kwargs)
     # Initialize the timing wheels. The finest possible
     self.__logger__ = logging.getLogger('freepy.lib.services.TimerService')
@@ -97,12 +217,30 @@ class TimerService(ThreadingActor):
     self.__timer_vector4_index__  = 0
     # Initialize the tick counter.
     self.__current_tick__ = 0
-    # Initialize the actor lookup table for O(1) timer removal.
+    # Initialize the actor lookup table for O(1) timer removal. The timers
+    # are keyed by actor urn and handle.
     self.__actor_lookup_table__ = dict()
-    # Singleton instance of the timeout event.
-    self.__timeout__ = TimeoutEvent()
-    # Monotonic clock.
+    # The clock that drives the service and the time the wheel started.
+    self.__clock_class__ = get_clock_class(clock)
     self.__clock__ = None
+    self.__epoch__ = None
+
+  def __add_timer__(self, command):
+    '''
+    Schedules a new timer replacing the sender's timer with the same handle.
+
+    Arguments: command - The ReceiveTimeoutCommand.
+    '''
+    # Timeouts count from now so the wheel must not lag behind.
+    self.__catch_up__()
+    observer = command.get_sender()
+    handle = command.get_handle()
+    timers = self.__actor_lookup_table__.get(observer.actor_urn)
+    if timers and timers.has_key(handle):
+      self.__remove_timer__(observer.actor_urn, handle)
+    timer = TimerService.Timer(observer, command.get_timeout(),
+      command.is_recurring(), handle)
+    self.__schedule__(timer)
 
   def __cascade_vector__(self, vector, elapsed):
     '''
@@ -173,6 +311,17 @@ class TimerService(ThreadingActor):
     index = (index + 1) % 256
     self.__timer_vector4_index__ = index
 
+  def __catch_up__(self):
+    '''
+    Executes every tick that elapsed since the last clock event.
+    '''
+    # The wheel does not move until the service starts.
+    if self.__epoch__ is None:
+      return
+    elapsed = int(round((monotonic() - self.__epoch__) * 1000)) // 100
+    while self.__current_tick__ < elapsed:
+      self.__tick__()
+
   def __create_vector__(self, size):
     '''
     Creates a new vector and initializes it to a specified size.
@@ -200,15 +349,14 @@ class TimerService(ThreadingActor):
     else:
       return timeout + 100 - remainder
 
-  def __schedule__(self, timer):
+  def __insert__(self, timer, expires):
     '''
-    Schedules a timer for expiration.
+    Inserts a timer into the vector that covers its expiration.
 
-    Arguments: timer - The timer to be shceduled.
+    Arguments: timer   - The timer to be inserted.
+               expires - The expiration in milliseconds from the start of
+                         the current rotation of vector 1.
     '''
-    tick = self.__current_tick__
-    timeout = timer.get_timeout()
-    expires = (tick % 256) * 100 + self.__round__(timeout)
     timer.set_expires(expires)
     if expires <= 25600:
       self.__vector1_insert__(timer)
@@ -219,54 +367,151 @@ class TimerService(ThreadingActor):
     elif expires <= 429496729600:
       self.__vector4_insert__(timer)
 
+  def __schedule__(self, timer):
+    '''
+    Schedules a timer for expiration.
+
+    Arguments: timer - The timer to be shceduled.
+    '''
+    tick = self.__current_tick__
+    timeout = timer.get_timeout()
+    self.__insert__(timer, (tick % 256) * 100 + self.__round__(timeout))
+
+  def __reschedule__(self, timers):
+    '''
+    Schedules recurring timers that just expired again from the current tick.
+    The timers keep their entries in the lookup table and timers with the
+    same timeout share one expiration.
+
+    Arguments: timers - The timers to be rescheduled.
+    '''
+    start = (self.__current_tick__ % 256) * 100
+    vector = self.__timer_vector1__
+    expirations = dict()
+    for timer in timers:
+      timeout = timer.get_timeout()
+      expires = expirations.get(timeout)
+      if expires is None:
+        expires = start + self.__round__(timeout)
+        expirations[timeout] = expires
+      if expires <= 25600:
+        timer.set_expires(expires)
+        bucket = vector[expires / 100 - 1]
+        urn = timer.get_observer().actor_urn
+        location = self.__actor_lookup_table__[urn][timer.get_handle()]
+        location['vector'] = bucket
+        location['node'] = bucket.append(timer)
+      else:
+        self.__insert__(timer, expires)
+
   def __tick__(self):
     '''
     Excutes one clock tick.
     '''
     tick = self.__current_tick__
-    timers = self.__timer_vector1__[tick % 256]
+    # Swap the expired bucket for an empty one instead of popping every timer.
+    index = tick % 256
+    timers = self.__timer_vector1__[index]
+    self.__timer_vector1__[index] = dllist()
+    # Observers that own a single timer are told right away while the
+    # expired timers of observers that own more are batched so every
+    # observer is told once.
+    batches = dict()
     recurring = list()
-    while len(timers) > 0:
-      timer = timers.popleft()
-      timer.get_observer().tell({'content': self.__timeout__})
+    stopped = set()
+    for timer in timers:
+      observer = timer.get_observer()
+      urn = observer.actor_urn
+      if urn in batches:
+        batches[urn].append(timer)
+      elif len(self.__actor_lookup_table__.get(urn)) > 1:
+        batches[urn] = [timer]
+      elif observer.is_alive():
+        observer.tell({'content': timer.get_event()})
+      else:
+        # Observers that stopped without stopping their timers are forgotten.
+        self.__forget_timer__(urn, timer.get_handle())
+        continue
       if timer.is_recurring():
         recurring.append(timer)
       else:
-        lookup_table = self.__actor_lookup_table__
-        urn = timer.get_observer().actor_urn
-        location = lookup_table.get(urn)
-        if location:
-          del lookup_table[urn]
-    for timer in recurring:
-      self.__schedule__(timer)
+        self.__forget_timer__(urn, timer.get_handle())
+    for urn, batch in batches.iteritems():
+      observer = batch[0].get_observer()
+      if not observer.is_alive():
+        for handle in self.__actor_lookup_table__.get(urn, dict()).keys():
+          self.__remove_timer__(urn, handle)
+        stopped.add(urn)
+      elif len(batch) == 1:
+        observer.tell({'content': batch[0].get_event()})
+      else:
+        events = [timer.get_event() for timer in batch]
+        observer.tell({'content': TimeoutBatch(events)})
     self.__current_tick__ = tick + 1
     if self.__current_tick__ % 256 == 0:
       self.__cascade_vector_2__()
+    # Recurring timers are scheduled from the next tick on.
+    if stopped:
+      recurring = [timer for timer in recurring
+        if not timer.get_observer().actor_urn in stopped]
+    self.__reschedule__(recurring)
 
-  def __unschedule__(self, command):
+  def __forget_timer__(self, urn, handle):
     '''
-    Unschedules a timer that has previously been scheduled for expiration.
+    Removes a timer that is no longer scheduled from the lookup table.
 
-    Arguments: command - The StopTimeoutCommand.
+    Arguments: urn    - The urn of the actor that owns the timer.
+               handle - The handle of the timer.
     '''
-    urn = command.get_sender().actor_urn
-    location = self.__actor_lookup_table__.get(urn)
+    timers = self.__actor_lookup_table__.get(urn)
+    if timers is not None:
+      timers.pop(handle, None)
+      if len(timers) == 0:
+        del self.__actor_lookup_table__[urn]
+
+  def __remove_timer__(self, urn, handle):
+    '''
+    Removes a scheduled timer.
+
+    Arguments: urn    - The urn of the actor that owns the timer.
+               handle - The handle of the timer.
+    '''
+    location = self.__actor_lookup_table__.get(urn, dict()).get(handle)
     if location:
-      del self.__actor_lookup_table__[urn]
+      self.__forget_timer__(urn, handle)
       vector = location.get('vector')
       node = location.get('node')
       vector.remove(node)
 
+  def __unschedule__(self, command):
+    '''
+    Unschedules the timers that have previously been scheduled for expiration.
+
+    Arguments: command - The StopTimeoutCommand.
+    '''
+    urn = command.get_sender().actor_urn
+    handle = command.get_handle()
+    if handle is not None:
+      self.__remove_timer__(urn, handle)
+    else:
+      for handle in self.__actor_lookup_table__.get(urn, dict()).keys():
+        self.__remove_timer__(urn, handle)
+
   def __update_lookup_table__(self, vector, node):
     '''
     Updates a lookup table used for O(1) timer removal.
     '''
-    urn = node.value.get_observer().actor_urn
+    timer = node.value
+    urn = timer.get_observer().actor_urn
     location = {
       'vector': vector,
       'node': node
     }
-    self.__actor_lookup_table__.update({urn: location})
+    timers = self.__actor_lookup_table__.get(urn)
+    if timers is None:
+      timers = dict()
+      self.__actor_lookup_table__.update({urn: timers})
+    timers.update({timer.get_handle(): location})
 
   def __vector1_insert__(self, timer):
     '''
@@ -331,26 +576,23 @@ class TimerService(ThreadingActor):
       return
     # Handle the message.
     if isinstance(message, ReceiveTimeoutCommand):
-      uuid = message.get_sender().actor_urn
-      if not self.__actor_lookup_table__.has_key(uuid):
-        timeout = message.get_timeout()
-        observer = message.get_sender()
-        recurring = message.is_recurring()
-        timer = TimerService.Timer(observer, timeout, recurring)
-        self.__schedule__(timer)
-      else:
-        self.__logger__.warning('Actor %s is requesting too many simultaneous timers.'
-          % uuid)
+      self.__add_timer__(message)
+    elif isinstance(message, ScheduleTimersCommand):
+      self.__catch_up__()
+      for command in message.get_timers():
+        self.__add_timer__(command)
     elif isinstance(message, StopTimeoutCommand):
       self.__unschedule__(message)
     elif isinstance(message, ClockEvent):
-      self.__tick__()
+      self.__catch_up__()
 
   def on_start(self):
     '''
     Initialized the TimerService.
     '''
-    self.__clock__ = MonotonicClock(self.actor_ref, TimerService.TICK_SIZE)
+    self.__epoch__ = monotonic()
+    self.__clock__ = self.__clock_class__(self.actor_ref,
+      TimerService.TICK_SIZE)
     self.__clock__.start()
 
   def on_stop(self):
@@ -360,15 +602,24 @@ class TimerService(ThreadingActor):
     self.__clock__.stop()
 
   class Timer(object):
-    def __init__(self, observer, timeout, recurring = False):
+    def __init__(self, observer, timeout, recurring = False, handle = None):
       self.__observer__ = observer
       self.__recurring__ = recurring
       self.__timeout__ = timeout
       self.__expires__ = 0
+      self.__handle__ = handle
+      # The timeout event is sent every time the timer expires.
+      self.__event__ = TimeoutEvent(handle)
+
+    def get_event(self):
+      return self.__event__
 
     def get_expires(self):
       return self.__expires__
 
+    def get_handle(self):
+      return self.__handle__
+
     def get_observer(self):
       return self.__observer__
 
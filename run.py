@@ -17,11 +17,33 @@
 #
 # Thomas Quintana <quintana.thomas@gmail.com>
 
+from conf.settings import actor_runtime
+
+# The green actor runtimes need a cooperative standard library which must
+# be patched before twisted and pykka are imported.
+if actor_runtime == 'gevent':
+  from gevent import monkey
+  monkey.patch_all()
+elif actor_runtime == 'eventlet':
+  import eventlet
+  eventlet.monkey_patch()
+if not actor_runtime == 'threading':
+  # The epoll and poll reactors can not wait on the patched select module.
+  from twisted.internet import selectreactor
+  selectreactor.install()
+
 from lib.server import FreepyServer
 
+import sys
+
 def main():
   server = FreepyServer()
-  server.start()
+  # Worker processes are started by freepy as:
+  #   run.py worker <node> <index> <socket>
+  if len(sys.argv) == 5 and sys.argv[1] == 'worker':
+    server.start_worker(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+  else:
+    server.start()
 
 # Start the application server!
 if __name__ == "__main__":
@@ -20,10 +20,11 @@
 # Nishad Musthafa  <nishadmusthafa@gmail.com>
 
 from lib.commands import AnswerCommand, KillCommand
-from lib.core import InitializeSwitchletEvent, Switchlet
-from lib.esl import Event
+from lib.core import InitializeSwitchletEvent, ResetSwitchletEvent, Switchlet
+from lib.esl import EVENT_CONTENT_TYPES, Event
 from lib.fsm import Action, FiniteStateMachine
-from lib.server import RegisterJobObserverCommand, UnregisterJobObserverCommand
+from lib.server import RegisterJobObserverCommand, ReleaseSwitchletCommand, \
+  UnregisterJobObserverCommand
 from switchlets.data_connector import DataConnector, QueryContext, QueryResult
 from switchlets.call_utilities import ActionExecutor, StartExecution, ExecutionComplete
 
@@ -50,6 +51,14 @@ class IncomingCallHandler(FiniteStateMachine, Switchlet):
     ('failed query. stopping call', 'terminate call'),
     ('executing call logic', 'terminate call'),
     ('terminate call', 'call terminated'),
+    ('call terminated', 'waiting for incoming call'),
+  ]
+
+  triggers = [
+    ('not ready', InitializeSwitchletEvent, 'waiting for incoming call'),
+    ('failed query. stopping call', EndCall, 'terminate call'),
+    ('executing call logic', ExecutionComplete, 'terminate call'),
+    ('call terminated', ResetSwitchletEvent, 'waiting for incoming call'),
   ]
 
   def __init__(self, *args, **kwargs):
@@ -83,13 +92,22 @@ class IncomingCallHandler(FiniteStateMachine, Switchlet):
   def get_call_uuid(self):
     return self.__call_context__.get('uuid')
 
+  @Action(state = 'not ready', on_enter = False, on_exit = True)
   def initialize(self, message):
     self.__dispatcher__ = message.get_dispatcher()
 
+  @Action(state = 'call terminated', on_enter = False, on_exit = True)
+  def reset(self, message):
+    # The data connector is kept for the next call.
+    self.__call_context__ = {}
+    self.__action_executor__ = None
+    self.__execution_actions__ = None
+
   @Action(state = 'call started. fetching app')
   def fetch_app(self, message):
     self.collect_call_context(message)
-    self.__data_connector__ = DataConnector.start()
+    if not self.__data_connector__ or not self.__data_connector__.is_alive():
+      self.__data_connector__ = DataConnector.start()
     query_data = {'sender': self.actor_ref,
                   'model': 'number_mappings',
                   'key': self.__call_context__.get('to'),
@@ -113,7 +131,6 @@ class IncomingCallHandler(FiniteStateMachine, Switchlet):
   @Action(state = 'got logic. answering call')
   def call_answer(self, message):
     self.__execution_actions__ = message.get_query_result()
-    self.__data_connector__.stop()
     answer_command = AnswerCommand(self.actor_ref, self.get_call_uuid())
     register_observer = RegisterJobObserverCommand(self.actor_ref, answer_command.get_job_uuid())
     self.__dispatcher__.tell({'content': register_observer})
@@ -138,7 +155,6 @@ class IncomingCallHandler(FiniteStateMachine, Switchlet):
 
   @Action(state = 'failed query. stopping call')
   def call_rejection(self, message):
-    self.__data_connector__.stop()
     self.actor_ref.tell({'content': EndCall()})
 
   @Action(state = 'terminate call')
@@ -153,22 +169,34 @@ class IncomingCallHandler(FiniteStateMachine, Switchlet):
   def end_call(self, message):
     if self.__action_executor__:
       self.__action_executor__.stop()
-    # self.actor_ref.stop()
+    # Hand this handler back to its pool for the next call.
+    release_switchlet = ReleaseSwitchletCommand(self.actor_ref)
+    self.__dispatcher__.tell({'content': release_switchlet})
+
+  def on_stop(self):
+    if self.__data_connector__ and self.__data_connector__.is_alive():
+      self.__data_connector__.stop(block = False)
 
   def on_receive(self, message):
     message = message.get('content')
 
-    if isinstance(message, InitializeSwitchletEvent):
-      self.initialize(message)
-      self.transition(to = 'waiting for incoming call')
-    elif isinstance(message, EndCall) or isinstance(message, ExecutionComplete):
-      self.transition(to = 'terminate call')
+    if self.trigger(message):
+      return
     elif isinstance(message, QueryResult):
       self.transition(to = message.get_destination_state(), event = message)
     elif isinstance(message, Event):
       content_type = message.get_header('Content-Type')
 
-      if content_type == 'text/event-plain':
+      # Calls connected using the outbound event socket start with the channel
+      # data because their CHANNEL_CREATE fired before the socket connected.
+      if content_type == 'command/reply':
+        name = message.get_header('Event-Name')
+        call_direction = message.get_header('Caller-Direction')
+
+        if name == 'CHANNEL_DATA' and call_direction == 'inbound':
+          self.transition(to = 'call started. fetching app', event = message)
+
+      elif content_type in EVENT_CONTENT_TYPES:
         name = message.get_header('Event-Name')
         call_direction = message.get_header('Caller-Direction')
         
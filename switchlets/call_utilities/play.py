@@ -1,7 +1,7 @@
 from lib.core import InitializeSwitchletEvent, Switchlet
-from lib.esl import Event
+from lib.esl import EVENT_CONTENT_TYPES, Event
 from lib.fsm import Action, FiniteStateMachine
-from lib.server import WatchEventCommand, UnwatchEventCommand
+from lib.server import SubscribeCallEventsCommand, UnsubscribeCallEventsCommand
 import logging
 from utils import ExecutionComplete, SendMessageCommand, StartExecution
 
@@ -31,17 +31,23 @@ class Play(FiniteStateMachine, Switchlet):
     ('sending play command', 'complete'),
   ]
 
+  triggers = [
+    ('ready', StartExecution, 'sending play command'),
+  ]
+
   def __init__(self, *args, **kwargs):
     super(Play, self).__init__(*args, **kwargs)
     self.__dispatcher__ = None
     self.__sender__ = None
     self.__call_uuid__ = None
+    self.__subscription__ = None
     self.__logger__ = logging.getLogger('call_utilities.play')
     self.transition(to = 'ready')
 
   def get_call_uuid(self):
     return self.__call_uuid__
 
+  @Action(state = 'ready', on_enter = False, on_exit = True)
   def configure(self, message):
     self.__dispatcher__ = message.get_dispatcher()
     self.__playback_path__ = message.get_context()
@@ -51,16 +57,16 @@ class Play(FiniteStateMachine, Switchlet):
   @Action(state = 'sending play command')
   def send_play_command(self, message):
     play_command = PlayCommand(self.__sender__, self.__call_uuid__, path = self.__playback_path__)
-    watch_command = WatchEventCommand(self.actor_ref, name="Event-Name", value="PLAYBACK_STOP")
-    self.__dispatcher__.tell({'content': watch_command})
-    watch_command = WatchEventCommand(self.actor_ref, name="Event-Name", value="CHANNEL_EXECUTE_COMPLETE")
-    
-
-
-
-    self.__dispatcher__.tell({'content': watch_command})
+    self.__subscription__ = SubscribeCallEventsCommand(self.actor_ref, self.__call_uuid__, ["PLAYBACK_STOP", "CHANNEL_EXECUTE_COMPLETE"])
+    self.__dispatcher__.tell({'content': self.__subscription__})
     self.__dispatcher__.tell({'content': play_command})
 
+  def unsubscribe(self):
+    if self.__subscription__:
+      unsubscribe_command = UnsubscribeCallEventsCommand(self.__subscription__)
+      self.__dispatcher__.tell({'content': unsubscribe_command})
+      self.__subscription__ = None
+
   @Action(state = 'complete')
   def stop_play(self, message):
     execution_complete = ExecutionComplete()
@@ -68,20 +74,16 @@ class Play(FiniteStateMachine, Switchlet):
 
   def on_receive(self, message):
     message = message.get('content')
-    if isinstance(message, StartExecution):
-      self.configure(message)
-      self.transition(to = 'sending play command', event = message)
+    if self.trigger(message):
+      return
     elif isinstance(message, Event):
       content_type = message.get_header('Content-Type')
 
-      if content_type == 'text/event-plain':
+      if content_type in EVENT_CONTENT_TYPES:
         name = message.get_header('Event-Name')
         call_uuid = message.get_header('Channel-Call-UUID')
         if name == 'PLAYBACK_STOP' and call_uuid == self.get_call_uuid():
-          unwatch_command = UnwatchEventCommand(name="Event-Name", value="PLAYBACK_STOP")
-          self.__dispatcher__.tell({'content': unwatch_command})
-          unwatch_command = UnwatchEventCommand(name="Event-Name", value="CHANNEL_EXECUTE_COMPLETE")
-          self.__dispatcher__.tell({'content': unwatch_command})
+          self.unsubscribe()
           self.transition(to = 'complete')
 
         if name == 'CHANNEL_EXECUTE_COMPLETE' and call_uuid == self.get_call_uuid():
@@ -89,9 +91,6 @@ class Play(FiniteStateMachine, Switchlet):
           application_data = message.get_header('Application-Data')
           application_response = message.get_header('Application-Response')
           if application == 'playback' and application_data == self.__playback_path__ and application_response == 'FILE NOT FOUND':
-            unwatch_command = UnwatchEventCommand(name="Event-Name", value="PLAYBACK_STOP")
-            self.__dispatcher__.tell({'content': unwatch_command})
-            unwatch_command = UnwatchEventCommand(name="Event-Name", value="CHANNEL_EXECUTE_COMPLETE")
-            self.__dispatcher__.tell({'content': unwatch_command})
+            self.unsubscribe()
             self.__logger__.error("Playback failed for call %s and playback with argument %s" % (self.__call_uuid__, self.__playback_path__))
             self.transition(to = 'complete')
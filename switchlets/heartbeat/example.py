@@ -22,7 +22,7 @@
 from lib.commands import *
 from lib.core import *
 from lib.fsm import *
-from lib.server import Event, RegisterJobObserverCommand, UnregisterJobObserverCommand
+from lib.server import RegisterJobObserverCommand, UnregisterJobObserverCommand
 
 import logging
 import urllib
@@ -44,6 +44,15 @@ class Monitor(FiniteStateMachine, Switchlet):
     ('processing status event', 'expecting heartbeat')
   ]
 
+  triggers = [
+    ('not ready', InitializeSwitchletEvent, 'ready'),
+    ('ready', StartMonitorCommand, 'expecting heartbeat'),
+    ('expecting heartbeat', 'HEARTBEAT', 'expecting status response'),
+    ('expecting status response', 'command/reply', 'expecting status event'),
+    ('expecting status event', 'BACKGROUND_JOB', 'processing status event'),
+    ('processing status event', StartMonitorCommand, 'expecting heartbeat')
+  ]
+
   def __init__(self, *args, **kwargs):
     super(Monitor, self).__init__(*args, **kwargs)
     self.__logger__ = logging.getLogger('heartbeat.monitor')
@@ -79,18 +88,4 @@ class Monitor(FiniteStateMachine, Switchlet):
 
   def on_receive(self, message):
     # Necessary because all pykka messages must be dicts.
-    message = message.get('content')
-    if isinstance(message, InitializeSwitchletEvent):
-      self.transition(to = 'ready', event = message)
-    if isinstance(message, StartMonitorCommand):
-      self.transition(to = 'expecting heartbeat')
-    elif isinstance(message, Event):
-      content_type = message.get_header('Content-Type')
-      if content_type == 'command/reply':
-        self.transition(to = 'expecting status event', event = message)
-      elif content_type == 'text/event-plain':
-        name = message.get_header('Event-Name')
-        if name == 'HEARTBEAT':
-          self.transition(to = 'expecting status response', event = message)
-        elif name == 'BACKGROUND_JOB':
-          self.transition(to = 'processing status event', event = message)
+    self.trigger(message.get('content'))
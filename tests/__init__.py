@@ -20,6 +20,7 @@
 # Nishad Musthafa  <nishadmusthafa@gmail.com>
 
 from command_tests import *
+from esl_tests import *
 from conf.settings import *
 from switchlets.call_handlers import *
 from switchlets.call_utilities import *
@@ -0,0 +1,56 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thomas Quintana <quintana.thomas@gmail.com>
+
+from lib.core import *
+from lib.server import Dispatcher
+from pykka import ThreadingActor
+from unittest import TestCase, skipUnless
+
+try:
+  from pykka.gevent import GeventActor
+except ImportError:
+  GeventActor = None
+
+try:
+  from pykka.eventlet import EventletActor
+except ImportError:
+  EventletActor = None
+
+class ActorRuntimeTests(TestCase):
+  def test_threading_runtime(self):
+    self.assertTrue(get_actor_class('threading') is ThreadingActor)
+    self.assertTrue(issubclass(Switchlet, RuntimeActor))
+    self.assertTrue(issubclass(Dispatcher, RuntimeActor))
+
+  @skipUnless(GeventActor, 'gevent is not installed.')
+  def test_gevent_runtime(self):
+    self.assertTrue(get_actor_class('gevent') is GeventActor)
+
+  @skipUnless(EventletActor, 'eventlet is not installed.')
+  def test_eventlet_runtime(self):
+    self.assertTrue(get_actor_class('eventlet') is EventletActor)
+
+  def test_invalid_runtime(self):
+    self.assertRaises(ValueError, get_actor_class, 'fibers')
+
+  def test_invalid_runtime_message(self):
+    with self.assertRaises(ValueError) as context:
+      get_actor_class('fibers')
+    self.assertEqual('The actor runtime fibers is invalid. Possible values '
+      'are threading, gevent or eventlet.', str(context.exception))
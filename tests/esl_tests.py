@@ -0,0 +1,227 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thomas Quintana <quintana.thomas@gmail.com>
+
+from lib.esl import *
+from twisted.test.proto_helpers import StringTransport
+from unittest import TestCase
+
+import mock
+
+AUTH_REQUEST = 'Content-Type: auth/request\n\n'
+
+COMMAND_REPLY = 'Content-Type: command/reply\nReply-Text: +OK accepted\n\n'
+
+HEARTBEAT_EVENT = 'Event-Name: HEARTBEAT\nCore-UUID: 2a1f7f4e\n' \
+  'Event-Info: System%20Ready\nUp-Time: 0%20years,%200%20days\n\n'
+
+BACKGROUND_JOB_EVENT = 'Event-Name: BACKGROUND_JOB\n' \
+  'Job-UUID: 7f4db78a-17d7-11dd-b7a0-db4edd065621\n' \
+  'Job-Command: status\nContent-Length: 11\n\n+OK status\n'
+
+def plain_event(event):
+  return 'Content-Length: %i\nContent-Type: text/event-plain\n\n%s' % \
+    (len(event), event)
+
+class EventSocketParserTests(TestCase):
+  def test_headers_only(self):
+    parser = EventSocketParser()
+    parser.feed(AUTH_REQUEST + COMMAND_REPLY)
+    event = parser.next_event()
+    self.assertEquals(event.get_header('Content-Type'), 'auth/request')
+    self.assertEquals(event.get_body(), None)
+    event = parser.next_event()
+    self.assertEquals(event.get_header('Reply-Text'), '+OK accepted')
+    self.assertEquals(parser.next_event(), None)
+
+  def test_plain_event(self):
+    parser = EventSocketParser()
+    parser.feed(plain_event(HEARTBEAT_EVENT))
+    event = parser.next_event()
+    self.assertEquals(event.get_header('Content-Type'), 'text/event-plain')
+    self.assertEquals(event.get_header('Event-Name'), 'HEARTBEAT')
+    self.assertEquals(event.get_header('Event-Info'), 'System Ready')
+    self.assertEquals(event.get_header('Up-Time'), '0 years, 0 days')
+    self.assertFalse('Content-Length' in event.get_headers())
+    self.assertEquals(event.get_body(), None)
+
+  def test_plain_event_with_body(self):
+    parser = EventSocketParser()
+    parser.feed(plain_event(BACKGROUND_JOB_EVENT) + AUTH_REQUEST)
+    event = parser.next_event()
+    self.assertEquals(event.get_header('Job-Command'), 'status')
+    self.assertEquals(event.get_body(), '+OK status\n')
+    self.assertFalse('Content-Length' in event.get_headers())
+    event = parser.next_event()
+    self.assertEquals(event.get_header('Content-Type'), 'auth/request')
+
+  def test_api_response_body(self):
+    parser = EventSocketParser()
+    parser.feed('Content-Type: api/response\nContent-Length: 3\n\n+OK')
+    event = parser.next_event()
+    self.assertEquals(event.get_header('Content-Type'), 'api/response')
+    self.assertEquals(event.get_body(), '+OK')
+
+  def test_fragmented_data(self):
+    data = plain_event(BACKGROUND_JOB_EVENT) + plain_event(HEARTBEAT_EVENT)
+    parser = EventSocketParser(threshold = 16)
+    events = list()
+    for character in data:
+      parser.feed(character)
+      event = parser.next_event()
+      if event:
+        events.append(event)
+    self.assertEquals(len(events), 2)
+    self.assertEquals(events[0].get_body(), '+OK status\n')
+    self.assertEquals(events[1].get_header('Event-Name'), 'HEARTBEAT')
+    self.assertEquals(parser.next_event(), None)
+
+class LazyEventTests(TestCase):
+  def test_lazy_plain_event(self):
+    parser = EventSocketParser(lazy_headers = True)
+    parser.feed(plain_event(BACKGROUND_JOB_EVENT))
+    event = parser.next_event()
+    self.assertTrue(isinstance(event, LazyEvent))
+    self.assertEquals(event.get_header('Content-Type'), 'text/event-plain')
+    self.assertEquals(event.get_header('Event-Name'), 'BACKGROUND_JOB')
+    self.assertEquals(event.get_header('Content-Length'), None)
+    self.assertEquals(event.get_header('Bogus'), None)
+    self.assertEquals(event.get_body(), '+OK status\n')
+
+  def test_lazy_headers_match_eager_headers(self):
+    data = plain_event(HEARTBEAT_EVENT) + plain_event(BACKGROUND_JOB_EVENT)
+    eager = EventSocketParser()
+    eager.feed(data)
+    lazy = EventSocketParser(lazy_headers = True)
+    lazy.feed(data)
+    for index in range(2):
+      expected = eager.next_event()
+      event = lazy.next_event()
+      self.assertEquals(event.get_header('Up-Time'),
+        expected.get_header('Up-Time'))
+      self.assertEquals(event.get_headers(), expected.get_headers())
+      self.assertEquals(event.get_header('Job-UUID'),
+        expected.get_header('Job-UUID'))
+
+  def test_repeated_header(self):
+    event = LazyEvent({}, 'Name: first\nOther: value\nName: second%20value')
+    self.assertEquals(event.get_header('Name'), 'second value')
+    self.assertEquals(event.get_header('Other'), 'value')
+    self.assertEquals(event.get_headers(), parse_headers(
+      'Name: first\nOther: value\nName: second%20value'))
+
+class EventFormatTests(TestCase):
+  def test_json_event(self):
+    event = '{"Event-Name": "BACKGROUND_JOB", "Job-UUID": "7f4db78a", ' \
+      '"Event-Info": "System Ready", "Content-Length": "11", ' \
+      '"_body": "+OK status\\n"}'
+    parser = EventSocketParser()
+    parser.feed('Content-Length: %i\nContent-Type: text/event-json\n\n%s' %
+      (len(event), event))
+    event = parser.next_event()
+    self.assertTrue(event.get_header('Content-Type') in EVENT_CONTENT_TYPES)
+    self.assertEquals(event.get_header('Event-Name'), 'BACKGROUND_JOB')
+    self.assertEquals(event.get_header('Event-Info'), 'System Ready')
+    self.assertEquals(event.get_header('Content-Length'), None)
+    self.assertEquals(event.get_header('_body'), None)
+    self.assertEquals(event.get_body(), '+OK status\n')
+
+  def test_xml_event(self):
+    event = '<event>\n  <headers>\n' \
+      '    <Event-Name>BACKGROUND_JOB</Event-Name>\n' \
+      '    <Job-UUID>7f4db78a</Job-UUID>\n' \
+      '    <Event-Info>System Ready</Event-Info>\n' \
+      '  </headers>\n  <Content-Length>11</Content-Length>\n' \
+      '  <body>+OK status\n</body>\n</event>'
+    parser = EventSocketParser()
+    parser.feed('Content-Length: %i\nContent-Type: text/event-xml\n\n%s' %
+      (len(event), event))
+    event = parser.next_event()
+    self.assertTrue(event.get_header('Content-Type') in EVENT_CONTENT_TYPES)
+    self.assertEquals(event.get_header('Event-Name'), 'BACKGROUND_JOB')
+    self.assertEquals(event.get_header('Event-Info'), 'System Ready')
+    self.assertEquals(event.get_header('Content-Length'), None)
+    self.assertEquals(event.get_body(), '+OK status\n')
+
+  def test_encoded_event(self):
+    event = Event({'Content-Type': 'text/event-plain',
+      'Event-Name': 'BACKGROUND_JOB', 'Event-Info': 'System Ready\n\nx: y',
+      'Job-UUID': '7f4db78a'}, '+OK status\n')
+    reply = Event({'Content-Type': 'command/reply',
+      'Reply-Text': '+OK 100% accepted'})
+    for lazy_headers in [False, True]:
+      parser = EventSocketParser(lazy_headers = lazy_headers)
+      parser.feed(encode_event(event) + encode_event(reply))
+      decoded = parser.next_event()
+      self.assertEquals(decoded.get_headers(), event.get_headers())
+      self.assertEquals(decoded.get_body(), '+OK status\n')
+      decoded = parser.next_event()
+      self.assertEquals(decoded.get_header('Content-Type'), 'command/reply')
+      self.assertEquals(decoded.get_headers(), reply.get_headers())
+      self.assertEquals(decoded.get_body(), None)
+      self.assertEquals(parser.next_event(), None)
+
+class RecordingObserver(IEventSocketClientObserver):
+  def __init__(self):
+    self.batches = list()
+
+  def on_event(self, event):
+    self.batches.append([event])
+
+  def on_events(self, events):
+    self.batches.append(events)
+
+class EventSocketClientTests(TestCase):
+  def test_batch_events(self):
+    observer = RecordingObserver()
+    client = EventSocketClient(observer, batch_events = True)
+    client.makeConnection(StringTransport())
+    client.dataReceived(AUTH_REQUEST + plain_event(HEARTBEAT_EVENT) +
+      plain_event(BACKGROUND_JOB_EVENT)[:10])
+    client.dataReceived(plain_event(BACKGROUND_JOB_EVENT)[10:])
+    self.assertEquals(len(observer.batches), 2)
+    self.assertEquals(len(observer.batches[0]), 2)
+    self.assertEquals(len(observer.batches[1]), 1)
+    self.assertEquals(observer.batches[1][0].get_header('Event-Name'),
+      'BACKGROUND_JOB')
+
+  def test_unbatched_events(self):
+    observer = RecordingObserver()
+    client = EventSocketClient(observer)
+    client.makeConnection(StringTransport())
+    client.dataReceived(AUTH_REQUEST + plain_event(HEARTBEAT_EVENT))
+    self.assertEquals(len(observer.batches), 2)
+
+  def test_send_coalesces_commands(self):
+    transport = StringTransport()
+    client = EventSocketClient(RecordingObserver())
+    client.makeConnection(transport)
+    with mock.patch('lib.esl.reactor') as reactor:
+      client.send('api status\n\n')
+      client.send('api version\n\n')
+      self.assertEquals(reactor.callFromThread.call_count, 1)
+      self.assertEquals(transport.value(), '')
+      reactor.callFromThread.call_args[0][0]()
+      self.assertEquals(transport.value(), 'api status\n\napi version\n\n')
+      client.send('api uptime\n\n')
+      self.assertEquals(reactor.callFromThread.call_count, 2)
+      reactor.callFromThread.call_args[0][0]()
+    self.assertEquals(client.get_flushes(), 2)
+    self.assertEquals(client.get_commands_sent(), 3)
+    self.assertEquals(client.get_largest_flush(), 2)
+    self.assertEquals(client.get_bytes_sent(), len(transport.value()))
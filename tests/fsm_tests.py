@@ -17,9 +17,12 @@
 #
 # Thomas Quintana <quintana.thomas@gmail.com>
 
+from lib.esl import Event
 from lib.fsm import *
 from unittest import TestCase, expectedFailure
 
+import mock
+
 class AbstractLightBulb(FiniteStateMachine):
   # Initial state.
   initial_state = 'off'
@@ -60,6 +63,77 @@ class LightBulb(AbstractLightBulb):
   def smash(self, message):
     self.indicator = 'broken'
 
+class FluorescentLightBulb(LightBulb):
+  @Action(state = 'on')
+  def turn_on(self, message):
+    self.indicator = 'flickering'
+
+class CompiledLightBulb(LightBulb, CompiledFiniteStateMachine):
+  pass
+
+class LightBulbWithBadGuard(LightBulb):
+  @Guard(state = 'on')
+  def check_electricity(self):
+    return 'yes'
+
+class CompiledLightBulbWithBadGuard(LightBulbWithBadGuard,
+  CompiledFiniteStateMachine):
+  pass
+
+class HoldCommand(object):
+  pass
+
+class MusicOnHoldCommand(HoldCommand):
+  pass
+
+class Telephone(FiniteStateMachine):
+  initial_state = 'idle'
+
+  parent_states = {
+    'ringing': 'in call',
+    'talking': 'in call',
+    'on hold': 'talking'
+  }
+
+  transitions = [
+    ('idle', 'ringing'),
+    ('ringing', 'talking'),
+    ('talking', 'on hold'),
+    ('on hold', 'talking'),
+    ('in call', 'hung up')
+  ]
+
+  triggers = [
+    ('idle', 'CHANNEL_CREATE', 'ringing'),
+    ('ringing', 'CHANNEL_ANSWER', 'talking'),
+    ('talking', HoldCommand, 'on hold'),
+    ('on hold', HoldCommand, 'talking'),
+    ('in call', 'CHANNEL_HANGUP', 'hung up')
+  ]
+
+  @Action(state = 'hung up')
+  def hang_up(self, message):
+    self.hung_up_by = message
+
+class CompiledTelephone(Telephone, CompiledFiniteStateMachine):
+  pass
+
+class TelephoneWithInvalidTrigger(Telephone):
+  triggers = [
+    ('idle', 'CHANNEL_ANSWER', 'talking')
+  ]
+
+class TelephoneWithParentCycle(Telephone):
+  parent_states = {
+    'ringing': 'talking',
+    'talking': 'ringing'
+  }
+
+class LightBulbWithExitAction(LightBulb):
+  @Action(state = 'on', on_enter = False, on_exit = True)
+  def cool_down(self, message):
+    self.cooled_down = True
+
 class LightBulbWithMultipleGuards(AbstractLightBulb):
   @Guard(state = 'on')
   def check_electricity(self):
@@ -140,6 +214,15 @@ class LightBulbTests(TestCase):
     self.assertTrue(light_bulb.state() == 'off')
     self.assertFalse(hasattr(light_bulb, 'indicator'))
 
+  def test_enter_and_exit_actions(self):
+    light_bulb = LightBulbWithExitAction()
+    light_bulb.electricity = True
+    light_bulb.on_message('turn on')
+    self.assertTrue(light_bulb.indicator == 'lit')
+    self.assertFalse(hasattr(light_bulb, 'cooled_down'))
+    light_bulb.on_message('turn off')
+    self.assertTrue(light_bulb.cooled_down)
+
   def test_multiple_guards(self):
     light_bulb = None
     self.assertRaises(FiniteStateMachineError, LightBulbWithMultipleGuards)
@@ -163,4 +246,161 @@ class LightBulbTests(TestCase):
   def test_bad_guard_state(self):
     light_bulb = None
     self.assertRaises(FiniteStateMachineError, LightBulbWithBadGuardState)
-    self.assertTrue(light_bulb == None)
\ No newline at end of file
+    self.assertTrue(light_bulb == None)
+
+  def test_lookup_table_shared_by_instances(self):
+    light_bulb_a = LightBulb()
+    light_bulb_b = LightBulb()
+    self.assertTrue(light_bulb_a.__fsm_transition_table__ is \
+      light_bulb_b.__fsm_transition_table__)
+
+  def test_lookup_table_per_subclass(self):
+    light_bulb = LightBulb()
+    light_bulb.electricity = True
+    fluorescent_light_bulb = FluorescentLightBulb()
+    fluorescent_light_bulb.electricity = True
+    self.assertFalse(light_bulb.__fsm_transition_table__ is \
+      fluorescent_light_bulb.__fsm_transition_table__)
+    light_bulb.on_message('turn on')
+    fluorescent_light_bulb.on_message('turn on')
+    self.assertTrue(light_bulb.indicator == 'lit')
+    self.assertTrue(fluorescent_light_bulb.indicator == 'flickering')
+
+class CompiledLightBulbTests(TestCase):
+  def test_success_scenario(self):
+    light_bulb = CompiledLightBulb()
+    light_bulb.electricity = True
+    self.assertTrue(light_bulb.state() == 'off')
+    light_bulb.on_message('turn on')
+    self.assertTrue(light_bulb.state() == 'on')
+    self.assertTrue(light_bulb.indicator == 'lit')
+    light_bulb.on_message('turn off')
+    self.assertTrue(light_bulb.state() == 'off')
+    self.assertTrue(light_bulb.indicator == 'dim')
+
+  def test_invalid_transition(self):
+    light_bulb = CompiledLightBulb()
+    light_bulb.electricity = True
+    self.assertRaises(FiniteStateMachineError, light_bulb.on_message, 'turn off')
+    self.assertRaises(FiniteStateMachineError, light_bulb.transition, to = 'bogus')
+    self.assertTrue(light_bulb.state() == 'off')
+    self.assertFalse(hasattr(light_bulb, 'indicator'))
+
+  def test_terminal_state(self):
+    light_bulb = CompiledLightBulb()
+    light_bulb.on_message('break')
+    self.assertTrue(light_bulb.state() == 'broken')
+    try:
+      light_bulb.on_message('turn on')
+      self.fail()
+    except FiniteStateMachineError as error:
+      self.assertTrue('broken' in str(error))
+    self.assertTrue(light_bulb.state() == 'broken')
+
+  def test_guard_denial(self):
+    light_bulb = CompiledLightBulb()
+    self.assertRaises(FiniteStateMachineError, light_bulb.on_message, 'turn on')
+    self.assertTrue(light_bulb.state() == 'off')
+    light_bulb = CompiledLightBulbWithBadGuard()
+    self.assertRaises(FiniteStateMachineError, light_bulb.on_message, 'turn on')
+    self.assertTrue(light_bulb.state() == 'off')
+
+  def test_bad_action_state(self):
+    class CompiledLightBulbWithBadActionState(LightBulbWithBadActionState,
+      CompiledFiniteStateMachine):
+      pass
+    self.assertRaises(FiniteStateMachineError, CompiledLightBulbWithBadActionState)
+
+class TransitionTracingTests(TestCase):
+  def tearDown(self):
+    set_transition_sink(None)
+
+  def test_tracing_turned_off(self):
+    light_bulb = CompiledLightBulb()
+    light_bulb.on_message('break')
+    self.assertFalse(hasattr(light_bulb, '__fsm_entered__'))
+
+  def test_transition_histogram(self):
+    histogram = TransitionHistogram(buckets = [1, 1000])
+    set_transition_sink(histogram)
+    for klass in [LightBulb, CompiledLightBulb]:
+      light_bulb = klass()
+      light_bulb.electricity = True
+      light_bulb.on_message('turn on')
+      light_bulb.on_message('turn off')
+      light_bulb.on_message('break')
+      counts = histogram.get_transition_counts().get(klass.__name__)
+      self.assertEquals(counts, {('off', 'on'): 1, ('on', 'off'): 1,
+        ('off', 'broken'): 1})
+      dwell_times = histogram.get_dwell_times().get(klass.__name__)
+      self.assertEquals(dwell_times.get('off').get('count'), 2)
+      self.assertEquals(dwell_times.get('on').get('count'), 1)
+      self.assertEquals(dict(dwell_times.get('off').get('buckets')),
+        {1: 2, 1000: 0, None: 0})
+      self.assertFalse(dwell_times.has_key('broken'))
+
+  def test_transition_histogram_with_tuple_buckets(self):
+    histogram = TransitionHistogram(buckets = (1, 1000))
+    set_transition_sink(histogram)
+    light_bulb = LightBulb()
+    light_bulb.on_message('break')
+    dwell_times = histogram.get_dwell_times().get('LightBulb')
+    self.assertEquals(dict(dwell_times.get('off').get('buckets')),
+      {1: 1, 1000: 0, None: 0})
+
+  def test_unknown_dwell_time(self):
+    sink = TransitionSink()
+    light_bulb = LightBulb()
+    set_transition_sink(sink)
+    with mock.patch.object(sink, 'on_transition') as on_transition:
+      light_bulb.on_message('break')
+      self.assertEquals(on_transition.call_args[0][1:3], ('off', 'broken'))
+      self.assertEquals(on_transition.call_args[0][4], None)
+
+class TriggerTests(TestCase):
+  def create_event(self, name):
+    return Event({'Content-Type': 'text/event-plain', 'Event-Name': name})
+
+  def test_triggers(self):
+    for klass in [Telephone, CompiledTelephone]:
+      telephone = klass()
+      self.assertFalse(telephone.trigger(self.create_event('CHANNEL_ANSWER')))
+      self.assertTrue(telephone.state() == 'idle')
+      self.assertTrue(telephone.trigger(self.create_event('CHANNEL_CREATE')))
+      self.assertTrue(telephone.state() == 'ringing')
+      self.assertFalse(telephone.trigger(HoldCommand()))
+      self.assertTrue(telephone.trigger(self.create_event('CHANNEL_ANSWER')))
+      self.assertTrue(telephone.state() == 'talking')
+
+  def test_triggers_match_subclasses(self):
+    telephone = Telephone()
+    telephone.trigger(self.create_event('CHANNEL_CREATE'))
+    telephone.trigger(self.create_event('CHANNEL_ANSWER'))
+    self.assertTrue(telephone.trigger(MusicOnHoldCommand()))
+    self.assertTrue(telephone.state() == 'on hold')
+
+  def test_nested_states(self):
+    for klass in [Telephone, CompiledTelephone]:
+      telephone = klass()
+      self.assertFalse(telephone.in_state('in call'))
+      telephone.trigger(self.create_event('CHANNEL_CREATE'))
+      telephone.trigger(self.create_event('CHANNEL_ANSWER'))
+      telephone.trigger(HoldCommand())
+      self.assertTrue(telephone.state() == 'on hold')
+      self.assertTrue(telephone.in_state('talking'))
+      self.assertTrue(telephone.in_state('in call'))
+      # Triggers declared for a nested state win over its parents.
+      telephone.trigger(HoldCommand())
+      self.assertTrue(telephone.state() == 'talking')
+      telephone.trigger(HoldCommand())
+      # Nested states take the transitions and triggers of their parents.
+      hang_up = self.create_event('CHANNEL_HANGUP')
+      self.assertTrue(telephone.trigger(hang_up))
+      self.assertTrue(telephone.state() == 'hung up')
+      self.assertTrue(telephone.hung_up_by is hang_up)
+
+  def test_invalid_trigger(self):
+    self.assertRaises(FiniteStateMachineError, TelephoneWithInvalidTrigger)
+
+  def test_parent_cycle(self):
+    self.assertRaises(FiniteStateMachineError, TelephoneWithParentCycle)
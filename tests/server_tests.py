@@ -22,6 +22,8 @@ from lib.server import *
 from pykka import ActorRegistry, ThreadingActor
 from unittest import TestCase
 
+import cPickle, mock, os
+
 class AuthCommandTests(TestCase):
   def test_success_scenario(self):
     command = AuthCommand('ClueCon')
@@ -39,6 +41,716 @@ class EventsCommandTests(TestCase):
   def test_invalid_format(self):
     self.assertRaises(ValueError, EventsCommand, ['BACKGROUD_JOB'], format = 'invalid')
 
+class FilterCommandTests(TestCase):
+  def test_success_scenario(self):
+    command = FilterCommand('Event-Name', 'HEARTBEAT')
+    self.assertTrue(str(command) == 'filter Event-Name HEARTBEAT\n\n')
+
+  def test_delete_success_scenario(self):
+    command = FilterDeleteCommand('Event-Name', 'HEARTBEAT')
+    self.assertTrue(str(command) == 'filter delete Event-Name HEARTBEAT\n\n')
+
+class DispatcherFilterTests(TestCase):
+  def initialize_dispatcher(self):
+    client = mock.Mock()
+    dispatcher = Dispatcher()
+    dispatcher.on_receive({'content': InitializeDispatcherEvent(None, client, None)})
+    dispatcher.__initialize__(None)
+    return dispatcher, [str(call[0][0]) for call in client.send.call_args_list]
+
+  def test_rule_filters(self):
+    dispatcher, commands = self.initialize_dispatcher()
+    self.assertTrue('filter Event-Name BACKGROUND_JOB\n\n' in commands)
+    for rule in dispatch_rules:
+      self.assertTrue('filter %s %s\n\n' % (rule.get('header_name'),
+        rule.get('header_value')) in commands)
+
+  @mock.patch('lib.server.dispatch_rules', [])
+  def test_heartbeat_filter(self):
+    dispatcher, commands = self.initialize_dispatcher()
+    # The node status needs the HEARTBEAT events to measure the load.
+    self.assertTrue('filter Event-Name HEARTBEAT\n\n' in commands)
+    dispatcher = Dispatcher(shard = 1, shards = 2)
+    self.assertFalse(('Event-Name', 'HEARTBEAT') in dispatcher.__filters__)
+
+  def test_watch_filters(self):
+    dispatcher, commands = self.initialize_dispatcher()
+    client = dispatcher.__client__
+    client.reset_mock()
+    watch = WatchEventCommand(object(), name = 'Event-Name', value = 'PLAYBACK_STOP')
+    dispatcher.on_receive({'content': watch})
+    dispatcher.on_receive({'content': watch})
+    self.assertEquals(client.send.call_count, 1)
+    self.assertEquals(str(client.send.call_args[0][0]),
+      'filter Event-Name PLAYBACK_STOP\n\n')
+    unwatch = UnwatchEventCommand(name = 'Event-Name', value = 'PLAYBACK_STOP')
+    dispatcher.on_receive({'content': unwatch})
+    self.assertEquals(client.send.call_count, 1)
+    dispatcher.on_receive({'content': unwatch})
+    self.assertEquals(client.send.call_count, 2)
+    self.assertEquals(str(client.send.call_args[0][0]),
+      'filter delete Event-Name PLAYBACK_STOP\n\n')
+
+class WatchRegistryTests(TestCase):
+  def test_add_and_remove(self):
+    registry = WatchRegistry()
+    watch = WatchEventCommand(object(), name = 'Event-Name', value = 'PLAYBACK_STOP')
+    registry.add(watch)
+    self.assertEquals(len(registry), 1)
+    self.assertEquals(registry.get_matches(Event({'Event-Name': 'PLAYBACK_STOP'})),
+      [watch])
+    self.assertTrue(registry.remove(watch))
+    self.assertFalse(registry.remove(watch))
+    self.assertEquals(len(registry), 0)
+    self.assertEquals(registry.get_matches(Event({'Event-Name': 'PLAYBACK_STOP'})),
+      [])
+
+  def test_delivers_to_every_match(self):
+    registry = WatchRegistry()
+    watches = [
+      WatchEventCommand(object(), name = 'Event-Name', value = 'PLAYBACK_STOP'),
+      WatchEventCommand(object(), name = 'Event-Name', value = 'PLAYBACK_STOP'),
+      WatchEventCommand(object(), name = 'Event-Name', pattern = '^PLAYBACK'),
+      WatchEventCommand(object(), name = 'Event-Name', value = 'CHANNEL_ANSWER')
+    ]
+    for watch in watches:
+      registry.add(watch)
+    matches = registry.get_matches(Event({'Event-Name': 'PLAYBACK_STOP'}))
+    self.assertEquals(matches, watches[:3])
+
+  def test_find(self):
+    registry = WatchRegistry()
+    observer = object()
+    mine = WatchEventCommand(observer, name = 'Event-Name', value = 'PLAYBACK_STOP')
+    theirs = WatchEventCommand(object(), name = 'Event-Name', value = 'PLAYBACK_STOP')
+    pattern = WatchEventCommand(observer, name = 'Event-Name', pattern = '^PLAY')
+    for watch in [mine, theirs, pattern]:
+      registry.add(watch)
+    self.assertEquals(registry.find('Event-Name', value = 'PLAYBACK_STOP'), theirs)
+    self.assertEquals(registry.find('Event-Name', value = 'PLAYBACK_STOP',
+      observer = observer), mine)
+    self.assertEquals(registry.find('Event-Name', pattern = '^PLAY'), pattern)
+    self.assertEquals(registry.find('Event-Name', pattern = '^CHANNEL'), None)
+
+  def test_unwatch_by_handle(self):
+    dispatcher = Dispatcher()
+    observer = mock.Mock()
+    watch = WatchEventCommand(observer, name = 'Event-Name', value = 'PLAYBACK_STOP')
+    dispatcher.on_receive({'content': watch})
+    event = Event({'Event-Name': 'PLAYBACK_STOP'})
+    self.assertTrue(dispatcher.__dispatch_incoming_using_watches__(event))
+    dispatcher.on_receive({'content': UnwatchEventCommand(watch = watch)})
+    self.assertFalse(dispatcher.__dispatch_incoming_using_watches__(event))
+    self.assertEquals(observer.tell.call_count, 1)
+
+class SubscriptionTests(TestCase):
+  __uuid__ = 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6'
+
+  def test_subscribe_and_unsubscribe(self):
+    dispatcher = Dispatcher()
+    client = mock.Mock()
+    dispatcher.on_receive({'content': InitializeDispatcherEvent(None, client, None)})
+    dispatcher.__initialize__(None)
+    client.reset_mock()
+    observer = mock.Mock()
+    subscription = SubscribeCallEventsCommand(observer, self.__uuid__,
+      ['PLAYBACK_STOP'])
+    dispatcher.on_receive({'content': subscription})
+    self.assertEquals(str(client.send.call_args[0][0]),
+      'filter Channel-Call-UUID %s\n\n' % self.__uuid__)
+    stop = Event({'Event-Name': 'PLAYBACK_STOP',
+                  'Channel-Call-UUID': self.__uuid__})
+    other_call = Event({'Event-Name': 'PLAYBACK_STOP',
+                        'Channel-Call-UUID': '0a1d4fae-7dec-11d0-a765-00a0c91e6bf6'})
+    other_event = Event({'Event-Name': 'CHANNEL_ANSWER',
+                         'Channel-Call-UUID': self.__uuid__})
+    self.assertTrue(dispatcher.__dispatch_incoming_using_subscriptions__(stop))
+    self.assertFalse(dispatcher.__dispatch_incoming_using_subscriptions__(other_call))
+    self.assertFalse(dispatcher.__dispatch_incoming_using_subscriptions__(other_event))
+    self.assertEquals(observer.tell.call_count, 1)
+    dispatcher.on_receive({'content': UnsubscribeCallEventsCommand(subscription)})
+    self.assertEquals(str(client.send.call_args[0][0]),
+      'filter delete Channel-Call-UUID %s\n\n' % self.__uuid__)
+    self.assertFalse(dispatcher.__dispatch_incoming_using_subscriptions__(stop))
+
+  def test_pool_routing(self):
+    dispatchers = [mock.Mock(), mock.Mock()]
+    pool = DispatcherPool(dispatchers)
+    subscription = SubscribeCallEventsCommand(object(), self.__uuid__,
+      ['PLAYBACK_STOP'])
+    pool.tell({'content': subscription})
+    pool.tell({'content': UnsubscribeCallEventsCommand(subscription)})
+    self.assertEquals(dispatchers[0].tell.call_count, 0)
+    self.assertEquals(dispatchers[1].tell.call_count, 2)
+
+class ShardTests(TestCase):
+  def test_shard_digits_are_disjoint(self):
+    for shards in range(1, 17):
+      digits = ''.join([shard_digits(shard, shards) for shard in range(shards)])
+      self.assertEquals(digits, UUID_DIGITS)
+
+  def test_shard_for_uuid(self):
+    for shards in range(1, 17):
+      for shard in range(shards):
+        for digit in shard_digits(shard, shards):
+          self.assertEquals(shard_for_uuid(digit + '1b2c3d4', shards), shard)
+          self.assertEquals(shard_for_uuid(digit.upper() + '1b2c3d4', shards), shard)
+          self.assertEquals(shard_for_uuid('1b2c3d4' + digit, shards, -1), shard)
+
+class DispatcherPoolTests(TestCase):
+  def test_routing(self):
+    dispatchers = [mock.Mock(), mock.Mock()]
+    pool = DispatcherPool(dispatchers)
+    command = KillCommand(object(), 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6')
+    pool.tell({'content': command})
+    self.assertEquals(dispatchers[0].tell.call_count, 0)
+    self.assertEquals(dispatchers[1].tell.call_count, 1)
+    observer = RegisterJobObserverCommand(object(), '0a1d4fae')
+    pool.tell({'content': observer})
+    self.assertEquals(dispatchers[0].tell.call_count, 1)
+    watch = WatchEventCommand(object(), name = 'Event-Name', value = 'PLAYBACK_STOP')
+    pool.tell({'content': watch})
+    self.assertEquals(dispatchers[0].tell.call_count, 2)
+    self.assertEquals(dispatchers[1].tell.call_count, 2)
+
+  def test_sharded_dispatcher_filters(self):
+    dispatcher = Dispatcher(shard = 1, shards = 2)
+    client = mock.Mock()
+    dispatcher.on_receive({'content': InitializeDispatcherEvent(None, client, None)})
+    dispatcher.__initialize__(None)
+    commands = [str(call[0][0]) for call in client.send.call_args_list]
+    self.assertEquals(len(commands), 3)
+    self.assertTrue('filter Channel-Call-UUID /^[89abcdefABCDEF]/\n\n' in commands)
+    self.assertTrue('filter Job-UUID /^[89abcdefABCDEF]/\n\n' in commands)
+
+class ShardedDispatcherTests(TestCase):
+  def create_dispatcher(self):
+    dispatchers = [mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock()]
+    return ShardedDispatcher(dispatchers), dispatchers
+
+  def get_recipients(self, dispatchers):
+    return [index for index, dispatcher in enumerate(dispatchers)
+      if dispatcher.tell.called]
+
+  def test_call_affinity(self):
+    sharded, dispatchers = self.create_dispatcher()
+    for name in ['CHANNEL_CREATE', 'CHANNEL_ANSWER', 'CHANNEL_HANGUP']:
+      sharded.tell({'content': Event({'Event-Name': name,
+        'Channel-Call-UUID': 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6'})})
+    self.assertEquals(len(self.get_recipients(dispatchers)), 1)
+
+  def test_command_reply_returns_to_sender(self):
+    sharded, dispatchers = self.create_dispatcher()
+    command = KillCommand(object(), 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6')
+    sharded.tell({'content': command})
+    sender = self.get_recipients(dispatchers)
+    for dispatcher in dispatchers:
+      dispatcher.reset_mock()
+    reply = Event({'Content-Type': 'command/reply',
+      'Reply-Text': '+OK Job-UUID: %s' % command.get_job_uuid(),
+      'Job-UUID': command.get_job_uuid()})
+    sharded.tell({'content': reply})
+    self.assertEquals(self.get_recipients(dispatchers), sender)
+
+  def test_event_batch_is_split(self):
+    sharded, dispatchers = self.create_dispatcher()
+    events = [Event({'Event-Name': 'HEARTBEAT'})]
+    for digit in '0123456789abcdef':
+      events.append(Event({'Event-Name': 'CHANNEL_CREATE',
+        'Channel-Call-UUID': '%s1d4fae-7dec-11d0-a765-00a0c91e6bf6' % digit}))
+    sharded.tell({'content': EventBatch(events)})
+    delivered = list()
+    for dispatcher in dispatchers:
+      received = list()
+      for call in dispatcher.tell.call_args_list:
+        content = call[0][0].get('content')
+        if isinstance(content, EventBatch):
+          received.extend(content.get_events())
+        else:
+          received.append(content)
+      delivered.append(received)
+    self.assertEquals(sorted(sum(delivered, [])), sorted(events))
+    self.assertTrue(len(self.get_recipients(dispatchers)) > 1)
+    # Events without a call are handled by the connection owner.
+    self.assertTrue(events[0] in delivered[0])
+
+  def test_threads_of_a_connection_share_its_calls(self):
+    # The calls of the first of 4 connections start with 0 through 3.
+    uuids = ['%s1d4fae-7dec-11d0-a765-00a0c91e6bf%s' % (first, last)
+      for first in '0123' for last in UUID_DIGITS]
+    shards = set([shard_for_uuid(uuid, 4, -1) for uuid in uuids])
+    self.assertEquals(shards, set(range(4)))
+
+  def test_mailbox_depth(self):
+    sharded, dispatchers = self.create_dispatcher()
+    for depth, dispatcher in enumerate(dispatchers):
+      dispatcher.get_mailbox_depth.return_value = depth
+    other = mock.Mock()
+    other.get_mailbox_depth.return_value = 1
+    self.assertEquals(sharded.get_mailbox_depth(), 3)
+    self.assertEquals(DispatcherPool([other, sharded]).get_mailbox_depth(), 3)
+    dispatcher = Dispatcher.start()
+    try:
+      self.assertTrue(isinstance(dispatcher, DispatcherRef))
+      self.assertEquals(dispatcher.get_mailbox_depth(), 0)
+    finally:
+      dispatcher.stop()
+
+  def test_lifecycle_is_broadcast(self):
+    sharded, dispatchers = self.create_dispatcher()
+    sharded.tell({'content': InitializeDispatcherEvent(None, None, None)})
+    sharded.tell({'content': KillDispatcherEvent()})
+    for dispatcher in dispatchers:
+      self.assertEquals(dispatcher.tell.call_count, 2)
+
+  def test_shard_starts_when_ready(self):
+    shard = DispatcherShard()
+    client = mock.Mock()
+    shard.on_receive({'content': InitializeDispatcherEvent(None, client, None)})
+    observer = mock.Mock()
+    shard.on_receive({'content': SubscribeCallEventsCommand(observer,
+      'f81d4fae-7dec-11d0-a765-00a0c91e6bf6', ['CHANNEL_ANSWER'])})
+    self.assertEquals(shard.state(), 'not ready')
+    self.assertFalse(client.send.called)
+    shard.on_receive({'content': DispatcherReadyEvent()})
+    self.assertEquals(shard.state(), 'dispatching')
+    self.assertEquals([str(call[0][0]) for call in client.send.call_args_list],
+      ['filter Channel-Call-UUID f81d4fae-7dec-11d0-a765-00a0c91e6bf6\n\n'])
+
+  @mock.patch('lib.server.event_socket_filters', False)
+  def test_shard_without_filters(self):
+    shard = DispatcherShard()
+    client = mock.Mock()
+    shard.on_receive({'content': InitializeDispatcherEvent(None, client, None)})
+    observer = mock.Mock()
+    shard.on_receive({'content': SubscribeCallEventsCommand(observer,
+      'f81d4fae-7dec-11d0-a765-00a0c91e6bf6', ['CHANNEL_ANSWER'])})
+    shard.on_receive({'content': DispatcherReadyEvent()})
+    shard.on_receive({'content': SubscribeCallEventsCommand(observer,
+      '0a1b2c3d-7dec-11d0-a765-00a0c91e6bf6', ['CHANNEL_ANSWER'])})
+    self.assertEquals(shard.state(), 'dispatching')
+    self.assertFalse(client.send.called)
+
+  def test_watch_filters(self):
+    sent = dict()
+    for klass in [DispatcherShard, WorkerDispatcher]:
+      shard = klass()
+      client = mock.Mock()
+      shard.on_receive({'content': InitializeDispatcherEvent(None, client, None)})
+      shard.on_receive({'content': DispatcherReadyEvent()})
+      watch = WatchEventCommand(object(), name = 'Event-Name',
+        value = 'PLAYBACK_STOP')
+      shard.__add_watch__(watch)
+      shard.__remove_watch__(watch)
+      sent.update({klass: [str(call[0][0])
+        for call in client.send.call_args_list]})
+    self.assertEquals(sent[DispatcherShard], [])
+    self.assertEquals(sent[WorkerDispatcher], [
+      'filter Event-Name PLAYBACK_STOP\n\n',
+      'filter delete Event-Name PLAYBACK_STOP\n\n'])
+
+  def test_shard_keeps_events_until_ready(self):
+    shard = DispatcherShard()
+    shard.on_receive({'content': InitializeDispatcherEvent(None, mock.Mock(),
+      None)})
+    events = [Event({'Content-Type': 'text/event-plain', 'Event-Name': name,
+      'Unique-ID': 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6'})
+      for name in ['CHANNEL_CREATE', 'CHANNEL_ANSWER']]
+    with mock.patch.object(Dispatcher, '__on_event__') as on_event:
+      shard.on_receive({'content': EventBatch(events)})
+      self.assertFalse(on_event.called)
+      shard.on_receive({'content': DispatcherReadyEvent()})
+      self.assertEquals([call[0][0] for call in on_event.call_args_list],
+        events)
+
+class WorkerFrontTests(TestCase):
+  __uuid__ = 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6'
+
+  @mock.patch('lib.server.Dispatcher')
+  def create_front(self, dispatcher):
+    connect = mock.Mock()
+    front = WorkerFront(freeswitch_hosts[0], NodeStatus('node-1'), 2, connect)
+    workers = [mock.Mock(), mock.Mock()]
+    for index, worker in enumerate(workers):
+      self.assertFalse(connect.called)
+      front.add_worker(index, worker)
+    self.assertTrue(connect.called)
+    client = mock.Mock()
+    front.on_start(client)
+    return front, dispatcher.start.return_value, workers, client
+
+  def test_workers_and_shards_share_the_calls(self):
+    front, dispatcher, workers, client = self.create_front()
+    shards = [mock.Mock() for shard in range(2)]
+    sharded = ShardedDispatcher(shards, -2)
+    reached = set()
+    for first in UUID_DIGITS:
+      for second in UUID_DIGITS:
+        uuid = 'f81d4fae-7dec-11d0-a765-00a0c91e6b%s%s' % (first, second)
+        event = Event({'Content-Type': 'text/event-plain',
+          'Event-Name': 'CHANNEL_ANSWER', 'Unique-ID': uuid})
+        reached.add((front.__route__(event),
+          shards.index(sharded.__route_event__(event))))
+    self.assertEquals(reached, set([(worker, shard)
+      for worker in range(2) for shard in range(2)]))
+
+  def get_events(self, worker):
+    events = list()
+    for call in worker.send_frame.call_args_list:
+      frame = call[0][0]
+      if frame[0] == 'events':
+        events.extend(frame[1])
+    return events
+
+  def test_call_affinity(self):
+    front, dispatcher, workers, client = self.create_front()
+    events = [Event({'Content-Type': 'text/event-plain', 'Event-Name': name,
+      'Channel-Call-UUID': self.__uuid__}) for name in
+      ['CHANNEL_CREATE', 'CHANNEL_ANSWER', 'CHANNEL_HANGUP']]
+    front.on_events(events)
+    index = shard_for_uuid(self.__uuid__, 2, -1)
+    self.assertEquals(self.get_events(workers[index]), events)
+    self.assertEquals(self.get_events(workers[1 - index]), [])
+    heartbeat = Event({'Content-Type': 'text/event-plain',
+      'Event-Name': 'HEARTBEAT', 'Max-Sessions': '1000', 'Session-Count': '1'})
+    front.on_event(heartbeat)
+    self.assertTrue(heartbeat in self.get_events(workers[0]))
+
+  def test_replies_return_to_sender(self):
+    front, dispatcher, workers, client = self.create_front()
+    dispatcher.reset_mock()
+    front.send(AuthCommand('ClueCon'))
+    front.on_worker_frame(1, ('command', 'job-1', 'bgapi status\nJob-UUID: job-1\n\n'))
+    self.assertEquals(client.send.call_count, 2)
+    accepted = Event({'Content-Type': 'command/reply',
+      'Reply-Text': '+OK accepted'})
+    job = Event({'Content-Type': 'command/reply', 'Job-UUID': 'job-1',
+      'Reply-Text': '+OK Job-UUID: job-1'})
+    front.on_events([accepted, job])
+    self.assertEquals(dispatcher.tell.call_args[0][0].get('content'), accepted)
+    self.assertEquals(self.get_events(workers[1]), [job])
+    completed = Event({'Content-Type': 'text/event-plain',
+      'Event-Name': 'BACKGROUND_JOB', 'Job-UUID': 'job-1'})
+    front.on_event(completed)
+    self.assertEquals(self.get_events(workers[1]), [job, completed])
+
+  def test_filters_are_merged_by_the_dispatcher(self):
+    front, dispatcher, workers, client = self.create_front()
+    command = FilterCommand('Channel-Call-UUID', self.__uuid__)
+    front.on_worker_frame(0, ('filter', command))
+    self.assertEquals(dispatcher.tell.call_args[0][0].get('content'), command)
+    self.assertFalse(client.send.called)
+
+  def test_ready(self):
+    front, dispatcher, workers, client = self.create_front()
+    with mock.patch('lib.server.reactor') as reactor:
+      front.tell({'content': DispatcherReadyEvent()})
+      reactor.callFromThread.call_args[0][0]()
+    for worker in workers:
+      worker.send_frame.assert_called_with(('ready',))
+
+class WorkerFilterTests(TestCase):
+  def test_worker_filters_share_reference_counts(self):
+    dispatcher = Dispatcher()
+    client = mock.Mock()
+    dispatcher.on_receive({'content': InitializeDispatcherEvent(None, client, None)})
+    dispatcher.__initialize__(None)
+    client.reset_mock()
+    dispatcher.on_receive({'content': FilterCommand('Event-Name', 'BACKGROUND_JOB')})
+    dispatcher.on_receive({'content': FilterDeleteCommand('Event-Name', 'BACKGROUND_JOB')})
+    self.assertFalse(client.send.called)
+    dispatcher.on_receive({'content': FilterCommand('Unique-ID', 'a')})
+    dispatcher.on_receive({'content': FilterDeleteCommand('Unique-ID', 'a')})
+    self.assertEquals([str(call[0][0]) for call in client.send.call_args_list],
+      ['filter Unique-ID a\n\n', 'filter delete Unique-ID a\n\n'])
+
+  @mock.patch('lib.server.reactor')
+  def test_front_connection_frames(self, reactor):
+    connection = FrontConnection(0, None, mock.Mock(), [], None)
+    connection.send(FilterCommand('Unique-ID', 'a'))
+    frame = reactor.callFromThread.call_args[0][1]
+    self.assertEquals(frame[0], 'filter')
+    self.assertEquals(str(frame[1]), 'filter Unique-ID a\n\n')
+    command = KillCommand(object(), 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6')
+    connection.send(command)
+    frame = reactor.callFromThread.call_args[0][1]
+    self.assertEquals(frame, ('command', command.get_job_uuid(), str(command)))
+
+class WorkerFrameTests(TestCase):
+  def test_frames(self):
+    event = Event({'Content-Type': 'text/event-plain',
+      'Event-Name': 'CHANNEL_CREATE', 'Unique-ID': 'a'})
+    frame = decode_frame(encode_frame(('events', [event, event])))
+    self.assertEquals(frame[0], 'events')
+    self.assertEquals([decoded.get_headers() for decoded in frame[1]],
+      [event.get_headers(), event.get_headers()])
+    command = 'bgapi status\nJob-UUID: job-1\n\n'
+    self.assertEquals(decode_frame(encode_frame(('command', 'job-1', command))),
+      ('command', 'job-1', command))
+    self.assertEquals(decode_frame(encode_frame(('command', None, command))),
+      ('command', None, command))
+    frame = decode_frame(encode_frame(('filter',
+      FilterDeleteCommand('Unique-ID', 'a'))))
+    self.assertTrue(isinstance(frame[1], FilterDeleteCommand))
+    self.assertEquals(str(frame[1]), 'filter delete Unique-ID a\n\n')
+    frame = decode_frame(encode_frame(('filter', FilterCommand('Unique-ID', 'a'))))
+    self.assertFalse(isinstance(frame[1], FilterDeleteCommand))
+    self.assertEquals(decode_frame(encode_frame(('hello', 3))), ('hello', 3))
+    self.assertEquals(decode_frame(encode_frame(('ready',))), ('ready',))
+
+  def test_pickles_are_not_loaded(self):
+    data = cPickle.dumps(('hello', 0), cPickle.HIGHEST_PROTOCOL)
+    self.assertEquals(len(decode_frame(data)), 1)
+
+  def test_worker_socket_name(self):
+    self.assertEquals(worker_socket_name('../node 1', 0), '0-.._node_1.sock')
+
+  @mock.patch('lib.server.reactor')
+  def test_worker_socket_directory(self, reactor):
+    server = FreepyServer()
+    directory = server.__get_socket_directory__()
+    try:
+      self.assertEquals(os.stat(directory).st_mode & 0777, 0700)
+      self.assertEquals(server.__get_socket_directory__(), directory)
+    finally:
+      os.rmdir(directory)
+
+class ExpiringMapTests(TestCase):
+  @mock.patch('lib.server.monotonic')
+  def test_expiry(self, monotonic):
+    monotonic.return_value = 100.0
+    entries = ExpiringMap(10)
+    entries.put('a', 1)
+    monotonic.return_value = 105.5
+    entries.put('b', 2)
+    self.assertEquals(entries.pop('a'), 1)
+    monotonic.return_value = 114.0
+    self.assertEquals(entries.get('b'), 2)
+    entries.put('a', 3)
+    monotonic.return_value = 115.0
+    self.assertEquals(entries.get('b'), None)
+    self.assertEquals(entries.pop('b', 0), 0)
+    self.assertEquals(len(entries), 1)
+    monotonic.return_value = 200.0
+    self.assertEquals(len(entries), 0)
+    entries.put('c', 4)
+    self.assertEquals(entries.get('c'), 4)
+
+  @mock.patch('lib.server.monotonic')
+  def test_lost_replies_are_forgotten(self, monotonic):
+    monotonic.return_value = 0.0
+    dispatchers = [mock.Mock(), mock.Mock()]
+    sharded = ShardedDispatcher(dispatchers)
+    for index in range(100):
+      sharded.tell({'content': KillCommand(object(),
+        'f81d4fae-7dec-11d0-a765-00a0c91e6bf%i' % (index % 10))})
+    monotonic.return_value = float(dispatcher_transaction_ttl)
+    reply = Event({'Content-Type': 'command/reply', 'Job-UUID': 'a',
+      'Reply-Text': '+OK'})
+    sharded.tell({'content': reply})
+    self.assertEquals(len(sharded.__senders__), 0)
+
+class ExpiryWheelTests(TestCase):
+  def test_expiry(self):
+    wheel = ExpiryWheel(size = 4)
+    wheel.add('a', 1)
+    wheel.add('b', 3)
+    wheel.add('c', 10)
+    wheel.add('d', 2)
+    self.assertTrue(wheel.remove('d'))
+    self.assertFalse(wheel.remove('d'))
+    expired = list()
+    for tick in range(10):
+      expired.append(wheel.tick())
+    self.assertEquals(expired, [['a'], [], ['b'], [], [], [], [], [], [], ['c']])
+    self.assertEquals(len(wheel), 0)
+
+  def test_reset(self):
+    wheel = ExpiryWheel(size = 4)
+    wheel.add('a', 1)
+    wheel.add('a', 2)
+    self.assertEquals(len(wheel), 1)
+    self.assertEquals(wheel.tick(), [])
+    self.assertEquals(wheel.tick(), ['a'])
+
+class ExpiryTests(TestCase):
+  def create_dispatcher(self):
+    status = NodeStatus('node-1')
+    dispatcher = Dispatcher(status = status)
+    dispatcher.on_receive({'content': InitializeDispatcherEvent(None, mock.Mock(), None)})
+    return dispatcher, status
+
+  @mock.patch('lib.server.dispatcher_transaction_ttl', 2)
+  def test_transaction_expiry(self):
+    dispatcher, status = self.create_dispatcher()
+    sender = mock.Mock()
+    answered = KillCommand(sender, 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6')
+    forgotten = KillCommand(sender, 'f81d4fae-7dec-11d0-a765-00a0c91e6bf6')
+    dispatcher.__dispatch_command__(answered)
+    dispatcher.__dispatch_command__(forgotten)
+    dispatcher.__on_timeout__(TimeoutEvent())
+    self.assertEquals(status.get_transactions(), 2)
+    dispatcher.__dispatch_response__(answered.get_job_uuid(),
+      Event({'Content-Type': 'command/reply'}))
+    dispatcher.__on_timeout__(TimeoutEvent())
+    self.assertEquals(status.get_transactions(), 0)
+    self.assertEquals(status.get_expired_transactions(), 1)
+    timeout = sender.tell.call_args[0][0].get('content')
+    self.assertTrue(isinstance(timeout, JobTimeoutEvent))
+    self.assertEquals(timeout.get_job_uuid(), forgotten.get_job_uuid())
+    self.assertEquals(sender.tell.call_count, 2)
+
+  @mock.patch('lib.server.dispatcher_observer_ttl', 1)
+  def test_observer_expiry(self):
+    dispatcher, status = self.create_dispatcher()
+    observer = mock.Mock()
+    dispatcher.__register_job_observer__(RegisterJobObserverCommand(observer, 'a'))
+    dispatcher.__register_job_observer__(RegisterJobObserverCommand(observer, 'b'))
+    dispatcher.__unregister_job_observer__(UnregisterJobObserverCommand('b'))
+    dispatcher.__on_timeout__(TimeoutEvent())
+    self.assertEquals(status.get_observers(), 0)
+    self.assertEquals(status.get_expired_observers(), 1)
+    self.assertEquals(observer.tell.call_args[0][0].get('content').get_job_uuid(), 'a')
+
+class NodeStatusTests(TestCase):
+  def test_heartbeat(self):
+    status = NodeStatus('node-1')
+    self.assertEquals(status.get_load(), None)
+    status.record_heartbeat(Event({'Event-Name': 'HEARTBEAT',
+      'Session-Count': '150', 'Max-Sessions': '1000', 'Idle-CPU': '80.0'}))
+    self.assertEquals(status.get_load(), 0.15)
+    self.assertEquals(status.get_heartbeat().get('Idle-CPU'), '80.0')
+    self.assertFalse(status.get_last_heartbeat() is None)
+
+  def test_counters(self):
+    status = NodeStatus('node-1')
+    dispatcher = Dispatcher(node = {'name': 'node-1', 'password': 'secret'},
+      status = status)
+    client = mock.Mock()
+    dispatcher.on_receive({'content': InitializeDispatcherEvent(None, client, None)})
+    self.assertTrue(status.is_healthy())
+    dispatcher.on_receive({'content': Event({'Content-Type': 'auth/request'})})
+    self.assertEquals(str(client.send.call_args[0][0]), 'auth secret\n\n')
+    dispatcher.on_receive({'content': EventBatch([
+      Event({'Content-Type': 'text/event-plain', 'Event-Name': 'HEARTBEAT'}),
+      Event({'Content-Type': 'text/event-plain', 'Event-Name': 'HEARTBEAT'})])})
+    self.assertEquals(status.get_events(), 3)
+    dispatcher.on_receive({'content': KillDispatcherEvent()})
+    self.assertFalse(status.is_healthy())
+
+class OutboundDispatcherTests(TestCase):
+  def test_call_flow(self):
+    apps = mock.Mock()
+    client = mock.Mock()
+    dispatcher = OutboundDispatcher(target = 'switchlets.Test')
+    dispatcher.on_receive({'content': InitializeDispatcherEvent(apps, client, {})})
+    self.assertEquals(str(client.send.call_args[0][0]), 'connect\n\n')
+    channel = Event({'Content-Type': 'command/reply',
+      'Event-Name': 'CHANNEL_DATA', 'Unique-ID': 'f81d4fae'})
+    dispatcher.on_receive({'content': channel})
+    commands = [str(call[0][0]) for call in client.send.call_args_list]
+    self.assertEquals(commands[-1], 'filter Unique-ID f81d4fae\n\n')
+    self.assertEquals(len(commands), 3)
+    dispatcher.on_receive({'content': Event({'Content-Type': 'command/reply',
+      'Reply-Text': '+OK event listener enabled %s' % event_socket_format})})
+    self.assertEquals(dispatcher.state(), 'dispatching')
+    apps.get_instance.assert_called_once_with('switchlets.Test',
+      dispatcher = dispatcher.actor_ref)
+    switchlet = apps.get_instance.return_value
+    self.assertEquals(switchlet.tell.call_args[0][0].get('content'), channel)
+    dispatcher.on_receive({'content': RegisterJobObserverCommand(switchlet, '7f4db78a')})
+    self.assertEquals(str(client.send.call_args[0][0]),
+      'filter Job-UUID 7f4db78a\n\n')
+    event = Event({'Content-Type': 'text/event-plain',
+      'Event-Name': 'CHANNEL_ANSWER', 'Unique-ID': 'f81d4fae'})
+    dispatcher.on_receive({'content': event})
+    self.assertEquals(switchlet.tell.call_args[0][0].get('content'), event)
+
+class DispatcherProxyTests(TestCase):
+  def test_event_batch(self):
+    dispatcher = mock.Mock()
+    proxy = DispatcherProxy(None, dispatcher, None)
+    events = [Event({'Event-Name': 'CHANNEL_CREATE'}),
+              Event({'Event-Name': 'CHANNEL_CREATE'})]
+    proxy.on_events(events)
+    self.assertEquals(dispatcher.tell.call_count, 1)
+    message = dispatcher.tell.call_args[0][0].get('content')
+    self.assertTrue(isinstance(message, EventBatch))
+    self.assertEquals(message.get_events(), events)
+
+  def test_single_event_is_not_batched(self):
+    dispatcher = mock.Mock()
+    proxy = DispatcherProxy(None, dispatcher, None)
+    event = Event({'Event-Name': 'CHANNEL_CREATE'})
+    proxy.on_events([event])
+    self.assertEquals(dispatcher.tell.call_args[0][0].get('content'), event)
+
+class DispatchRulesTests(TestCase):
+  def test_first_declared_rule_wins(self):
+    rules = DispatchRules([
+      {'header_name': 'Caller-Destination-Number',
+       'header_pattern': '^555', 'target': 'pattern'},
+      {'header_name': 'Event-Name', 'header_value': 'CHANNEL_CREATE',
+       'target': 'value'}
+    ])
+    event = Event({'Event-Name': 'CHANNEL_CREATE',
+                   'Caller-Destination-Number': '5551234'})
+    self.assertEquals(rules.get_target(event), 'pattern')
+    event = Event({'Event-Name': 'CHANNEL_CREATE',
+                   'Caller-Destination-Number': '1000'})
+    self.assertEquals(rules.get_target(event), 'value')
+
+  def test_no_match(self):
+    rules = DispatchRules([
+      {'header_name': 'Event-Name', 'header_value': 'HEARTBEAT',
+       'target': 'value'}
+    ])
+    self.assertEquals(rules.get_target(Event({'Event-Name': 'CUSTOM'})), None)
+    self.assertEquals(rules.get_target(Event({})), None)
+
+  def test_value_before_pattern_on_same_header(self):
+    rules = DispatchRules([
+      {'header_name': 'Event-Name', 'header_value': 'HEARTBEAT',
+       'target': 'value'},
+      {'header_name': 'Event-Name', 'header_pattern': '^HEART',
+       'target': 'pattern'}
+    ])
+    event = Event({'Event-Name': 'HEARTBEAT'})
+    self.assertEquals(rules.get_target(event), 'value')
+
+class DispatcherProxyBackpressureTests(TestCase):
+  def create_proxy(self, depths):
+    dispatcher = mock.Mock()
+    dispatcher.get_mailbox_depth.side_effect = depths
+    proxy = DispatcherProxy(None, dispatcher, None, high_watermark = 10,
+      low_watermark = 2)
+    client = mock.Mock()
+    proxy.on_start(client)
+    return proxy, client
+
+  @mock.patch('lib.server.reactor')
+  def test_below_high_watermark(self, reactor):
+    proxy, client = self.create_proxy([9])
+    proxy.on_event(Event({'Event-Name': 'CHANNEL_CREATE'}))
+    self.assertFalse(proxy.is_paused())
+    self.assertFalse(client.pause.called)
+    self.assertFalse(reactor.callLater.called)
+
+  @mock.patch('lib.server.reactor')
+  def test_pause_and_resume(self, reactor):
+    proxy, client = self.create_proxy([10, 5, 2])
+    proxy.on_event(Event({'Event-Name': 'CHANNEL_CREATE'}))
+    self.assertTrue(proxy.is_paused())
+    self.assertTrue(client.pause.called)
+    # The mailbox is still above the low watermark.
+    reactor.callLater.call_args[0][1]()
+    self.assertTrue(proxy.is_paused())
+    self.assertFalse(client.resume.called)
+    reactor.callLater.call_args[0][1]()
+    self.assertFalse(proxy.is_paused())
+    self.assertTrue(client.resume.called)
+    self.assertEquals(reactor.callLater.call_count, 2)
+
 class TestApplicationFactoryActor(ThreadingActor):
   def on_receive(self, message):
     pass
@@ -58,6 +770,63 @@ class ApplicationFactoryTests(TestCase):
     self.assertFalse(instance_a.actor_urn == instance_b.actor_urn)
     self.__factory__.shutdown()
 
+  def test_queue_depths(self):
+    ActorRegistry.stop_all()
+    self.__factory__ = ApplicationFactory(object())
+    self.__factory__.register(self.__test_actor_path__)
+    self.__factory__.get_instance(self.__test_actor_path__)
+    self.__factory__.get_instance(self.__test_actor_path__)
+    gauges = self.__factory__.get_queue_depths()
+    gauge = gauges.get(self.__test_actor_path__)
+    self.assertEquals(gauge.get('instances'), 2)
+    self.assertTrue(gauge.get('total') >= gauge.get('largest') >= 0)
+    ActorRegistry.stop_all()
+
+  def test_pooled_instances_are_reused(self):
+    self.__factory__ = ApplicationFactory(object())
+    self.__factory__.register(self.__test_actor_path__, pool_size = 2)
+    self.assertEquals(self.__factory__.get_pool_size(self.__test_actor_path__), 2)
+    instance_a = self.__factory__.get_instance(self.__test_actor_path__)
+    instance_b = self.__factory__.get_instance(self.__test_actor_path__)
+    instance_c = self.__factory__.get_instance(self.__test_actor_path__)
+    self.assertEquals(self.__factory__.get_pool_size(self.__test_actor_path__), 0)
+    self.__factory__.release(instance_a)
+    self.assertEquals(self.__factory__.get_pool_size(self.__test_actor_path__), 1)
+    instance_d = self.__factory__.get_instance(self.__test_actor_path__)
+    self.assertEquals(instance_a.actor_urn, instance_d.actor_urn)
+    self.assertTrue(instance_a.is_alive())
+    self.__factory__.shutdown()
+
+  def test_release_to_full_pool_stops_instance(self):
+    self.__factory__ = ApplicationFactory(object())
+    self.__factory__.register(self.__test_actor_path__, pool_size = 1)
+    instance_a = self.__factory__.get_instance(self.__test_actor_path__)
+    instance_b = self.__factory__.get_instance(self.__test_actor_path__)
+    self.__factory__.release(instance_a)
+    self.__factory__.release(instance_b)
+    self.assertEquals(self.__factory__.get_pool_size(self.__test_actor_path__), 1)
+    self.assertTrue(instance_b.actor_stopped.wait(1))
+    self.assertTrue(instance_a.is_alive())
+    self.__factory__.shutdown()
+    self.assertTrue(instance_a.actor_stopped.wait(1))
+
+  def test_release_resets_instance(self):
+    self.__factory__ = ApplicationFactory(object())
+    self.__factory__.register(self.__test_actor_path__, pool_size = 1)
+    instance = self.__factory__.get_instance(self.__test_actor_path__)
+    with mock.patch.object(instance, 'tell') as tell:
+      self.__factory__.release(instance)
+      self.assertTrue(isinstance(tell.call_args[0][0].get('content'),
+        ResetSwitchletEvent))
+    self.__factory__.shutdown()
+
+  def test_release_without_pool_stops_instance(self):
+    self.__factory__ = ApplicationFactory(object())
+    self.__factory__.register(self.__test_actor_path__)
+    instance = self.__factory__.get_instance(self.__test_actor_path__)
+    self.__factory__.release(instance)
+    self.assertTrue(instance.actor_stopped.wait(1))
+
   def test_singleton_instantiation(self):
     self.__factory__ = ApplicationFactory(object())
     self.__factory__.register(self.__test_actor_path__, type = 'singleton')
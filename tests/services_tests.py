@@ -22,7 +22,7 @@ from lib.services import *
 from pykka import ActorRegistry
 from unittest import TestCase
 
-import logging, math, time
+import lib.clock, logging, math, mock, time
 
 logging.basicConfig(
   format = '%(asctime)s %(levelname)s - %(name)s - %(message)s',
@@ -64,6 +64,188 @@ class TimerServiceTestSwitchlet(Switchlet):
         print 'Initialized timer service test switchlet.'
       self.__last_time__ = now
 
+class MonotonicClockTests(TestCase):
+  def tearDown(self):
+    reload(lib.clock)
+
+  def test_clock_id_per_platform(self):
+    with mock.patch('sys.platform', 'darwin'):
+      reload(lib.clock)
+      self.assertEqual(6, lib.clock.CLOCK_MONOTONIC)
+    with mock.patch('sys.platform', 'linux2'):
+      reload(lib.clock)
+      self.assertEqual(1, lib.clock.CLOCK_MONOTONIC)
+
+  def test_falls_back_when_clock_fails(self):
+    library = mock.Mock()
+    library.clock_gettime.return_value = -1
+    with mock.patch('ctypes.CDLL', return_value = library):
+      reload(lib.clock)
+    self.assertIs(time.time, lib.clock.monotonic)
+
+  def test_monotonic(self):
+    first = lib.clock.monotonic()
+    self.assertTrue(lib.clock.monotonic() >= first)
+
+class TimerServiceHandleTests(TestCase):
+  def create_observer(self, urn):
+    observer = mock.Mock()
+    observer.actor_urn = urn
+    observer.is_alive.return_value = True
+    return observer
+
+  def get_handles(self, observer):
+    handles = list()
+    for call in observer.tell.call_args_list:
+      event = call[0][0].get('content')
+      if isinstance(event, TimeoutBatch):
+        handles.extend([event.get_handle() for event in event.get_events()])
+      else:
+        handles.append(event.get_handle())
+    return handles
+
+  def setUp(self):
+    self.elapsed = 0
+    patcher = mock.patch('lib.services.monotonic', return_value = 0.0)
+    self.monotonic = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def create_service(self):
+    service = TimerService(clock = 'thread')
+    # Start the wheel without starting the clock.
+    service.__epoch__ = 0.0
+    return service
+
+  def tick(self, service, ticks, events = None):
+    self.elapsed += ticks
+    self.monotonic.return_value = self.elapsed * TimerService.TICK_SIZE
+    for event in range(ticks if events is None else events):
+      service.on_receive({'content': ClockEvent()})
+
+  def test_many_timers_per_actor(self):
+    service = self.create_service()
+    observer = self.create_observer('urn:a')
+    service.on_receive({'content': ReceiveTimeoutCommand(observer, 200,
+      handle = 'no answer')})
+    service.on_receive({'content': ReceiveTimeoutCommand(observer, 400,
+      handle = 'max duration')})
+    self.tick(service, 2)
+    self.assertEquals(self.get_handles(observer), ['no answer'])
+    self.tick(service, 2)
+    self.assertEquals(self.get_handles(observer), ['no answer', 'max duration'])
+    self.assertEquals(service.__actor_lookup_table__, dict())
+
+  def test_generated_handles(self):
+    observer = self.create_observer('urn:a')
+    command_a = ReceiveTimeoutCommand(observer, 100)
+    command_b = ReceiveTimeoutCommand(observer, 100)
+    self.assertFalse(command_a.get_handle() == command_b.get_handle())
+    service = self.create_service()
+    service.on_receive({'content': ScheduleTimersCommand([command_a, command_b])})
+    self.tick(service, 1)
+    self.assertEquals(sorted(self.get_handles(observer)),
+      sorted([command_a.get_handle(), command_b.get_handle()]))
+
+  def test_same_handle_replaces_timer(self):
+    service = self.create_service()
+    observer = self.create_observer('urn:a')
+    service.on_receive({'content': ReceiveTimeoutCommand(observer, 100,
+      handle = 'digit')})
+    service.on_receive({'content': ReceiveTimeoutCommand(observer, 300,
+      handle = 'digit')})
+    self.tick(service, 2)
+    self.assertEquals(self.get_handles(observer), [])
+    self.tick(service, 1)
+    self.assertEquals(self.get_handles(observer), ['digit'])
+
+  def test_stop_timer_by_handle(self):
+    service = self.create_service()
+    observer = self.create_observer('urn:a')
+    service.on_receive({'content': ScheduleTimersCommand([
+      ReceiveTimeoutCommand(observer, 100, recurring = True, handle = 'a'),
+      ReceiveTimeoutCommand(observer, 100, recurring = True, handle = 'b'),
+      ReceiveTimeoutCommand(observer, 100, recurring = True, handle = 'c')
+    ])})
+    self.tick(service, 1)
+    service.on_receive({'content': StopTimeoutCommand(observer, handle = 'b')})
+    self.tick(service, 1)
+    self.assertEquals(sorted(self.get_handles(observer)),
+      ['a', 'a', 'b', 'c', 'c'])
+    service.on_receive({'content': StopTimeoutCommand(observer)})
+    self.tick(service, 1)
+    self.assertEquals(len(self.get_handles(observer)), 5)
+    self.assertEquals(service.__actor_lookup_table__, dict())
+
+  def test_clock_catches_up(self):
+    service = self.create_service()
+    observer = self.create_observer('urn:a')
+    service.on_receive({'content': ScheduleTimersCommand([
+      ReceiveTimeoutCommand(observer, 200, handle = 'a'),
+      ReceiveTimeoutCommand(observer, 500, handle = 'b'),
+      ReceiveTimeoutCommand(observer, 100, recurring = True, handle = 'c')
+    ])})
+    self.tick(service, 1, events = 0)
+    self.assertEquals(self.get_handles(observer), [])
+    self.tick(service, 4, events = 1)
+    self.assertEquals(sorted(self.get_handles(observer)),
+      ['a', 'b', 'c', 'c', 'c', 'c', 'c'])
+    self.tick(service, 0, events = 1)
+    self.assertEquals(len(self.get_handles(observer)), 7)
+
+  def test_timers_scheduled_on_lagging_wheel(self):
+    service = self.create_service()
+    observer = self.create_observer('urn:a')
+    # The wheel is 2 seconds behind when the timers are scheduled.
+    self.tick(service, 20, events = 0)
+    service.on_receive({'content': ReceiveTimeoutCommand(observer, 1000,
+      handle = 'a')})
+    service.on_receive({'content': ScheduleTimersCommand([
+      ReceiveTimeoutCommand(observer, 1000, handle = 'b')
+    ])})
+    self.tick(service, 1)
+    self.assertEquals(self.get_handles(observer), [])
+    self.tick(service, 8)
+    self.assertEquals(self.get_handles(observer), [])
+    self.tick(service, 1)
+    self.assertEquals(sorted(self.get_handles(observer)), ['a', 'b'])
+
+  def test_timeouts_are_batched_per_observer(self):
+    service = self.create_service()
+    observer_a = self.create_observer('urn:a')
+    observer_b = self.create_observer('urn:b')
+    service.on_receive({'content': ScheduleTimersCommand([
+      ReceiveTimeoutCommand(observer_a, 100, recurring = True, handle = 'a'),
+      ReceiveTimeoutCommand(observer_a, 100, handle = 'b'),
+      ReceiveTimeoutCommand(observer_b, 100, handle = 'c')
+    ])})
+    self.tick(service, 1)
+    self.assertEquals(observer_a.tell.call_count, 1)
+    batch = observer_a.tell.call_args[0][0].get('content')
+    self.assertTrue(isinstance(batch, TimeoutBatch))
+    self.assertEquals(sorted([event.get_handle()
+      for event in batch.get_events()]), ['a', 'b'])
+    event = observer_b.tell.call_args[0][0].get('content')
+    self.assertTrue(isinstance(event, TimeoutEvent))
+    self.assertEquals(event.get_handle(), 'c')
+    self.tick(service, 1)
+    self.assertEquals(self.get_handles(observer_a), ['a', 'b', 'a'])
+    self.assertEquals(service.__actor_lookup_table__.keys(), ['urn:a'])
+
+  def test_stopped_observer_timers_are_removed(self):
+    service = self.create_service()
+    observer = self.create_observer('urn:a')
+    service.on_receive({'content': ScheduleTimersCommand([
+      ReceiveTimeoutCommand(observer, 100, recurring = True, handle = 'a'),
+      ReceiveTimeoutCommand(observer, 500, handle = 'b')
+    ])})
+    observer.is_alive.return_value = False
+    self.tick(service, 5)
+    self.assertEquals(observer.tell.call_count, 0)
+    self.assertEquals(service.__actor_lookup_table__, dict())
+
+  def test_invalid_clock(self):
+    self.assertRaises(ValueError, TimerService, clock = 'sundial')
+
 class TimerServiceTests(TestCase):
   @classmethod
   def tearDownClass(cls):
@@ -71,7 +253,7 @@ class TimerServiceTests(TestCase):
 
   def test_recurring_timer_one_second_interval(self):
     # Start the timer service.
-    service = TimerService().start()
+    service = TimerService.start(clock = 'thread')
     # Start the seconds switchlet.
     consumer = TimerServiceTestSwitchlet().start()
     event = InitializeTestSwitchletEvent(1000, 100)
@@ -20,12 +20,16 @@
 # Nishad Musthafa  <nishadmusthafa@gmail.com>
 
 from lib.commands import AnswerCommand, KillCommand
-from lib.core import InitializeSwitchletEvent
+from lib.core import InitializeSwitchletEvent, ResetSwitchletEvent
 from lib.esl import Event
-from lib.server import RegisterJobObserverCommand, UnregisterJobObserverCommand
+from lib.server import ApplicationFactory, InitializeDispatcherEvent, \
+  OutboundDispatcher, RegisterJobObserverCommand, ReleaseSwitchletCommand, \
+  UnregisterJobObserverCommand
+from conf.settings import event_socket_format
 from switchlets.call_handlers import IncomingCallHandler
 from switchlets.call_utilities import ActionExecutor, ExecutionComplete, StartExecution
 from switchlets.data_connector import QueryContext, QueryResult
+from pykka import ActorRegistry
 from unittest import TestCase
 import mock, time
 
@@ -151,6 +155,16 @@ class IncomingCallHandlerTests(TestCase):
         message_sent_to_dispatcher = dispatcher.mock_calls[5].call_list()[0][1][0]['content']
         self.assertTrue(isinstance(message_sent_to_dispatcher, UnregisterJobObserverCommand))
         self.assertEquals(incoming_call_handler._actor.__state__, 'call terminated')
+        message_sent_to_dispatcher = dispatcher.mock_calls[6].call_list()[0][1][0]['content']
+        self.assertTrue(isinstance(message_sent_to_dispatcher, ReleaseSwitchletCommand))
+        self.assertEquals(message_sent_to_dispatcher.get_switchlet().actor_urn, incoming_call_handler.actor_urn)
+
+        # State 'call terminated' to 'waiting for incoming call'
+        incoming_call_handler.tell({'content': ResetSwitchletEvent()})
+        time.sleep(2)
+
+        self.assertEquals(incoming_call_handler._actor.__state__, 'waiting for incoming call')
+        self.assertEquals(incoming_call_handler._actor.get_call_uuid(), None)
 
     incoming_call_handler.stop()
 
@@ -223,4 +237,66 @@ class IncomingCallHandlerTests(TestCase):
         self.assertTrue(isinstance(message_sent_to_dispatcher, UnregisterJobObserverCommand))
         self.assertEquals(incoming_call_handler._actor.__state__, 'call terminated')
 
-    incoming_call_handler.stop()
\ No newline at end of file
+    incoming_call_handler.stop()
+
+  def test_incoming_call_handler_outbound_flow(self):
+    target = 'switchlets.call_handlers.IncomingCallHandler'
+    apps = ApplicationFactory(None)
+    apps.register(target, type = 'class')
+    client = mock.Mock()
+    dispatcher = OutboundDispatcher.start(target = target)
+
+    try:
+      with mock.patch('switchlets.data_connector.data_connector.DataConnector.on_receive') as mock_data_connector_on_receive:
+        with mock.patch('switchlets.call_utilities.ActionExecutor.on_receive') as mock_action_executor_on_receive:
+          dispatcher.tell({'content': InitializeDispatcherEvent(apps, client, {})})
+
+          # The CHANNEL_CREATE event fired before the call connected so the
+          # handler starts the call from the channel data.
+          channel_data_headers = {
+                                  'Content-Type': 'command/reply',
+                                  'Event-Name': 'CHANNEL_DATA',
+                                  'Caller-Direction': 'inbound',
+                                  'Unique-ID': 'fake_call_uuid',
+                                  'Channel-Call-UUID': 'fake_call_uuid',
+                                  'Caller-Destination-Number': 'sample_to_number'}
+          dispatcher.tell({'content': Event(channel_data_headers)})
+          dispatcher.tell({'content': Event({'Content-Type': 'command/reply',
+            'Reply-Text': '+OK event listener enabled %s' % event_socket_format})})
+          time.sleep(2)
+
+          self.assertEquals(mock_data_connector_on_receive.call_count, 1)
+          passed_query = mock_data_connector_on_receive.call_args_list[0][0][0]['content']
+          self.assertEquals(passed_query.get_key(), 'sample_to_number')
+          incoming_call_handler = passed_query.get_sender()
+
+          incoming_call_handler.tell({'content': QueryResult('sample_app_name',
+            'sample message', 'fetching execution logic')})
+          time.sleep(2)
+          incoming_call_handler.tell({'content': QueryResult('sample_app_data',
+            'sample message', 'got logic. answering call')})
+          time.sleep(2)
+
+          # The answer command is sent on the call's own connection.
+          commands = [str(call[0][0]) for call in client.send.call_args_list]
+          answer_commands = [command for command in commands
+            if command.startswith('bgapi uuid_answer fake_call_uuid\n')]
+          self.assertEquals(len(answer_commands), 1)
+          job_uuid = answer_commands[0].split('Job-UUID: ')[1].strip()
+          self.assertTrue('filter Job-UUID %s\n\n' % job_uuid in commands)
+
+          call_answer_headers = {
+                                  'Content-Type':'text/event-plain',
+                                  'Event-Name': 'BACKGROUND_JOB',
+                                  'Job-UUID': job_uuid,
+                                  'Job-Command-Arg': 'fake_call_uuid',
+                                  'Job-Command': 'uuid_answer'
+                                  }
+          dispatcher.tell({'content': Event(call_answer_headers)})
+          time.sleep(2)
+
+          self.assertEquals(incoming_call_handler._actor.__state__, 'executing call logic')
+          self.assertEquals(mock_action_executor_on_receive.call_count, 1)
+    finally:
+      # The handler and its action executor are left running by the call.
+      ActorRegistry.stop_all()
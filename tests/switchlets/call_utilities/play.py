@@ -20,7 +20,7 @@
 # Nishad Musthafa  <nishadmusthafa@gmail.com>
 
 from lib.esl import Event
-from lib.server import Dispatcher, WatchEventCommand, UnwatchEventCommand
+from lib.server import Dispatcher, SubscribeCallEventsCommand, UnsubscribeCallEventsCommand
 from switchlets.call_utilities.play import PlayCommand, Play
 from switchlets.call_utilities.utils import StartExecution
 import mock, time
@@ -54,7 +54,6 @@ class PlayTests(TestCase):
       on_play_call_count = mock_on_receive.call_count
       on_play_passed_message_first = mock_on_receive.call_args_list[0][0][0]
       on_play_passed_message_second = mock_on_receive.call_args_list[1][0][0]
-      on_play_passed_message_third = mock_on_receive.call_args_list[2][0][0]
       playback_stop_headers = {
                               'Content-Type':'text/event-plain',
                               'Event-Name': 'PLAYBACK_STOP',
@@ -65,21 +64,23 @@ class PlayTests(TestCase):
       play.tell({'content': playback_stop})
       time.sleep(2)
       on_playback_stop_call_count = mock_on_receive.call_count
-      on_playback_stop_message_first = mock_on_receive.call_args_list[3][0][0]
-      on_playback_stop_message_second = mock_on_receive.call_args_list[4][0][0]
-
-    self.assertTrue(on_play_call_count, 3)
-    self.assertTrue(isinstance(on_play_passed_message_first['content'], WatchEventCommand))
-    self.assertTrue(isinstance(on_play_passed_message_second['content'], WatchEventCommand))
-    self.assertTrue(isinstance(on_play_passed_message_third['content'], PlayCommand))
-    passed_play_command = on_play_passed_message_third['content']
+      on_playback_stop_message = mock_on_receive.call_args_list[2][0][0]
+
+    self.assertEquals(on_play_call_count, 2)
+    subscription = on_play_passed_message_first['content']
+    self.assertTrue(isinstance(subscription, SubscribeCallEventsCommand))
+    self.assertEquals('fake_call_uuid', subscription.get_uuid())
+    self.assertEquals(frozenset(['PLAYBACK_STOP', 'CHANNEL_EXECUTE_COMPLETE']),
+      subscription.get_events())
+    self.assertTrue(isinstance(on_play_passed_message_second['content'], PlayCommand))
+    passed_play_command = on_play_passed_message_second['content']
     self.assertEquals('playback', passed_play_command.__app_name__)
     self.assertEquals('fake_call_uuid', passed_play_command.__uuid__)
     desired_play_command_output = 'sendmsg fake_call_uuid\ncall-command: execute\nexecute-app-name: playback\ncontent-type: text/plain\ncontent-length: 8\n\nplay_url\n'
     self.assertEquals(desired_play_command_output, str(passed_play_command))
-    self.assertTrue(on_playback_stop_call_count, 5)
-    self.assertTrue(isinstance(on_playback_stop_message_first['content'], UnwatchEventCommand))
-    self.assertTrue(isinstance(on_playback_stop_message_second['content'], UnwatchEventCommand))
+    self.assertEquals(on_playback_stop_call_count, 3)
+    self.assertTrue(isinstance(on_playback_stop_message['content'], UnsubscribeCallEventsCommand))
+    self.assertEquals(subscription, on_playback_stop_message['content'].get_subscription())
 
     dispatcher.stop()
     play.stop()
@@ -103,7 +104,6 @@ class PlayTests(TestCase):
       on_play_call_count = mock_on_receive.call_count
       on_play_passed_message_first = mock_on_receive.call_args_list[0][0][0]
       on_play_passed_message_second = mock_on_receive.call_args_list[1][0][0]
-      on_play_passed_message_third = mock_on_receive.call_args_list[2][0][0]
       channel_execute_headers = {
                               'Content-Type':'text/event-plain',
                               'Event-Name': 'CHANNEL_EXECUTE_COMPLETE',
@@ -117,21 +117,23 @@ class PlayTests(TestCase):
       play.tell({'content': channel_executed})
       time.sleep(2)
       on_channel_executed_call_count = mock_on_receive.call_count
-      on_channel_executed_message_first = mock_on_receive.call_args_list[3][0][0]
-      on_channel_executed_message_second = mock_on_receive.call_args_list[3][0][0]
-
-    self.assertTrue(on_play_call_count, 3)
-    self.assertTrue(isinstance(on_play_passed_message_first['content'], WatchEventCommand))
-    self.assertTrue(isinstance(on_play_passed_message_second['content'], WatchEventCommand))
-    self.assertTrue(isinstance(on_play_passed_message_third['content'], PlayCommand))
-    passed_play_command = on_play_passed_message_third['content']
+      on_channel_executed_message = mock_on_receive.call_args_list[2][0][0]
+
+    self.assertEquals(on_play_call_count, 2)
+    subscription = on_play_passed_message_first['content']
+    self.assertTrue(isinstance(subscription, SubscribeCallEventsCommand))
+    self.assertEquals('fake_call_uuid', subscription.get_uuid())
+    self.assertEquals(frozenset(['PLAYBACK_STOP', 'CHANNEL_EXECUTE_COMPLETE']),
+      subscription.get_events())
+    self.assertTrue(isinstance(on_play_passed_message_second['content'], PlayCommand))
+    passed_play_command = on_play_passed_message_second['content']
     self.assertEquals('playback', passed_play_command.__app_name__)
     self.assertEquals('fake_call_uuid', passed_play_command.__uuid__)
     desired_play_command_output = 'sendmsg fake_call_uuid\ncall-command: execute\nexecute-app-name: playback\ncontent-type: text/plain\ncontent-length: 8\n\nplay_url\n'
     self.assertEquals(desired_play_command_output, str(passed_play_command))
-    self.assertEquals(on_channel_executed_call_count, 5)
-    self.assertTrue(isinstance(on_channel_executed_message_first['content'], UnwatchEventCommand))
-    self.assertTrue(isinstance(on_channel_executed_message_second['content'], UnwatchEventCommand))
+    self.assertEquals(on_channel_executed_call_count, 3)
+    self.assertTrue(isinstance(on_channel_executed_message['content'], UnsubscribeCallEventsCommand))
+    self.assertEquals(subscription, on_channel_executed_message['content'].get_subscription())
 
     dispatcher.stop()
     play.stop()
\ No newline at end of file